@@ -1,80 +1,355 @@
 import os
+import queue
 import subprocess
 import sys
+import threading
 import time
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
+import categorize
+import db
+import ingest
+import ingest_plan
+import journal
+import merchant
+import metrics
+import reconcile
+import schema
 
 # Paths and settings
 DROPZONE_PATH = os.path.abspath('./dropzone')
 COMPLETED_PATH = os.path.abspath('./completed')
-INGESTION_SCRIPT = './ingest.py'
-MERCHANT_SCRIPT = './merchant.py'
 MERCHANT_META_SCRIPT = './merchant_meta.py'
+RUN_MERCHANT_META = True  # merchant_meta.py enriches new merchants through the LLM, caching every response
+MERCHANT_META_LIMIT = 500  # merchants enriched per run, the rest wait for the next merchant pass
+OPENAI_KEY_FILE = './openai_key.txt'  # read by merchant_meta.py when OPENAI_API_KEY is not set
 CONFIG_FILE = './config.yaml'
+CATEGORY_RULES_FILE = './category_rules.yaml'  # optional exact and prefix merchant rules for categorize.py
+DB_FILE = './financials.db'
+INGEST_WORKERS = 4
+STABLE_SECONDS = 2  # a file's size and mtime must stay unchanged this long before it is ingested
+QUIET_SECONDS = 10  # the merchant pass runs once nothing has been detected or committed for this long
+POLL_INTERVAL = 0.5
+METRICS_FILE = './metrics.prom'  # rewritten after every commit and merchant pass, for a textfile collector
+METRICS_PORT = None  # e.g. 9108 to also serve the metrics at http://127.0.0.1:9108/metrics
+EVENT_LOG_FILE = './events.log'  # structured JSON events, one per line
+EXPORT_DIR = None  # e.g. './exports/transactions' to keep the columnar export (export.py) current after each merchant pass
+
+class IngestEngine:
+    """In-process ingestion: a bounded worker pool prepares files concurrently and a single writer commits them."""
+
+    def __init__(self, on_committed, on_idle, workers=INGEST_WORKERS):
+        # Both callbacks run on the writer thread, after a commit and whenever the pending queue drains
+        self.on_committed = on_committed
+        self.on_idle = on_idle
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ingest-prepare')
+        # Bounded so workers can't hold more than a few prepared files in memory ahead of the writer
+        self.write_queue = queue.Queue(maxsize=workers)
+        self.lock = threading.Lock()
+        self.pending = {}  # file_path -> [account_name, state]
+        self.failed = set()
+        self.writer = threading.Thread(target=self._write_loop, name='ingest-writer', daemon=True)
+
+    def start(self):
+        """Start the writer thread."""
+        self.writer.start()
+
+    def stop(self):
+        """Finish the files already submitted, then stop the workers and the writer."""
+        self.pool.shutdown(wait=True)
+        self.write_queue.put(None)
+        self.writer.join()
+
+    def submit(self, account_name, file_path):
+        """Queue a file for ingestion, ignoring files that are already pending."""
+        with self.lock:
+            if file_path in self.pending:
+                return False
+            self.pending[file_path] = [account_name, 'queued']
+            self.failed.discard(file_path)
+        self.pool.submit(self._prepare, account_name, file_path)
+        self.publish_queue_depth()
+        metrics.event('file_queued', account=account_name, file=file_path)
+        print(f"Queued file '{file_path}' for account '{account_name}' ({self.pending_count()} pending)")
+        return True
+
+    def pending_count(self):
+        """Return the number of files queued, being prepared or waiting for the writer."""
+        with self.lock:
+            return len(self.pending)
+
+    def pending_snapshot(self):
+        """Return a copy of the pending queue as {file_path: (account_name, state)}."""
+        with self.lock:
+            return {file_path: tuple(entry) for file_path, entry in self.pending.items()}
+
+    def _set_state(self, file_path, state):
+        with self.lock:
+            if file_path in self.pending:
+                self.pending[file_path][1] = state
+        self.publish_queue_depth()
+
+    def publish_queue_depth(self):
+        """Set the queue_depth gauge for every pending state and for the prepared files awaiting the writer."""
+        with self.lock:
+            states = [state for _, state in self.pending.values()]
+        for state in ('queued', 'preparing', 'waiting', 'writing'):
+            metrics.gauge('queue_depth', states.count(state), state=state)
+        metrics.gauge('queue_depth', self.write_queue.qsize(), state='write_queue')
+
+    def _prepare(self, account_name, file_path):
+        """Parse and prepare a file on a worker thread and hand it to the writer."""
+        self._set_state(file_path, 'preparing')
+        try:
+            with metrics.stage('prepare_file', account=account_name), metrics.profiled(file_path, 'prepare'):
+                prepared = ingest.prepare_file(account_name, file_path, CONFIG_FILE)
+        except Exception as e:
+            print(f"Error preparing file '{file_path}': {e}")
+            metrics.event('file_failed', account=account_name, file=file_path, stage='prepare', error=str(e))
+            prepared = None
+        else:
+            self._set_state(file_path, 'waiting')
+        # Failures also go through the writer so pending bookkeeping stays on one thread
+        self.write_queue.put((account_name, file_path, prepared))
+
+    def _write_loop(self):
+        """Commit prepared files one at a time on the shared writer connection."""
+        while True:
+            item = self.write_queue.get()
+            if item is None:
+                break
+            account_name, file_path, prepared = item
+            self._finish(file_path, prepared is not None and self._write(account_name, file_path, prepared))
+
+    def _write(self, account_name, file_path, prepared):
+        self._set_state(file_path, 'writing')
+        print(f"Processing file '{file_path}' for account '{account_name}'...")
+        committed = False
+        try:
+            with db.get_database(DB_FILE).reader() as conn:
+                committed = journal.is_committed(conn.cursor(), prepared['file_hash'], account_name)
+            if committed:
+                # Its earlier move out of the dropzone failed; ingesting it again would only add duplicates
+                print(f"File '{file_path}' is already committed, only moving it")
+            else:
+                with metrics.stage('write_file', account=account_name), metrics.profiled(file_path, 'write'):
+                    with db.get_database(DB_FILE).writer() as conn:
+                        ingest.ingest_prepared_file(conn, prepared)
+                metrics.event('file_committed', account=account_name, file=file_path)
+        except Exception as e:
+            print(f"Error processing file '{file_path}': {e}")
+            metrics.event('file_failed', account=account_name, file=file_path, stage='write', error=str(e))
+            if not committed:
+                record_journal(prepared['file_hash'], account_name, file_path, journal.FAILED)
+            return False
+        self.on_committed(account_name, file_path, prepared['file_hash'])
+        return True
+
+    def _finish(self, file_path, success):
+        """Drop a file from the pending queue whether or not it succeeded."""
+        with self.lock:
+            self.pending.pop(file_path, None)
+            if not success:
+                self.failed.add(file_path)
+            remaining = len(self.pending)
+        metrics.count('files_total', outcome='committed' if success else 'failed')
+        self.publish_queue_depth()
+        write_metrics()
+        print(f"{remaining} file(s) pending")
+        if remaining == 0:
+            self.on_idle()
+
+class DropzoneScheduler:
+    """Sits between watchdog and the ingest engine.
+
+    Events for the same file are coalesced and the file is only submitted once its
+    size and mtime have been stable for STABLE_SECONDS. Ready files are submitted
+    grouped per account, and the merchant pass runs once per quiet period after
+    something was committed, on its own thread so files that settle meanwhile are
+    still submitted. The pending set is kept in memory, so deciding whether the
+    dropzone is drained never walks the tree.
+    """
+
+    def __init__(self, engine, on_quiet):
+        self.engine = engine
+        self.on_quiet = on_quiet
+        self.lock = threading.Lock()
+        self.candidates = {}  # file_path -> {'account_name', 'signature', 'stable_since'}
+        # Start dirty so the merchant pass also runs once after startup
+        self.dirty = True
+        self.last_activity = time.monotonic()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='dropzone-scheduler', daemon=True)
+        self.quiet_thread = None
+
+    def start(self):
+        """Start the scheduler thread."""
+        self.thread.start()
+
+    def stop(self):
+        """Stop the scheduler thread and wait for a running merchant pass, files still settling are picked up again on the next startup."""
+        self.stopping.set()
+        self.thread.join()
+        if self.quiet_thread is not None:
+            self.quiet_thread.join()
+
+    def note_file(self, account_name, file_path):
+        """Record an event for a file, restarting its stability timer."""
+        with self.lock:
+            self.candidates[file_path] = {'account_name': account_name, 'signature': None, 'stable_since': None}
+            self.last_activity = time.monotonic()
+
+    def forget_file(self, file_path):
+        """Stop tracking a file that was deleted or moved away."""
+        with self.lock:
+            self.candidates.pop(file_path, None)
+
+    def note_committed(self):
+        """Record that a file was committed, so a merchant pass is due after the next quiet period."""
+        with self.lock:
+            self.dirty = True
+            self.last_activity = time.monotonic()
+
+    def note_activity(self):
+        """Restart the quiet period."""
+        with self.lock:
+            self.last_activity = time.monotonic()
+
+    def pending_files(self):
+        """Return the files still settling or queued in the ingest engine."""
+        with self.lock:
+            pending = set(self.candidates)
+        return pending | set(self.engine.pending_snapshot())
+
+    def _poll_ready(self):
+        """Return {account_name: [file_path]} for the files whose size and mtime have settled."""
+        now = time.monotonic()
+        ready = {}
+        with self.lock:
+            entries = list(self.candidates.items())
+        for file_path, entry in entries:
+            try:
+                stat = os.stat(file_path)
+            except FileNotFoundError:
+                self.forget_file(file_path)
+                continue
+            signature = (stat.st_size, stat.st_mtime_ns)
+            with self.lock:
+                if self.candidates.get(file_path) is not entry:
+                    continue  # a newer event replaced the entry while we were looking
+                if entry['signature'] != signature:
+                    entry['signature'] = signature
+                    entry['stable_since'] = now
+                elif now - entry['stable_since'] >= STABLE_SECONDS:
+                    del self.candidates[file_path]
+                    ready.setdefault(entry['account_name'], []).append(file_path)
+        return ready
+
+    def _quiet_pass_due(self):
+        with self.lock:
+            if not self.dirty or self.candidates or time.monotonic() - self.last_activity < QUIET_SECONDS:
+                return False
+        if self.quiet_thread is not None and self.quiet_thread.is_alive():
+            return False  # stays dirty, the next pass runs once this one is done
+        return self.engine.pending_count() == 0
+
+    def _run(self):
+        while not self.stopping.wait(POLL_INTERVAL):
+            for account_name, file_paths in sorted(self._poll_ready().items()):
+                for file_path in sorted(file_paths):
+                    self.engine.submit(account_name, file_path)
+            if self._quiet_pass_due():
+                with self.lock:
+                    self.dirty = False
+                # Its transactions take turns with ingest commits on the shared writer connection
+                self.quiet_thread = threading.Thread(target=self.on_quiet, name='merchant-pass', daemon=True)
+                self.quiet_thread.start()
 
 class DropzoneHandler(FileSystemEventHandler):
     """Handler for monitoring new files in the dropzone folder structure."""
 
     def __init__(self):
         super().__init__()
-        self.pending_files = 0
+        self.engine = IngestEngine(on_committed=self.file_committed, on_idle=self.note_activity)
+        self.scheduler = DropzoneScheduler(self.engine, on_quiet=self.run_merchant_scripts)
+        # merchant_meta.py runs in the background so the scheduler keeps submitting files meanwhile
+        self.merchant_meta_thread = None
+        self.merchant_meta_warned = False
+
+    @property
+    def pending_files(self):
+        """Number of files settling or submitted to the ingest engine and not yet finished."""
+        return len(self.scheduler.pending_files())
+
+    def start(self):
+        """Start the ingest engine and the scheduler."""
+        self.engine.start()
+        self.scheduler.start()
+
+    def stop(self):
+        """Stop the scheduler and a running merchant pass, then let the engine and a running merchant_meta.py finish."""
+        self.scheduler.stop()
+        self.engine.stop()
+        if self.merchant_meta_thread is not None:
+            self.merchant_meta_thread.join()
+
+    def note_csv(self, file_path, verb):
+        """Hand a dropzone .csv path to the scheduler."""
+        if not file_path.lower().endswith('.csv'):
+            return  # Skip non-CSV files
+        account_folder = os.path.relpath(file_path, DROPZONE_PATH)
+        if account_folder.startswith(os.pardir):
+            return  # Moved out of the dropzone, e.g. into completed/
+        account_name = os.path.dirname(account_folder)
+        print(f"{verb} .csv file for account '{account_name}': {file_path}")
+        self.scheduler.note_file(account_name, file_path)
 
     def on_created(self, event):
         """Triggered when a new file is created in the dropzone."""
-        if event.is_directory or not event.src_path.lower().endswith('.csv'):
-            return  # Skip directories and non-CSV files
+        if not event.is_directory:
+            self.note_csv(event.src_path, "New")
 
-        account_folder = os.path.relpath(event.src_path, DROPZONE_PATH)
-        account_name = os.path.dirname(account_folder)
-        file_path = event.src_path
-        
-        print(f"New .csv file detected for account '{account_name}': {file_path}")
-        
-        self.pending_files += 1
-        success = self.process_file(account_name, file_path)
-        
-        if success:
-            self.move_to_completed(account_name, file_path)
-            self.pending_files -= 1
+    def on_modified(self, event):
+        """Triggered while a file is still being written."""
+        if not event.is_directory:
+            self.note_csv(event.src_path, "Modified")
 
-            # Check if all files have been processed and run merchant scripts if so
-            if self.pending_files == 0 and self.is_dropzone_empty():
-                self.run_merchant_scripts()
+    def on_moved(self, event):
+        """Triggered when a file is renamed into, within or out of the dropzone."""
+        if not event.is_directory:
+            self.scheduler.forget_file(event.src_path)
+            self.note_csv(event.dest_path, "Moved")
 
-    def process_file(self, account_name, file_path):
-        """Invoke the ingestion script with account name and file path."""
-        try:
-            command = [
-                'python', INGESTION_SCRIPT,
-                account_name, file_path,
-                '--config', CONFIG_FILE
-            ]
-            print(f"Processing file '{file_path}' for account '{account_name}'...")
-            result = subprocess.run(command, check=True, capture_output=True, text=True)
-            print(result.stdout)
-            return True
-        except subprocess.CalledProcessError as e:
-            print(f"Error processing file '{file_path}': {e.stderr}")
-            return False
+    def on_deleted(self, event):
+        """Triggered when a file is removed before it was ingested."""
+        if not event.is_directory:
+            self.scheduler.forget_file(event.src_path)
 
-    def move_to_completed(self, account_name, file_path):
-        """Move a processed file to the completed folder with a timestamped filename."""
-        completed_folder = os.path.join(COMPLETED_PATH, account_name)
-        os.makedirs(completed_folder, exist_ok=True)
+    def note_activity(self):
+        """Called by the engine when its queue drains."""
+        self.scheduler.note_activity()
 
-        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        filename = os.path.basename(file_path)
-        new_filename = f"{timestamp}_{filename}"
-        completed_path = os.path.join(completed_folder, new_filename)
-        
-        os.rename(file_path, completed_path)
+    def file_committed(self, account_name, file_path, file_hash):
+        """Move a committed file out of the dropzone and schedule a merchant pass."""
+        self.move_to_completed(account_name, file_path, file_hash)
+        self.scheduler.note_committed()
+
+    def move_to_completed(self, account_name, file_path, file_hash):
+        """Move a processed file to the completed folder with a timestamped filename and journal the move."""
+        try:
+            completed_path = ingest.move_to_completed(account_name, file_path, COMPLETED_PATH)
+        except OSError as e:
+            # Journaled as committed, so the next startup finishes the move instead of ingesting it again
+            print(f"Error moving file '{file_path}' to completed: {e}")
+            return
         print(f"File '{file_path}' moved to '{completed_path}'")
+        record_journal(file_hash, account_name, completed_path, journal.MOVED)
 
     def ingest_existing_files(self):
-        """Process all existing .csv files in the dropzone on service startup."""
+        """Schedule all existing .csv files in the dropzone on service startup, returning how many were found."""
         print("Starting ingestion of existing .csv files in the dropzone...")
+        found = 0
         for account_name in os.listdir(DROPZONE_PATH):
             account_folder = os.path.join(DROPZONE_PATH, account_name)
             if os.path.isdir(account_folder):
@@ -82,53 +357,156 @@ class DropzoneHandler(FileSystemEventHandler):
                     file_path = os.path.join(account_folder, file_name)
                     if file_name.lower().endswith('.csv') and os.path.isfile(file_path):
                         print(f"Found existing .csv file '{file_path}' for account '{account_name}'")
-                        self.pending_files += 1
-                        success = self.process_file(account_name, file_path)
-                        if success:
-                            self.move_to_completed(account_name, file_path)
-                            self.pending_files -= 1
-
-    def is_dropzone_empty(self):
-        """Check if there are any remaining .csv files in the dropzone directory."""
-        for root, _, files in os.walk(DROPZONE_PATH):
-            if any(file.lower().endswith('.csv') for file in files):
-                return False
+                        if not self.recover_committed_file(account_name, file_path):
+                            self.scheduler.note_file(account_name, file_path)
+                        found += 1
+        return found
+
+    def recover_committed_file(self, account_name, file_path):
+        """Finish moving a file the journal shows was committed before the service stopped. Returns True if it was."""
+        file_hash = ingest.file_digest(file_path)
+        with db.get_database(DB_FILE).reader() as conn:
+            committed = journal.is_committed(conn.cursor(), file_hash, account_name)
+        if not committed:
+            return False
+        print(f"File '{file_path}' was committed before the last shutdown, finishing its move")
+        metrics.event('file_recovered', account=account_name, file=file_path)
+        metrics.count('files_total', outcome='recovered')
+        self.move_to_completed(account_name, file_path, file_hash)
         return True
 
     def run_merchant_scripts(self):
-        """Run the merchant.py script, followed by the merchant_meta.py script to add metadata."""
-        print("Running merchant update script...")
+        """Link Amazon orders to Amex charges, update and categorize the merchant table, then run merchant_meta.py to add metadata."""
+        print("Running Amazon order reconciliation...")
+        try:
+            with metrics.stage('reconcile'), db.get_database(DB_FILE).writer() as conn:
+                links = db.with_retry(reconcile.reconcile, conn)
+            metrics.event('reconcile', links=links)
+        except Exception as e:
+            metrics.event('reconcile_failed', error=str(e))
+            print(f"Error running Amazon order reconciliation: {e}")
+
+        print("Running merchant update...")
         merchant_success = False
         
         try:
-            # Run merchant.py to update the merchant table
-            result = subprocess.run(['python', MERCHANT_SCRIPT], check=True, text=True, stdout=sys.stdout, stderr=sys.stderr)
+            # Update the merchant table in-process on the writer the ingest engine uses, so they never contend
+            with metrics.stage('merchant_pass'), db.get_database(DB_FILE).writer() as conn:
+                merchants = db.with_retry(merchant.refresh_merchants, conn, False, CONFIG_FILE)
+            metrics.event('merchant_pass', merchants=len(merchants))
             print("Merchant update completed.")
             merchant_success = True
-        except subprocess.CalledProcessError as e:
-            print(f"Error running merchant update script: {e.stderr}")
+        except Exception as e:
+            metrics.event('merchant_pass_failed', error=str(e))
+            print(f"Error running merchant update: {e}")
+
+        if merchant_success:
+            self.run_categorize()
+        write_metrics()
+
+        if EXPORT_DIR:
+            self.run_export()
 
         # Only run merchant_meta.py if merchant.py ran successfully
-        if False: #merchant_success:
-            print("Running merchant metadata update script...")
-            try:
-                # Stream output directly to avoid buffering issues
-                result = subprocess.run(['python', MERCHANT_META_SCRIPT], check=True, text=True, stdout=sys.stdout, stderr=sys.stderr)
-                print("Merchant metadata update completed.")
-            except subprocess.CalledProcessError as e:
-                print(f"Error running merchant metadata update script: {e.stderr}")
+        if RUN_MERCHANT_META and merchant_success:
+            self.start_merchant_meta()
+
+    def start_merchant_meta(self):
+        """Start merchant_meta.py on a background thread, unless it is still running or no API key is configured."""
+        if not os.environ.get('OPENAI_API_KEY') and not os.path.exists(OPENAI_KEY_FILE):
+            if not self.merchant_meta_warned:
+                print(f"Warning: neither OPENAI_API_KEY nor {OPENAI_KEY_FILE} is set, skipping merchant metadata updates")
+                self.merchant_meta_warned = True
+            return
+        if self.merchant_meta_thread is not None and self.merchant_meta_thread.is_alive():
+            print("Merchant metadata update still running, skipping it this pass")
+            return
+        self.merchant_meta_thread = threading.Thread(target=self.run_merchant_meta, name='merchant-meta', daemon=True)
+        self.merchant_meta_thread.start()
+
+    def run_merchant_meta(self):
+        """Run merchant_meta.py for at most MERCHANT_META_LIMIT merchants; its writes retry while the database is busy."""
+        print("Running merchant metadata update script...")
+        try:
+            # Stream output directly to avoid buffering issues
+            with metrics.stage('merchant_meta'):
+                subprocess.run([sys.executable, MERCHANT_META_SCRIPT, '--limit', str(MERCHANT_META_LIMIT)],
+                               check=True, text=True, stdout=sys.stdout, stderr=sys.stderr)
+            metrics.event('merchant_meta')
+            print("Merchant metadata update completed.")
+        except subprocess.CalledProcessError as e:
+            metrics.event('merchant_meta_failed', error=str(e))
+            print(f"Error running merchant metadata update script: {e}")
+
+    def run_categorize(self):
+        """Categorize new merchants locally, so merchant_meta.py only asks the LLM about uncertain ones."""
+        print("Running merchant categorization...")
+        try:
+            with metrics.stage('categorize'), db.get_database(DB_FILE).writer() as conn:
+                results = db.with_retry(categorize.categorize, conn, False, CATEGORY_RULES_FILE)
+            metrics.event('categorize', merchants=len(results))
+            print("Merchant categorization completed.")
+        except Exception as e:
+            metrics.event('categorize_failed', error=str(e))
+            print(f"Error running merchant categorization: {e}")
+
+    def run_export(self):
+        """Append the transactions ingested since the last export to the columnar export."""
+        print("Running transaction export...")
+        try:
+            # Imported here so pyarrow is only needed when the export is switched on
+            import export
+            with metrics.stage('export'):
+                rows = export.export(DB_FILE, EXPORT_DIR)
+            metrics.event('export', rows=rows)
+            print("Transaction export completed.")
+        except Exception as e:
+            metrics.event('export_failed', error=str(e))
+            print(f"Error running transaction export: {e}")
+
+def record_journal(file_hash, account_name, file_path, state):
+    """Journal a state change of a file on the writer, reporting rather than raising errors."""
+    try:
+        with db.get_database(DB_FILE).writer() as conn:
+            db.with_retry(journal.record_now, conn, file_hash, account_name, file_path, state)
+    except Exception as e:
+        print(f"Error journaling file '{file_path}' as {state}: {e}")
+
+def write_metrics():
+    """Rewrite METRICS_FILE, logging rather than raising since metrics must never stop an ingest."""
+    if not METRICS_FILE:
+        return
+    try:
+        metrics.write_file(METRICS_FILE)
+    except OSError as e:
+        print(f"Error writing metrics file '{METRICS_FILE}': {e}")
 
 def run_service():
     """Set up and run the dropzone folder monitoring service."""
+    if EVENT_LOG_FILE:
+        metrics.configure_event_log(EVENT_LOG_FILE)
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+        print(f"Serving metrics at http://127.0.0.1:{METRICS_PORT}/metrics")
     event_handler = DropzoneHandler()
-    
-    # Process existing .csv files in the dropzone on startup
+
+    # Reject a malformed config before anything is ingested; later edits are picked up by mtime
+    try:
+        plans = ingest_plan.load_plans(CONFIG_FILE)
+    except ValueError as e:
+        print(e)
+        return
+    print(f"Loaded ingest plans for {len(plans)} accounts from {CONFIG_FILE}")
+
+    # Bring existing account tables up to the current schema before ingesting anything
+    print("Migrating database schema...")
+    migrated = schema.migrate(DB_FILE, CONFIG_FILE)
+    print(f"Schema at version {schema.SCHEMA_VERSION}, migrated tables: {migrated or 'none'}")
+
+    # Process existing .csv files in the dropzone on startup, the merchant pass follows once things go quiet
     print("Processing existing .csv files in the dropzone on startup...")
     event_handler.ingest_existing_files()
-
-    # Run merchant scripts after initial ingestion of existing files
-    if event_handler.pending_files == 0 and event_handler.is_dropzone_empty():
-        event_handler.run_merchant_scripts()
+    event_handler.start()
 
     observer = Observer()
     observer.schedule(event_handler, path=DROPZONE_PATH, recursive=True)
@@ -143,6 +521,8 @@ def run_service():
         print("Stopping service...")
         observer.stop()
     observer.join()
+    event_handler.stop()
+    db.close_all()
 
 if __name__ == "__main__":
     run_service()
@@ -1,5 +1,5 @@
 SELECT
-    substr(a.unique_hash, 1, 5) || '...' || substr(a.unique_hash, -4) AS unique_hash,
+    substr(lower(hex(a.unique_hash)), 1, 5) || '...' || substr(lower(hex(a.unique_hash)), -4) AS unique_hash,
     'amexcc' AS Account,
     a."Date" AS tx_date,
     a.Description AS tx_merchant,
@@ -0,0 +1,270 @@
+import os
+import sys
+import time
+import argparse
+import itertools
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import db
+import ingest
+import ingest_plan
+import journal
+import metrics
+import schema
+
+# Database file path
+DB_FILE = 'financials.db'
+CONFIG_FILE = 'config.yaml'
+COMPLETED_PATH = 'completed'
+# Worker processes parsing and hashing files; each holds at most one prepared file ahead of the writer
+BACKFILL_WORKERS = os.cpu_count() or 4
+
+# A backfill ingests a tree laid out like the dropzone, <root>/<account>/**/*.csv, in parallel.
+# Workers parse and hash whole files; the single writer applies them in path order inside one
+# transaction per account, so rows repeated across an account's files are tagged from the keys
+# already written in the batch and only the rest are probed in the table. Committed files are
+# moved into completed/<account>/ and journaled, so a rerun after a crash only moves the files
+# an earlier run committed. Every account is written in bulk mode, which produces the
+# same rows as row mode, except stream accounts: their files are written one at a time through
+# ingest's streamed path on the writer, one chunk in memory and one transaction per chunk.
+
+def find_files(root):
+    """Return (account_name, file_path, size) for every .csv under root/<account>/, sorted by account and path."""
+    files = []
+    for account_name in sorted(os.listdir(root)):
+        account_folder = os.path.join(root, account_name)
+        if not os.path.isdir(account_folder):
+            continue
+        for folder, _, file_names in os.walk(account_folder):
+            for file_name in file_names:
+                file_path = os.path.join(folder, file_name)
+                if file_name.lower().endswith('.csv') and os.path.isfile(file_path):
+                    files.append((account_name, file_path, os.path.getsize(file_path)))
+    return sorted(files)
+
+def prepare_bulk_file(account_name, csv_file, config_file):
+    """Parse and hash a file in a worker process, returning its content hash and its prepared bulk rows."""
+    plan = ingest_plan.get_plan(config_file, account_name)
+    df = ingest.read_csv_file(csv_file, plan.config)
+    return ingest.file_digest(csv_file), ingest.prepare_bulk_rows(account_name, df, plan)
+
+def is_stream_account(account_name, config_file):
+    return ingest_plan.get_plan(config_file, account_name).ingest_mode == 'stream'
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s" if hours else f"{minutes}m{seconds:02d}s"
+
+class Progress:
+    """Files and bytes written so far, with an ETA from the byte rate."""
+
+    def __init__(self, files):
+        self.total_files = len(files)
+        self.total_bytes = sum(size for _, _, size in files) or 1
+        self.done_files = 0
+        self.done_bytes = 0
+        self.rows = 0
+        self.started = time.monotonic()
+
+    def file_done(self, size, rows=0):
+        self.done_files += 1
+        self.done_bytes += size
+        self.rows += rows
+        elapsed = time.monotonic() - self.started
+        fraction = self.done_bytes / self.total_bytes
+        eta = format_duration(elapsed / fraction - elapsed) if fraction else '?'
+        print(f"[{self.done_files}/{self.total_files} files, {fraction:.0%}] {self.rows} rows "
+              f"in {format_duration(elapsed)}, ETA {eta}", flush=True)
+
+def prepared_in_order(pool, files, config_file, window):
+    """Yield (account_name, file_path, size, (file hash, bulk rows) or exception) in file order, keeping window files in flight.
+
+    Files of stream accounts are not prepared ahead and come with None, write_streamed_account reads them.
+    """
+    pending = deque()
+    files = iter(files)
+    while True:
+        while len(pending) < window:
+            item = next(files, None)
+            if item is None:
+                break
+            account_name, file_path, _ = item
+            if is_stream_account(account_name, config_file):
+                pending.append((item, None))
+            else:
+                pending.append((item, pool.submit(prepare_bulk_file, account_name, file_path, config_file)))
+        if not pending:
+            return
+        item, future = pending.popleft()
+        if future is None:
+            yield item + (None,)
+            continue
+        try:
+            result = future.result()
+        except Exception as e:
+            result = e
+        yield item + (result,)
+
+def write_account(conn, account_name, items, config_file, progress):
+    """Write one account's prepared files in a single transaction.
+
+    Files the journal shows were committed by an earlier run that died before moving them
+    are not written again, and are still moved if the account is rolled back. A file with
+    the same content as one earlier in the batch is written, its rows tagged as duplicates.
+    Returns ([(file path, content hash)] committed, [file path] failed).
+    """
+    plan = ingest_plan.get_plan(config_file, account_name)
+    cursor = conn.cursor()
+    known_hashes = set()
+    counts = ingest.new_row_counts()
+    written, failed = [], []
+    recovered = set()
+    # Content hashes seen in this batch, whose COMMITTED records are this transaction's own
+    batch_hashes = set()
+    started = int(time.time())
+    writing = None
+    try:
+        journal.create_journal_table(cursor)
+        for _, file_path, size, result in items:
+            if isinstance(result, Exception):
+                print(f"Error preparing file '{file_path}': {result}")
+                metrics.event('file_failed', account=account_name, file=file_path, stage='prepare', error=str(result))
+                failed.append(file_path)
+                progress.file_done(size)
+                continue
+            file_hash, bulk_rows = result
+            if file_hash not in batch_hashes and journal.is_committed(cursor, file_hash, account_name):
+                print(f"File '{file_path}' was committed by an earlier run, only moving it")
+                batch_hashes.add(file_hash)
+                recovered.add(file_path)
+                written.append((file_path, file_hash))
+                progress.file_done(size)
+                continue
+            batch_hashes.add(file_hash)
+            writing = (file_path, file_hash)
+            ingest.create_account_table(cursor, account_name, bulk_rows['columns'], plan.column_types)
+            schema.migrate_account(cursor, account_name, plan.config)
+            file_counts = ingest.write_bulk_rows(cursor, account_name, bulk_rows, plan, known_hashes)
+            for outcome, rows in file_counts.items():
+                counts[outcome] += rows
+            file_rows = sum(file_counts.values())
+            journal.record(cursor, file_hash, account_name, file_path, journal.COMMITTED, file_rows)
+            written.append(writing)
+            writing = None
+            progress.file_done(size, file_rows)
+        ingest.refresh_materialized(cursor, account_name, started)
+        metrics.timed_commit(conn, account=account_name)
+    except Exception as e:
+        conn.rollback()
+        # Drain the rest of the account so the next one starts at its own files
+        remaining = [item[1] for item in items]
+        print(f"Error writing account '{account_name}', rolled back {len(written)} file(s): {e}")
+        metrics.event('file_failed', account=account_name, stage='write', error=str(e))
+        # Files committed by an earlier run are still committed and are moved as usual
+        kept = [(file_path, file_hash) for file_path, file_hash in written if file_path in recovered]
+        rolled_back = [item for item in written if item[0] not in recovered] + ([writing] if writing else [])
+        for file_path, file_hash in rolled_back:
+            journal.record(cursor, file_hash, account_name, file_path, journal.FAILED)
+        conn.commit()
+        return kept, failed + [file_path for file_path, _ in rolled_back] + remaining
+    ingest.record_row_counts(account_name, counts)
+    print(f"Committed {len(written)} file(s) for account '{account_name}': {counts}")
+    return written, failed
+
+def write_streamed_account(conn, account_name, items, config_file, progress):
+    """Write one stream account's files one at a time through ingest's streamed path.
+
+    Each file commits chunk by chunk, so a failure only fails that file. Returns the
+    same ([(file path, content hash)] committed, [file path] failed) as write_account.
+    """
+    written, failed = [], []
+    batch_hashes = set()
+    for _, file_path, size, _ in items:
+        try:
+            prepared = ingest.prepare_file(account_name, file_path, config_file)
+            file_hash = prepared['file_hash']
+        except Exception as e:
+            print(f"Error preparing file '{file_path}': {e}")
+            metrics.event('file_failed', account=account_name, file=file_path, stage='prepare', error=str(e))
+            failed.append(file_path)
+            progress.file_done(size)
+            continue
+        if file_hash not in batch_hashes and journal.is_committed(conn.cursor(), file_hash, account_name):
+            print(f"File '{file_path}' was committed by an earlier run, only moving it")
+            batch_hashes.add(file_hash)
+            written.append((file_path, file_hash))
+            progress.file_done(size)
+            continue
+        batch_hashes.add(file_hash)
+        try:
+            rows = ingest.ingest_prepared_file(conn, prepared)
+        except Exception as e:
+            print(f"Error writing file '{file_path}': {e}")
+            metrics.event('file_failed', account=account_name, file=file_path, stage='write', error=str(e))
+            db.with_retry(journal.record_now, conn, file_hash, account_name, file_path, journal.FAILED)
+            failed.append(file_path)
+            progress.file_done(size)
+            continue
+        written.append((file_path, file_hash))
+        progress.file_done(size, rows)
+    print(f"Committed {len(written)} file(s) for account '{account_name}'")
+    return written, failed
+
+def backfill(root, db_file=DB_FILE, config_file=CONFIG_FILE, workers=BACKFILL_WORKERS, completed_path=COMPLETED_PATH,
+             move=True):
+    """Ingest every .csv under root/<account>/ and move committed files to completed_path. Returns the failed files."""
+    # Reject a malformed config before any worker starts
+    ingest_plan.load_plans(config_file)
+    files = find_files(root)
+    print(f"Backfilling {len(files)} file(s) from '{root}' with {workers} worker(s)")
+    progress = Progress(files)
+    failed = []
+    # Spawned rather than forked, so workers never inherit open SQLite connections
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    with pool, db.get_database(db_file).writer() as conn:
+        results = prepared_in_order(pool, files, config_file, workers * 2)
+        for account_name, items in itertools.groupby(results, key=lambda item: item[0]):
+            with metrics.stage('backfill_account', account=account_name):
+                write = write_streamed_account if is_stream_account(account_name, config_file) else write_account
+                written, account_failed = write(conn, account_name, items, config_file, progress)
+            failed.extend(account_failed)
+            for file_path, file_hash in written:
+                metrics.count('files_total', outcome='committed')
+                if not move:
+                    continue
+                try:
+                    completed_file = ingest.move_to_completed(account_name, file_path, completed_path)
+                except OSError as e:
+                    # Journaled as committed, so the next run only moves it
+                    print(f"Error moving file '{file_path}' to completed: {e}")
+                    metrics.event('file_failed', account=account_name, file=file_path, stage='move', error=str(e))
+                    continue
+                journal.record(conn.cursor(), file_hash, account_name, completed_file, journal.MOVED)
+                print(f"File '{file_path}' moved to '{completed_file}'")
+            conn.commit()
+    metrics.count('files_total', len(failed), outcome='failed')
+    print(f"Backfill finished: {len(files) - len(failed)} file(s) committed, {len(failed)} failed")
+    for file_path in failed:
+        print(f"  failed: {file_path}")
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest a tree of historical statements laid out as <root>/<account>/**/*.csv in parallel.")
+    parser.add_argument('root', type=str, help="Directory with one folder per account.")
+    parser.add_argument('--db', type=str, default=DB_FILE, help="Path to the SQLite database.")
+    parser.add_argument('--config', type=str, default=CONFIG_FILE, help="Path to the YAML configuration file.")
+    parser.add_argument('--workers', type=int, default=BACKFILL_WORKERS, help="Worker processes parsing and hashing files.")
+    parser.add_argument('--completed', type=str, default=COMPLETED_PATH, help="Folder committed files are moved into.")
+    parser.add_argument('--no-move', action='store_true', help="Leave committed files where they are.")
+    parser.add_argument('--metrics-file', type=str, help="Write the ingest metrics here in Prometheus text format.")
+    args = parser.parse_args()
+    failed = backfill(args.root, args.db, args.config, args.workers, args.completed, not args.no_move)
+    if args.metrics_file:
+        metrics.write_file(args.metrics_file)
+    db.close_all()
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
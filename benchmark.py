@@ -0,0 +1,480 @@
+import os
+import sys
+import csv
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import platform
+import resource
+import statistics
+import subprocess
+import tempfile
+import zlib
+import numpy as np
+import pandas as pd
+import yaml
+import categorize
+import dates
+import db
+import ingest
+import merchant
+import reconcile
+
+CONFIG_FILE = 'config.yaml'
+VIEWS_FILE = 'views.sql'
+# Generated CSVs are kept here and reused across runs with the same rows and seed
+DATA_DIR = 'bench_data'
+RESULTS_DIR = 'bench_results'
+ROW_COUNTS = [10000, 100000, 1000000]
+SEED = 20240101
+# Merchants classified in the categorizer throughput measure, the merchant table repeated as needed
+CLASSIFY_SAMPLES = 100000
+# Generated transactions are spread over two years starting here (Eastern Time)
+START_DATE = '2023-01-01'
+SPAN_DAYS = 730
+# Share of rows repeating an earlier row, so duplicate tagging is exercised
+DUPLICATE_RATE = 0.01
+MERCHANT_POOL_SIZE = 2000
+QUERY_REPEATS = 5
+
+# Column layouts of the exports each account in config.yaml is configured for, as (column, kind).
+# Kinds are generated by generate_column; DATETIME columns use the account's date_format if it has one.
+ACCOUNT_LAYOUTS = {
+    'venmo': [('', 'blank'), ('ID', 'id'), ('Datetime', 'iso_datetime'), ('Type', 'venmo_type'),
+              ('Status', 'status'), ('Note', 'note'), ('From', 'person'), ('To', 'person'),
+              ('Amount (total)', 'venmo_amount'), ('Amount (tip)', 'blank'), ('Amount (tax)', 'blank'),
+              ('Amount (fee)', 'blank'), ('Tax Rate', 'blank'), ('Tax Exempt', 'blank'),
+              ('Funding Source', 'funding'), ('Destination', 'funding'), ('Beginning Balance', 'blank'),
+              ('Ending Balance', 'blank'), ('Statement Period Venmo Fees', 'blank'),
+              ('Terminal Location', 'venmo_terminal'), ('Year to Date Venmo Fees', 'blank'), ('Disclaimer', 'blank')],
+    'amexcc': [('Date', 'date'), ('Description', 'merchant'), ('Card Member', 'card_member'),
+               ('Account #', 'account_number'), ('Amount', 'amount'), ('Extended Details', 'note'),
+               ('Category', 'category')],
+    'amexsv': [('Date', 'date'), ('Type', 'savings_type'), ('Amount', 'signed_amount')],
+    'paypal': [('Date', 'date'), ('Time', 'time'), ('TimeZone', 'timezone'), ('Name', 'merchant'),
+               ('Type', 'paypal_type'), ('Status', 'status'), ('Currency', 'currency'), ('Amount', 'signed_amount'),
+               ('Receipt ID', 'blank'), ('Balance', 'balance')],
+    'chasecc': [('Transaction Date', 'date'), ('Post Date', 'date'), ('Description', 'merchant'),
+                ('Category', 'category'), ('Type', 'chase_type'), ('Amount', 'signed_amount'), ('Memo', 'blank')],
+    'citicc': [('Status', 'cleared'), ('Date', 'date'), ('Description', 'merchant'), ('Debit', 'debit'),
+               ('Credit', 'credit')],
+    'psecucc': [('Date', 'date'), ('Transaction Description', 'merchant'), ('Principal', 'amount'),
+                ('Interest', 'small_amount'), ('Fees', 'fee'), ('Balance', 'balance'), ('Category', 'category'),
+                ('Note', 'blank')],
+    'psecuch': [('Date', 'date'), ('Transaction Description', 'merchant'), ('Amount', 'signed_amount'),
+                ('Check/Misc. ', 'blank'), ('Balance', 'balance'), ('Category', 'category'), ('Note', 'blank')],
+    'psecudr': [('Date', 'date'), ('Transaction Description', 'merchant'), ('Amount', 'signed_amount'),
+                ('Check/Misc. ', 'blank'), ('Balance', 'balance'), ('Category', 'category'), ('Note', 'blank')],
+    'psecuxd': [('Date', 'date'), ('Transaction Description', 'merchant'), ('Amount', 'signed_amount'),
+                ('Check/Misc. ', 'blank'), ('Balance', 'balance'), ('Category', 'category'), ('Note', 'blank')],
+    'psecupe': [('Date', 'date'), ('Transaction Description', 'merchant'), ('Amount', 'signed_amount'),
+                ('Check/Misc. ', 'blank'), ('Balance', 'balance'), ('Category', 'category'), ('Note', 'blank')],
+    'chasemo': [('Date', 'date'), ('Description', 'merchant'), ('Amount', 'signed_amount'), ('Unapplied', 'zero'),
+                ('Balance', 'balance')],
+    'mint': [('Date', 'date'), ('Description', 'merchant_clean'), ('Original Description', 'merchant'),
+             ('Amount', 'amount'), ('Transaction Type', 'debit_credit'), ('Category', 'category'),
+             ('Account Name', 'mint_account'), ('Labels', 'blank'), ('Notes', 'blank')],
+    'amazon_digital': [('ASIN', 'asin'), ('ProductName', 'product'), ('OrderId', 'order_id'),
+                       ('OrderDate', 'iso_datetime'), ('FulfilledDate', 'iso_datetime'), ('OurPrice', 'amount'),
+                       ('ListPriceAmount', 'amount'), ('ListPriceTaxAmount', 'small_amount'),
+                       ('OriginalQuantity', 'quantity'), ('QuantityOrdered', 'quantity'), ('GiftMessage', 'blank')],
+    'amazon': [('Order ID', 'order_id'), ('Order Date', 'iso_datetime'), ('Purchase Order Number', 'blank'),
+               ('Product Name', 'product'), ('Unit Price', 'amount'), ('Unit Price Tax', 'small_amount'),
+               ('Shipping Charge', 'zero'), ('Total Discounts', 'zero'), ('Total Owed', 'amount'),
+               ('Shipment Item Subtotal', 'amount'), ('Shipment Item Subtotal Tax', 'small_amount'),
+               ('Quantity', 'quantity'), ('Ship Date', 'iso_datetime')],
+}
+DEFAULT_DATE_FORMATS = {
+    'date': '%m/%d/%Y',
+    'time': '%H:%M:%S',
+    'iso_datetime': '%Y-%m-%dT%H:%M:%S',
+}
+CHOICES = {
+    'category': ['Restaurant-Restaurant', 'Merchandise & Supplies-Groceries', 'Travel-Airline',
+                 'Transportation-Fuel', 'Entertainment', 'Business Services', 'AMAZON', ''],
+    'venmo_type': ['Payment', 'Charge', 'Standard Transfer'],
+    'status': ['Complete', 'Completed', 'Issued'],
+    'funding': ['Venmo balance', 'Visa Debit *1234', ''],
+    'venmo_terminal': ['Venmo', 'Mobile'],
+    'savings_type': ['Deposit', 'Withdrawal', 'Interest Payment'],
+    'paypal_type': ['General Payment', 'Express Checkout Payment', 'General Authorization', 'Bank Deposit to PP Account'],
+    'timezone': ['EST', 'EDT'],
+    'currency': ['USD'],
+    'chase_type': ['Sale', 'Return', 'Payment'],
+    'cleared': ['Cleared'],
+    'debit_credit': ['debit', 'debit', 'debit', 'credit'],
+    'mint_account': ['CREDIT CARD', 'Checking', 'Blue Cash Everyday'],
+    'card_member': ['J DOE', 'A DOE'],
+    'account_number': ['-11001', '-21002'],
+}
+MERCHANT_WORDS = ['STARBUCKS', 'UBER', 'TRIP', 'AMAZON', 'MKTPLACE', 'SHELL', 'OIL', 'WHOLEFDS', 'MARKET', 'TARGET',
+                  'COSTCO', 'WHSE', 'NETFLIX', 'COM', 'SPOTIFY', 'USA', 'DELTA', 'AIR', 'BLUE', 'BOTTLE', 'COFFEE',
+                  'PIZZA', 'JOES', 'HOME', 'DEPOT', 'CVS', 'PHARMACY', 'TRADER', 'STORE', 'GRILL', 'BAR', 'KITCHEN']
+CITIES = ['NEW YORK NY', 'PHILADELPHIA PA', 'SEATTLE WA', 'AUSTIN TX', 'BOSTON MA', '']
+PREFIXES = ['', '', '', 'AplPay ', 'SQ *', 'TST* ']
+
+# Query latency is measured for these, on the views the dashboards read
+QUERIES = {
+    'all_transactions_count': ("SELECT COUNT(*) FROM all_transactions", {}),
+    'all_transactions_first_page': ("SELECT * FROM all_transactions LIMIT 100", {}),
+    'all_transactions_month': (
+        "SELECT * FROM all_transactions WHERE tx_date BETWEEN :start AND :end",
+        {'start': '2023-06-01', 'end': '2023-06-30'},
+    ),
+    'category_totals': ("SELECT tx_category, SUM(tx_amount) FROM all_transactions GROUP BY tx_category", {}),
+    'merchant_totals': ("SELECT merchant_key, COUNT(*), SUM(tx_amount) FROM all_transactions GROUP BY merchant_key", {}),
+    'amexcc_view_count': ("SELECT COUNT(*) FROM amexcc_view", {}),
+}
+
+def merchant_pool(rng, size=MERCHANT_POOL_SIZE):
+    """Build the merchant names every account draws from, with the store-number and prefix noise real exports have."""
+    names = []
+    for _ in range(size):
+        words = rng.choice(MERCHANT_WORDS, size=rng.integers(1, 4), replace=False)
+        name = ' '.join(words)
+        if rng.random() < 0.4:
+            name += f" #{rng.integers(1, 99999)}"
+        name = rng.choice(PREFIXES) + name
+        city = rng.choice(CITIES)
+        if city:
+            name += ('  ' if rng.random() < 0.1 else ' ') + city
+        names.append(name)
+    return np.array(names, dtype=object)
+
+def format_money(values):
+    """Format amounts with two decimals."""
+    return pd.Series(values).map('{:.2f}'.format).to_numpy(dtype=object)
+
+def generate_column(kind, rows, rng, pool, timestamps, date_format):
+    """Generate one column of a kind, deterministically for a given generator state."""
+    if kind == 'blank':
+        return np.full(rows, '', dtype=object)
+    if kind == 'zero':
+        return np.full(rows, '0.00', dtype=object)
+    if kind in ('date', 'time', 'iso_datetime'):
+        return timestamps.strftime(date_format).to_numpy(dtype=object)
+    if kind == 'merchant':
+        return pool[rng.integers(0, len(pool), rows)]
+    if kind == 'merchant_clean':
+        return np.char.title(pool[rng.integers(0, len(pool), rows)].astype(str)).astype(object)
+    if kind == 'product':
+        return np.array([f"Product {i} - Item" for i in rng.integers(0, MERCHANT_POOL_SIZE * 5, rows)], dtype=object)
+    if kind == 'amount':
+        return format_money(rng.gamma(2.0, 30.0, rows))
+    if kind == 'small_amount':
+        return format_money(rng.gamma(1.0, 2.0, rows))
+    if kind == 'fee':
+        return format_money(np.where(rng.random(rows) < 0.05, 35.0, 0.0))
+    if kind == 'signed_amount':
+        return format_money(rng.gamma(2.0, 30.0, rows) * np.where(rng.random(rows) < 0.85, -1, 1))
+    if kind == 'venmo_amount':
+        amounts = rng.gamma(2.0, 20.0, rows)
+        signs = np.where(rng.random(rows) < 0.5, '- $', '+ $')
+        return np.array([f"{sign}{amount:.2f}" for sign, amount in zip(signs, amounts)], dtype=object)
+    if kind == 'debit':
+        debit = rng.gamma(2.0, 30.0, rows)
+        return np.where(rng.random(rows) < 0.9, format_money(debit), '')
+    if kind == 'credit':
+        return np.where(rng.random(rows) < 0.1, format_money(rng.gamma(2.0, 30.0, rows)), '')
+    if kind == 'balance':
+        return format_money(5000 + np.cumsum(rng.normal(0, 50, rows)))
+    if kind == 'quantity':
+        return rng.integers(1, 4, rows).astype(str).astype(object)
+    if kind == 'id':
+        return (rng.integers(10**18, 10**19 - 1, rows, dtype=np.uint64)).astype(str).astype(object)
+    if kind == 'order_id':
+        return np.array([f"{a:03d}-{b:07d}-{c:07d}" for a, b, c in zip(
+            rng.integers(100, 999, rows), rng.integers(0, 10**7, rows), rng.integers(0, 10**7, rows))], dtype=object)
+    if kind == 'asin':
+        return np.array([f"B0{i:08d}" for i in rng.integers(0, 10**8, rows)], dtype=object)
+    if kind == 'person':
+        return np.array([f"Friend {i}" for i in rng.integers(0, 300, rows)], dtype=object)
+    if kind == 'note':
+        return np.array([f"note {i}" for i in rng.integers(0, 1000, rows)], dtype=object)
+    if kind in CHOICES:
+        return np.array(CHOICES[kind], dtype=object)[rng.integers(0, len(CHOICES[kind]), rows)]
+    raise ValueError(f"Unknown column kind '{kind}'")
+
+def generate_frame(account_name, config, rows, seed=SEED):
+    """Generate the data rows of an account export as strings, the same for the same rows and seed."""
+    # Seeded per account so a subset of accounts generates the same files as a full run
+    rng = np.random.default_rng([seed, zlib.crc32(account_name.encode())])
+    pool = merchant_pool(np.random.default_rng(seed))
+    start = pd.Timestamp(START_DATE)
+    seconds = np.sort(rng.integers(0, SPAN_DAYS * 86400, rows))
+    timestamps = pd.DatetimeIndex(start + pd.to_timedelta(seconds, unit='s'))
+    date_format = config.get('date_format')
+
+    data = {}
+    for column, kind in ACCOUNT_LAYOUTS[account_name]:
+        fmt = (kind == 'date' and dates.column_format(date_format, column)) or DEFAULT_DATE_FORMATS.get(kind)
+        data[column] = generate_column(kind, rows, rng, pool, timestamps, fmt)
+    frame = pd.DataFrame(data, columns=[column for column, _ in ACCOUNT_LAYOUTS[account_name]])
+
+    # Repeat a few earlier rows, as overlapping statement exports do
+    duplicates = int(rows * DUPLICATE_RATE)
+    if duplicates and rows > 1:
+        targets = rng.choice(np.arange(1, rows), size=duplicates, replace=False)
+        sources = (targets * rng.random(duplicates)).astype(int)
+        frame.iloc[targets] = frame.iloc[sources].to_numpy()
+    return frame
+
+def write_export(frame, config, csv_file):
+    """Write a generated frame the way the account exports it: explicit headers, or a header_row with preamble lines."""
+    with open(csv_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        if not config.get('headers'):
+            width = len(frame.columns)
+            for line in range(config.get('header_row', 1) - 1):
+                writer.writerow([f"Account Statement line {line + 1}"] + [''] * (width - 1))
+            writer.writerow(frame.columns)
+        writer.writerows(frame.itertuples(index=False, name=None))
+
+def generate_exports(config, rows, data_dir=DATA_DIR, seed=SEED, accounts=None):
+    """Generate (or reuse) one export per account layout, returning {account_name: csv_file}."""
+    os.makedirs(data_dir, exist_ok=True)
+    files = {}
+    for account_name in accounts or ACCOUNT_LAYOUTS:
+        account_config = config.get(account_name) or {}
+        csv_file = os.path.join(data_dir, f"{account_name}_{rows}_{seed}.csv")
+        if not os.path.exists(csv_file):
+            partial_file = csv_file + '.partial'
+            write_export(generate_frame(account_name, account_config, rows, seed), account_config, partial_file)
+            os.replace(partial_file, csv_file)
+        files[account_name] = csv_file
+    return files
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MiB.
+
+    ru_maxrss never goes down, so readings taken part way through a run are stored as
+    peak_rss_mb_so_far: each includes everything that ran before it, not just its own step.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def load_views(conn, views_file=VIEWS_FILE):
+    """Create the views in a fresh database, where views.sql's unconditional DROP VIEWs would fail."""
+    with open(views_file, 'r') as f:
+        script = f.read().replace('DROP VIEW IF EXISTS ', 'DROP VIEW ').replace('DROP VIEW ', 'DROP VIEW IF EXISTS ')
+    conn.executescript(script)
+
+def time_query(conn, sql, params, repeats=QUERY_REPEATS):
+    """Run a query repeatedly, returning its row count and latency statistics in milliseconds."""
+    timings = []
+    rows = 0
+    for _ in range(repeats):
+        started = time.perf_counter()
+        rows = len(conn.execute(sql, params).fetchall())
+        timings.append((time.perf_counter() - started) * 1000)
+    return {'rows': rows, 'min_ms': round(min(timings), 2), 'median_ms': round(statistics.median(timings), 2)}
+
+def run_benchmark(rows, config_file=CONFIG_FILE, data_dir=DATA_DIR, seed=SEED, ingest_mode=None, accounts=None):
+    """Ingest generated exports into a fresh database, refresh merchants and time the main views."""
+    with open(config_file, 'r') as f:
+        config = yaml.safe_load(f)
+    if ingest_mode:
+        for account_config in config.values():
+            account_config['ingest_mode'] = ingest_mode
+
+    files = generate_exports(config, rows, data_dir, seed, accounts)
+    work_dir = tempfile.mkdtemp(prefix='findb-bench-')
+    try:
+        bench_config = os.path.join(work_dir, 'config.yaml')
+        with open(bench_config, 'w') as f:
+            yaml.safe_dump(config, f)
+        db_file = os.path.join(work_dir, 'financials.db')
+
+        results = {'rows': rows, 'ingest': {}, 'queries': {}}
+        total_rows = 0
+        total_seconds = 0.0
+        for account_name, csv_file in files.items():
+            started = time.perf_counter()
+            ingest.insert_csv_to_db(account_name, csv_file, bench_config, db_file)
+            seconds = time.perf_counter() - started
+            total_rows += rows
+            total_seconds += seconds
+            results['ingest'][account_name] = {
+                'mode': config.get(account_name, {}).get('ingest_mode', 'row'),
+                'seconds': round(seconds, 3),
+                'rows_per_sec': round(rows / seconds, 1),
+                'peak_rss_mb_so_far': peak_rss_mb(),
+            }
+        results['ingest_total'] = {
+            'rows': total_rows,
+            'seconds': round(total_seconds, 3),
+            'rows_per_sec': round(total_rows / total_seconds, 1) if total_seconds else None,
+            'peak_rss_mb_so_far': peak_rss_mb(),
+        }
+
+        database = db.get_database(db_file)
+        with database.writer() as conn:
+            load_views(conn)
+            # Accounts left out of the run still need their tables for the unioned views
+            for account_name in ACCOUNT_LAYOUTS:
+                if account_name not in files:
+                    columns = [column for column, _ in ACCOUNT_LAYOUTS[account_name] if column]
+                    ingest.create_account_table(conn.cursor(), account_name, columns,
+                                                (config.get(account_name) or {}).get('column_types', {}))
+            conn.commit()
+            started = time.perf_counter()
+            links = reconcile.reconcile(conn, full=True)
+            results['reconcile'] = {'seconds': round(time.perf_counter() - started, 3), 'links': links}
+            started = time.perf_counter()
+            merchants = merchant.refresh_merchants(conn, full=True, config_file=bench_config)
+            results['merchant_refresh'] = {
+                'seconds': round(time.perf_counter() - started, 3),
+                'merchants': len(merchants),
+                'peak_rss_mb_so_far': peak_rss_mb(),
+            }
+            results['categorize'] = benchmark_categorize(conn)
+
+        with database.reader() as conn:
+            for name, (sql, params) in QUERIES.items():
+                results['queries'][name] = time_query(conn, sql, params)
+        results['peak_rss_mb'] = peak_rss_mb()
+        return results
+    finally:
+        db.close_all()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def benchmark_categorize(conn):
+    """Time categorize.py on the refreshed merchants, half of them given a category to train on.
+
+    The generated merchants carry no categories, so every other one is labelled with its
+    first source category, as if the LLM had answered for it.
+    """
+    conn.execute("""
+        UPDATE merchant SET gpt_category = substr(tx_category, 1, instr(tx_category || ',', ',') - 1)
+        WHERE tx_category IS NOT NULL AND rowid % 2 = 0
+    """)
+    labelled = conn.execute("SELECT changes()").fetchone()[0]
+    conn.commit()
+    started = time.perf_counter()
+    categorized = categorize.categorize(conn, full=True, rules_file=None)
+    seconds = time.perf_counter() - started
+
+    # Classification alone, without the database round trip
+    cursor = conn.cursor()
+    model = categorize.train_model(cursor)
+    merchants = conn.execute("SELECT merchant_id, tx_category FROM merchant").fetchall()
+    samples = (merchants * (CLASSIFY_SAMPLES // max(len(merchants), 1) + 1))[:CLASSIFY_SAMPLES]
+    classify_started = time.perf_counter()
+    categorize.classify(samples, categorize.RuleTrie(), model)
+    classify_seconds = time.perf_counter() - classify_started
+    return {
+        'seconds': round(seconds, 3),
+        'labelled': labelled,
+        'merchants': len(categorized),
+        'left_for_llm': sum(confidence < categorize.CONFIDENCE_THRESHOLD for _, confidence, _ in categorized.values()),
+        'classify_per_sec': round(len(samples) / classify_seconds, 1) if samples else None,
+    }
+
+def environment():
+    """Describe what a run was measured on, so results are only compared like for like."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'commit': commit or None,
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+def compare(results, baseline):
+    """Print how a run's throughput and latencies moved against a baseline run."""
+    baseline_runs = {run['rows']: run for run in baseline.get('runs', [])}
+    for run in results['runs']:
+        base = baseline_runs.get(run['rows'])
+        if not base:
+            continue
+        print(f"{run['rows']} rows vs baseline {baseline.get('environment', {}).get('commit')}:")
+        for account_name, stats in run['ingest'].items():
+            before = base['ingest'].get(account_name)
+            if before:
+                change = stats['rows_per_sec'] / before['rows_per_sec'] - 1
+                print(f"  ingest {account_name:16} {stats['rows_per_sec']:>12,.0f} rows/s ({change:+.1%})")
+        categorized, before = run.get('categorize'), base.get('categorize')
+        if categorized and before and categorized['classify_per_sec'] and before['classify_per_sec']:
+            change = categorized['classify_per_sec'] / before['classify_per_sec'] - 1
+            print(f"  categorize {'classify':20} {categorized['classify_per_sec']:>12,.0f} merchants/s ({change:+.1%})")
+        for name, stats in run['queries'].items():
+            before = base['queries'].get(name)
+            if before and before['median_ms']:
+                change = stats['median_ms'] / before['median_ms'] - 1
+                print(f"  query  {name:28} {stats['median_ms']:>10.2f} ms ({change:+.1%})")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ingest, the merchant refresh, categorization and view queries on generated exports.")
+    parser.add_argument('--rows', type=int, nargs='+', default=ROW_COUNTS, help="Rows per account export, one run each.")
+    parser.add_argument('--accounts', nargs='+', choices=sorted(ACCOUNT_LAYOUTS), default=None,
+                        help="Only ingest these accounts (the others get empty tables).")
+    parser.add_argument('--mode', choices=ingest.INGEST_MODES, default=None,
+                        help="Override every account's ingest_mode.")
+    parser.add_argument('--config', type=str, default=CONFIG_FILE, help="Path to the YAML configuration file.")
+    parser.add_argument('--data-dir', type=str, default=DATA_DIR, help="Where generated exports are kept.")
+    parser.add_argument('--seed', type=int, default=SEED, help="Seed of the data generator.")
+    parser.add_argument('--output', type=str, default=None, help="Results file, by default under bench_results/.")
+    parser.add_argument('--compare', type=str, default=None, help="Results file of an earlier run to compare against.")
+    parser.add_argument('--single-run', type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single_run:
+        # Child process for one row count, so peak RSS isn't carried over from a previous run
+        results = run_benchmark(args.rows[0], args.config, args.data_dir, args.seed, args.mode, args.accounts)
+        with open(args.single_run, 'w') as f:
+            json.dump(results, f)
+        return
+
+    runs = []
+    for rows in args.rows:
+        print(f"Benchmarking {rows} rows per account...")
+        with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+            run_file = f.name
+        command = [sys.executable, os.path.abspath(__file__), '--rows', str(rows), '--config', args.config,
+                   '--data-dir', args.data_dir, '--seed', str(args.seed), '--single-run', run_file]
+        if args.mode:
+            command += ['--mode', args.mode]
+        if args.accounts:
+            command += ['--accounts'] + args.accounts
+        try:
+            subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+            with open(run_file, 'r') as f:
+                run = json.load(f)
+        finally:
+            os.remove(run_file)
+        total = run['ingest_total']
+        print(f"  ingest {total['rows']} rows at {total['rows_per_sec']:,.0f} rows/s, "
+              f"reconcile {run['reconcile']['seconds']}s ({run['reconcile']['links']} links), "
+              f"merchant refresh {run['merchant_refresh']['seconds']}s, "
+              f"categorize {run['categorize']['merchants']} merchants in {run['categorize']['seconds']}s "
+              f"({run['categorize']['classify_per_sec'] or 0:,.0f} merchants/s classified), peak RSS {run['peak_rss_mb']} MiB")
+        runs.append(run)
+
+    results = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': environment(),
+        'seed': args.seed,
+        'mode': args.mode,
+        'runs': runs,
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f"bench_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(results, json.load(f))
+
+if __name__ == "__main__":
+    main()
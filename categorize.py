@@ -0,0 +1,251 @@
+import os
+import logging
+import argparse
+import yaml
+import numpy as np
+import db
+import merchant
+import metrics
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Database file path
+DB_FILE = 'financials.db'
+# Optional hand-written rules, {'exact': {merchant: category}, 'prefix': {merchant prefix: category}}
+RULES_FILE = 'category_rules.yaml'
+
+# Merchants categorized locally with at least this confidence are not sent to merchant_meta.py, and their
+# category is shown while the LLM has none (materialize.TX_CATEGORY and views.sql repeat the value)
+CONFIDENCE_THRESHOLD = 0.8
+# Additive smoothing of the token counts
+SMOOTHING = 0.5
+
+# A local first pass over the merchant table. The rules of RULES_FILE are matched token by token
+# against the merchant key, an exact rule on the whole key winning over the longest prefix rule.
+# Merchants no rule covers are scored by a multinomial naive Bayes model over their name tokens
+# and source categories, trained on the merchants that already have a manual or LLM category.
+# The result is stored on the merchant in auto_category, auto_confidence and auto_source, and
+# only merchants below CONFIDENCE_THRESHOLD are left for the LLM.
+
+# Prefix of the source category features, which alone never make a confident prediction
+SOURCE_PREFIX = 'src:'
+
+# Trie node keys for the rules ending at a node; tokens are always strings
+EXACT = 0
+PREFIX = 1
+
+class RuleTrie:
+    """Exact and prefix category rules over the tokens of normalized merchant names."""
+
+    def __init__(self):
+        self.root = {}
+        self.size = 0
+
+    def add(self, name, category, prefix=False):
+        node = self.root
+        for token in normalize(name).split():
+            node = node.setdefault(token, {})
+        node[PREFIX if prefix else EXACT] = category
+        self.size += 1
+
+    def match(self, name):
+        """Return the category of the exact rule for name, else of its longest prefix rule, else None."""
+        node = self.root
+        best = None
+        for token in name.split():
+            node = node.get(token)
+            if node is None:
+                return best
+            best = node.get(PREFIX, best)
+        return node.get(EXACT, best)
+
+class TokenModel:
+    """Multinomial naive Bayes over merchant features, with log probabilities in dense numpy arrays."""
+
+    def __init__(self, categories, vocabulary, log_prior, log_likelihood):
+        self.categories = categories
+        self.vocabulary = vocabulary
+        self.log_prior = log_prior
+        # One row per vocabulary token plus a trailing zero row that unknown tokens map to
+        self.log_likelihood = np.vstack([log_likelihood, np.zeros((1, len(categories)))])
+
+    @classmethod
+    def train(cls, examples, smoothing=SMOOTHING):
+        """Fit the model on (features, category) pairs. Returns None without examples."""
+        if not examples:
+            return None
+        categories = sorted({category for _, category in examples})
+        category_ids = {category: i for i, category in enumerate(categories)}
+        vocabulary = {}
+        token_ids, label_ids = [], []
+        for features, category in examples:
+            for feature in features:
+                token_ids.append(vocabulary.setdefault(feature, len(vocabulary)))
+                label_ids.append(category_ids[category])
+        counts = np.zeros((len(vocabulary), len(categories)))
+        np.add.at(counts, (token_ids, label_ids), 1)
+        counts += smoothing
+        log_likelihood = np.log(counts) - np.log(counts.sum(axis=0))
+        priors = np.bincount([category_ids[category] for _, category in examples], minlength=len(categories))
+        log_prior = np.log(priors) - np.log(priors.sum())
+        return cls(categories, vocabulary, log_prior, log_likelihood)
+
+    def predict(self, feature_lists):
+        """Return (category, confidence) per feature list, confidence being the posterior of the category.
+
+        The confidence is 0 when the model has a single category, or when none of the
+        name tokens is in the vocabulary, as the posterior is then only the prior.
+        """
+        if not feature_lists:
+            return []
+        unknown = len(self.vocabulary)
+        # Every merchant gets the zero row, so no segment is empty
+        ids, starts, known_names = [], [], []
+        for features in feature_lists:
+            starts.append(len(ids))
+            ids.append(unknown)
+            ids.extend(self.vocabulary.get(feature, unknown) for feature in features)
+            known_names.append(any(not feature.startswith(SOURCE_PREFIX) and feature in self.vocabulary
+                                   for feature in features))
+        scores = np.add.reduceat(self.log_likelihood[ids], starts, axis=0) + self.log_prior
+        scores -= scores.max(axis=1, keepdims=True)
+        posteriors = np.exp(scores)
+        posteriors /= posteriors.sum(axis=1, keepdims=True)
+        best = posteriors.argmax(axis=1)
+        confidences = posteriors[np.arange(len(best)), best]
+        if len(self.categories) < 2:
+            confidences[:] = 0.0
+        else:
+            confidences[~np.asarray(known_names)] = 0.0
+        return [(self.categories[i], float(p)) for i, p in zip(best, confidences)]
+
+def normalize(name):
+    """Match the canonical merchant key format: upper case with single spaces."""
+    return ' '.join(name.upper().split())
+
+def features(merchant_id, tx_category):
+    """Model features of a merchant: its name tokens and the source categories its transactions carried."""
+    tokens = merchant_id.split()
+    tokens.extend(SOURCE_PREFIX + category for category in (tx_category or '').split(',') if category)
+    return tokens
+
+def load_rules(rules_file=RULES_FILE):
+    """Return a RuleTrie with the rules of rules_file, empty if the file does not exist."""
+    rules = RuleTrie()
+    if not rules_file or not os.path.exists(rules_file):
+        return rules
+    with open(rules_file, 'r') as f:
+        try:
+            config = yaml.safe_load(f) or {}
+        except yaml.YAMLError as e:
+            raise ValueError(f"Invalid rules in '{rules_file}': {e}") from e
+    if not isinstance(config, dict) or set(config) - {'exact', 'prefix'}:
+        raise ValueError(f"'{rules_file}' must be a mapping with 'exact' and 'prefix' sections")
+    for section in ('exact', 'prefix'):
+        entries = config.get(section) or {}
+        if not isinstance(entries, dict) or not all(isinstance(v, str) and v for v in entries.values()):
+            raise ValueError(f"'{section}' in '{rules_file}' must map merchant names to categories")
+        for name, category in entries.items():
+            rules.add(str(name), category, prefix=section == 'prefix')
+    return rules
+
+def train_model(cursor):
+    """Train the model on merchants with a manual category, or the LLM's when there is none."""
+    cursor.execute("""
+        SELECT merchant_id, tx_category, COALESCE(NULLIF(category, ''), NULLIF(gpt_category, ''))
+        FROM merchant
+        WHERE COALESCE(NULLIF(category, ''), NULLIF(gpt_category, '')) IS NOT NULL
+    """)
+    return TokenModel.train([(features(merchant_id, tx_category), label) for merchant_id, tx_category, label in cursor])
+
+def get_uncategorized_merchants(cursor, full=False):
+    """Return (merchant_id, tx_category) of merchants with neither a manual nor an LLM category.
+
+    Without full, merchants already categorized with confidence are skipped; the rest are
+    scored again, as the model learns from every LLM answer.
+    """
+    where = "" if full else "AND (auto_source IS NULL OR auto_confidence < ?)"
+    cursor.execute(f"""
+        SELECT merchant_id, tx_category FROM merchant
+        WHERE (category IS NULL OR category = '') AND (gpt_category IS NULL OR gpt_category = '') {where}
+    """, () if full else (CONFIDENCE_THRESHOLD,))
+    return cursor.fetchall()
+
+def classify(merchants, rules, model):
+    """Return {merchant_id: (category, confidence, source)} for (merchant_id, tx_category) pairs."""
+    results = {}
+    unmatched = []
+    for merchant_id, tx_category in merchants:
+        category = rules.match(merchant_id)
+        if category is not None:
+            results[merchant_id] = (category, 1.0, 'rule')
+        else:
+            unmatched.append((merchant_id, tx_category))
+    if model is None:
+        results.update((merchant_id, (None, 0.0, 'model')) for merchant_id, _ in unmatched)
+        return results
+    predictions = model.predict([features(merchant_id, tx_category) for merchant_id, tx_category in unmatched])
+    for (merchant_id, _), (category, confidence) in zip(unmatched, predictions):
+        results[merchant_id] = (category, confidence, 'model')
+    return results
+
+def shown_categories(cursor):
+    """Return {merchant_id: auto_category} of the merchants whose auto_category transactions show."""
+    cursor.execute("""
+        SELECT merchant_id, auto_category FROM merchant
+        WHERE auto_confidence >= ? AND COALESCE(gpt_category, '') = ''
+    """, (CONFIDENCE_THRESHOLD,))
+    return dict(cursor.fetchall())
+
+def categorize(conn, full=False, rules_file=RULES_FILE):
+    """Categorize merchants locally and store the results on the merchant table, in one transaction."""
+    cursor = conn.cursor()
+    try:
+        merchant.create_merchant_table_if_not_exists(cursor)
+        with metrics.stage('categorize_train'):
+            rules = load_rules(rules_file)
+            model = train_model(cursor)
+        merchants = get_uncategorized_merchants(cursor, full)
+        with metrics.stage('categorize_classify'):
+            results = classify(merchants, rules, model)
+        shown = shown_categories(cursor)
+        cursor.executemany(
+            "UPDATE merchant SET auto_category = ?, auto_confidence = ?, auto_source = ? WHERE merchant_id = ?",
+            [(category, confidence, source, merchant_id)
+             for merchant_id, (category, confidence, source) in results.items()]
+        )
+        # Transactions show confident categories, so their materialized rows change with them
+        now_shown = shown_categories(cursor)
+        changed = [merchant_id for merchant_id in results if shown.get(merchant_id) != now_shown.get(merchant_id)]
+        if changed:
+            merchant.refresh_materialized_transactions(cursor, changed)
+        metrics.timed_commit(conn, table='merchant')
+    except Exception:
+        conn.rollback()
+        raise
+    outcomes = {'rule': 0, 'model': 0, 'llm': 0}
+    for _, confidence, source in results.values():
+        outcomes[source if confidence >= CONFIDENCE_THRESHOLD else 'llm'] += 1
+    for outcome, merchants_categorized in outcomes.items():
+        metrics.count('categorized_total', merchants_categorized, outcome=outcome)
+    logging.info(f"Categorized {len(results)} merchants: {outcomes['rule']} by rule, {outcomes['model']} by the model, "
+                 f"{outcomes['llm']} left for the LLM ({rules.size} rules, "
+                 f"{len(model.categories) if model else 0} model categories)")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Categorize merchants locally from rules and a model trained on categorized merchants.")
+    parser.add_argument('--db', type=str, default=DB_FILE, help="Path to the SQLite database.")
+    parser.add_argument('--rules', type=str, default=RULES_FILE, help="Path to the YAML category rules.")
+    parser.add_argument('--full', action='store_true', help="Categorize every merchant again, not only new or uncertain ones.")
+    parser.add_argument('--metrics-file', type=str, help="Write the categorization metrics here in Prometheus text format.")
+    args = parser.parse_args()
+
+    with db.get_database(args.db).writer() as conn:
+        db.with_retry(categorize, conn, args.full, args.rules)
+    if args.metrics_file:
+        metrics.write_file(args.metrics_file)
+
+if __name__ == "__main__":
+    main()
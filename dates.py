@@ -0,0 +1,199 @@
+import re
+import warnings
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+import numpy as np
+import pandas as pd
+
+# Source CSV dates are Eastern Time and are stored as UTC epoch seconds
+TIMEZONE_NAME = 'America/New_York'
+TIMEZONE = ZoneInfo(TIMEZONE_NAME)
+
+# Months the pre-zoneinfo conversion treated as EDT
+LEGACY_EDT_MONTHS = (4, 5, 6, 7, 8, 9, 10)
+
+# Formats tried in order when an account doesn't configure date_format
+CANDIDATE_FORMATS = [
+    '%m/%d/%Y',
+    '%m/%d/%y',
+    '%Y-%m-%d',
+    '%m/%d/%Y %H:%M',
+    '%m/%d/%Y %H:%M:%S',
+    '%m/%d/%Y %I:%M:%S %p',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S.%f',
+    '%d %b %Y',
+    '%b %d, %Y',
+    '%H:%M:%S',
+]
+
+# Number of non-empty values used to detect or validate a column's format
+SAMPLE_SIZE = 100
+
+# (account_name, column) -> format detected for the account's previous file
+_format_cache = {}
+
+def _sample(values):
+    """Return up to SAMPLE_SIZE non-empty string values from a column."""
+    sample = []
+    for value in values:
+        if isinstance(value, str) and value.strip():
+            sample.append(value)
+            if len(sample) == SAMPLE_SIZE:
+                break
+    return sample
+
+def _parses(sample, fmt):
+    """Return True if every sampled value matches the format."""
+    try:
+        pd.to_datetime(pd.Series(sample, dtype=object), format=fmt, errors='raise')
+        return True
+    except (ValueError, TypeError):
+        return False
+
+def detect_format(values):
+    """Return the first candidate format matching every sampled value, None if none does."""
+    sample = _sample(values)
+    if not sample:
+        return None
+    for fmt in CANDIDATE_FORMATS:
+        if _parses(sample, fmt):
+            return fmt
+    return None
+
+def column_format(date_format, column):
+    """Return the configured format of a column: date_format itself, or its entry when it maps columns to formats."""
+    if isinstance(date_format, dict):
+        return date_format.get(column)
+    return date_format
+
+def resolve_format(account_name, column, values, date_format=None):
+    """Return the format for a column: configured, cached from the account's last file, or detected."""
+    date_format = column_format(date_format, column)
+    if date_format:
+        return date_format
+
+    key = (account_name, column)
+    cached = _format_cache.get(key)
+    if cached and _parses(_sample(values), cached):
+        return cached
+    fmt = detect_format(values)
+    if fmt:
+        _format_cache[key] = fmt
+    return fmt
+
+def _parse_value(value):
+    """Parse a single value by inference, returning a naive Eastern Time timestamp or NaT."""
+    try:
+        timestamp = pd.to_datetime(value, errors='raise')
+    except (ValueError, TypeError, OverflowError):
+        return pd.NaT
+    if isinstance(timestamp, pd.Timestamp) and timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_convert(TIMEZONE_NAME).tz_localize(None)
+    return timestamp if isinstance(timestamp, pd.Timestamp) else pd.NaT
+
+def parse_column(values, fmt=None):
+    """Parse a column into naive Eastern Time timestamps, falling back to inference for values off-format."""
+    series = pd.Series(values, dtype=object)
+    if fmt:
+        parsed = pd.to_datetime(series, format=fmt, errors='coerce')
+    else:
+        parsed = pd.Series(pd.NaT, index=series.index, dtype='datetime64[ns]')
+    leftover = parsed.isna() & series.notna()
+    if leftover.any():
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)
+            parsed[leftover] = [_parse_value(value) for value in series[leftover]]
+    return parsed.astype('datetime64[ns]')
+
+def _seconds(ns, missing, truncate=False):
+    """Convert int64 nanoseconds to a list of int seconds, None where missing."""
+    if truncate:
+        seconds = np.where(ns < 0, -((-ns) // 10**9), ns // 10**9)
+    else:
+        seconds = ns // 10**9
+    return [None if is_missing else int(value) for value, is_missing in zip(seconds.tolist(), missing.tolist())]
+
+def to_epoch(parsed):
+    """Localize naive Eastern Time timestamps with real DST rules and return UTC epoch seconds."""
+    missing = parsed.isna().to_numpy()
+    # Ambiguous fall-back times resolve to the first (EDT) occurrence, times skipped in spring move forward
+    localized = parsed.dt.tz_localize(
+        TIMEZONE_NAME, ambiguous=np.ones(len(parsed), dtype=bool), nonexistent='shift_forward'
+    )
+    ns = localized.dt.tz_convert('UTC').dt.tz_localize(None).to_numpy(dtype='datetime64[ns]').astype('int64')
+    return _seconds(ns, missing)
+
+def legacy_epoch(parsed):
+    """The pre-zoneinfo conversion (EDT for April-October, EST otherwise).
+
+    Version 1 unique_hash values were computed from these, so ignore_hash entries
+    written before row keys (see row_keys.py) are still matched against them.
+    """
+    missing = parsed.isna().to_numpy()
+    offset_hours = np.where(parsed.dt.month.isin(LEGACY_EDT_MONTHS).to_numpy(), 4, 5)
+    ns = parsed.to_numpy(dtype='datetime64[ns]').astype('int64') + offset_hours * 3600 * 10**9
+    # int(Timestamp.timestamp()) truncates towards zero
+    return _seconds(ns, missing, truncate=True)
+
+def convert_column(values, account_name=None, column=None, date_format=None):
+    """Convert a DATETIME column, returning (UTC epoch seconds, legacy epoch seconds for hashing)."""
+    fmt = resolve_format(account_name, column, values, date_format)
+    parsed = parse_column(values, fmt)
+    return to_epoch(parsed), legacy_epoch(parsed)
+
+def local_dates(epochs):
+    """Return the Eastern Time calendar date (YYYY-MM-DD) of each UTC epoch, None where missing."""
+    seconds = pd.Series(epochs, dtype='float64')
+    dates = pd.to_datetime(seconds, unit='s', utc=True).dt.tz_convert(TIMEZONE_NAME).dt.strftime('%Y-%m-%d')
+    return [None if pd.isna(value) else value for value in dates]
+
+def primary_date_column(config, columns):
+    """Return the column providing an account's transaction date: date_column, else the first DATETIME column."""
+    date_column = config.get('date_column')
+    if date_column in columns:
+        return date_column
+    for column, col_type in config.get('column_types', {}).items():
+        if col_type == "DATETIME" and column in columns:
+            return column
+    return None
+
+def legacy_naive(epochs):
+    """Recover the naive Eastern Time timestamps the month-based EDT/EST guess stored as epochs.
+
+    Returns (timestamps, ambiguous). The guess stored March 31 23:xx (EST) and April 1
+    00:xx (EDT) as the same epochs; those are flagged as ambiguous and read as April 1.
+    """
+    seconds = pd.Series(epochs, dtype='float64')
+    as_edt = pd.to_datetime(seconds - 4 * 3600, unit='s')
+    as_est = pd.to_datetime(seconds - 5 * 3600, unit='s')
+    edt_fits = as_edt.dt.month.isin(LEGACY_EDT_MONTHS)
+    ambiguous = (edt_fits & ~as_est.dt.month.isin(LEGACY_EDT_MONTHS)).to_numpy()
+    return as_edt.where(edt_fits, as_est), ambiguous
+
+def time_of_day(parsed):
+    """Move timestamps to 1900-01-01, the date strptime gives values parsed with a time-only format."""
+    return pd.Timestamp(1900, 1, 1) + (parsed - parsed.dt.normalize())
+
+def is_time_only(parsed, created, date_format=None):
+    """True if a DATETIME column stored by the old parser held times of day without a date.
+
+    That parser filled in the day of the ingest, so every value falls on the local day
+    its row was created (or the day before, when midnight passed in between). Columns
+    whose configured format has a date, or holding only midnights, never qualify;
+    date_format is the column's own format, see column_format.
+    """
+    if date_format and re.search(r'%[dmyYbBjaAcxUWG]', date_format):
+        return False
+    if parsed.isna().all() or (parsed == parsed.dt.normalize()).all():
+        return False
+    created_days = pd.Series([datetime.fromtimestamp(int(epoch)).date() for epoch in created], dtype='datetime64[ns]')
+    lag = (created_days - parsed.dt.normalize()).dt.days
+    return bool(lag.isin((0, 1)).all())
+
+def local_date(epoch):
+    """Return the Eastern Time calendar date (YYYY-MM-DD) of a UTC epoch."""
+    if epoch is None:
+        return None
+    return datetime.fromtimestamp(int(epoch), tz=timezone.utc).astimezone(TIMEZONE).strftime('%Y-%m-%d')
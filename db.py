@@ -0,0 +1,163 @@
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+import logging
+from contextlib import contextmanager
+import yaml
+
+# Database file path
+DB_FILE = 'financials.db'
+# Optional overrides for PRAGMAS, e.g. "synchronous: FULL" or "mmap_size: 0"
+DATABASE_CONFIG_FILE = 'database.yaml'
+
+# Applied to every connection. WAL lets readers run while the single writer commits.
+PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',  # durable across application crashes, may lose the last commit on power loss in WAL mode
+    'cache_size': -65536,  # KiB when negative: 64 MiB page cache per connection
+    'mmap_size': 268435456,  # 256 MiB of the file read through memory mapping
+    'temp_store': 'MEMORY',
+}
+# Milliseconds a statement waits on a lock held by another connection before raising
+BUSY_TIMEOUT_MS = 5000
+# Transactions are retried this many times when they still fail with a busy/locked error
+MAX_RETRIES = 5
+RETRY_BACKOFF_SECONDS = 0.1
+READ_POOL_SIZE = 4
+
+def load_pragmas(config_file=DATABASE_CONFIG_FILE):
+    """Return PRAGMAS updated with the overrides in the database config file, if there is one."""
+    pragmas = dict(PRAGMAS)
+    if config_file and os.path.exists(config_file):
+        with open(config_file, 'r') as f:
+            pragmas.update((yaml.safe_load(f) or {}).get('pragmas', {}))
+    return pragmas
+
+def connect(db_file=DB_FILE, readonly=False, pragmas=None, check_same_thread=True):
+    """Open a connection with the busy timeout and pragmas applied, read-only connections refuse writes."""
+    pragmas = load_pragmas() if pragmas is None else pragmas
+    if readonly:
+        conn = sqlite3.connect(f'file:{db_file}?mode=ro', uri=True, timeout=BUSY_TIMEOUT_MS / 1000,
+                               check_same_thread=check_same_thread)
+    else:
+        conn = sqlite3.connect(db_file, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=check_same_thread)
+    conn.execute(f'PRAGMA busy_timeout = {int(BUSY_TIMEOUT_MS)}')
+    for name, value in pragmas.items():
+        if readonly and name == 'journal_mode':
+            # Set by the writer; it is a property of the database file, not the connection
+            continue
+        conn.execute(f'PRAGMA {name} = {value}')
+    if readonly:
+        conn.execute('PRAGMA query_only = 1')
+    return conn
+
+def is_busy(error):
+    """Return True for the lock contention errors worth retrying."""
+    message = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in message or 'busy' in message)
+
+def with_retry(operation, *args, **kwargs):
+    """Run a transaction, retrying with jittered exponential backoff while it fails with busy/locked errors.
+
+    The operation must roll back on failure so it can safely run again.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return operation(*args, **kwargs)
+        except sqlite3.OperationalError as e:
+            if not is_busy(e) or attempt == MAX_RETRIES:
+                raise
+            delay = RETRY_BACKOFF_SECONDS * (2 ** attempt) * (1 + random.random())
+            logging.warning(f"Database busy ({e}), retrying in {delay:.2f}s")
+            time.sleep(delay)
+
+class Database:
+    """One writer connection, serialized by a lock, and a pool of read-only connections for a database file."""
+
+    def __init__(self, db_file=DB_FILE, read_pool_size=READ_POOL_SIZE, pragmas=None):
+        self.db_file = db_file
+        self.pragmas = load_pragmas() if pragmas is None else pragmas
+        self.write_lock = threading.RLock()
+        self.write_conn = None
+        self.read_pool = queue.LifoQueue()
+        self.read_slots = threading.BoundedSemaphore(read_pool_size)
+        self.version_lock = threading.Lock()
+        self.version_conn = None
+
+    @contextmanager
+    def writer(self):
+        """Borrow the writer connection; only one thread holds it at a time."""
+        with self.write_lock:
+            if self.write_conn is None:
+                self.write_conn = connect(self.db_file, pragmas=self.pragmas, check_same_thread=False)
+            yield self.write_conn
+
+    @contextmanager
+    def reader(self):
+        """Borrow a read-only connection from the pool, opening one if none is idle."""
+        with self.read_slots:
+            try:
+                conn = self.read_pool.get_nowait()
+            except queue.Empty:
+                if self.write_conn is None:
+                    # The first connection switches the file to WAL, which a read-only one can't do
+                    with self.writer():
+                        pass
+                conn = connect(self.db_file, readonly=True, pragmas=self.pragmas, check_same_thread=False)
+            try:
+                yield conn
+            finally:
+                if conn.in_transaction:
+                    conn.rollback()
+                self.read_pool.put(conn)
+
+    def data_version(self):
+        """Return a number that changes whenever any connection, in this process or another, commits to the file.
+
+        Read from one dedicated connection, since PRAGMA data_version is only comparable
+        between calls on the same connection.
+        """
+        with self.version_lock:
+            if self.version_conn is None:
+                if self.write_conn is None:
+                    with self.writer():
+                        pass
+                self.version_conn = connect(self.db_file, readonly=True, pragmas=self.pragmas, check_same_thread=False)
+            return self.version_conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def close(self):
+        """Close every pooled connection and the writer."""
+        while True:
+            try:
+                self.read_pool.get_nowait().close()
+            except queue.Empty:
+                break
+        with self.version_lock:
+            if self.version_conn is not None:
+                self.version_conn.close()
+                self.version_conn = None
+        with self.write_lock:
+            if self.write_conn is not None:
+                self.write_conn.close()
+                self.write_conn = None
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+def get_database(db_file=DB_FILE):
+    """Return the process-wide Database for a file, so every caller shares its single writer."""
+    key = os.path.abspath(db_file)
+    with _databases_lock:
+        if key not in _databases:
+            _databases[key] = Database(db_file)
+        return _databases[key]
+
+def close_all():
+    """Close the connections of every shared Database."""
+    with _databases_lock:
+        for database in _databases.values():
+            database.close()
+        _databases.clear()
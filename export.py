@@ -0,0 +1,230 @@
+import os
+import json
+import sqlite3
+import time
+import logging
+import argparse
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+import db
+import materialize
+import metrics
+import row_keys
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Database file path
+DB_FILE = 'financials.db'
+
+# The normalized transactions (the rows of the materialized all_transactions table) as one columnar
+# file per account and month: EXPORT_DIR/account=amexcc/month=2024-03/part.arrow. Arrow IPC files are
+# written uncompressed so load_table can memory-map them without copying; parquet is smaller but is
+# decoded on load.
+EXPORT_DIR = 'exports/transactions'
+EXPORT_FORMATS = {'arrow': 'part.arrow', 'parquet': 'part.parquet'}
+MANIFEST_FILE = '_manifest.json'
+
+# Rows created this many seconds before the high-water mark are exported again, like the merchant refresh
+EXPORT_OVERLAP_SECONDS = 300
+
+SCHEMA = pa.schema([
+    ('unique_hash', pa.string()),
+    ('Account', pa.dictionary(pa.int32(), pa.string())),
+    ('tx_epoch', pa.int64()),
+    ('tx_date', pa.string()),
+    ('tx_merchant', pa.string()),
+    ('tx_amount', pa.float64()),
+    ('source_category', pa.dictionary(pa.int32(), pa.string())),
+    ('tx_category', pa.dictionary(pa.int32(), pa.string())),
+    ('tx_note', pa.string()),
+    ('created', pa.int64()),
+    ('merchant_key', pa.string()),
+])
+# materialize.COLUMNS order, which every query below selects
+assert SCHEMA.names == materialize.COLUMNS
+
+def load_manifest(export_dir):
+    """Return the manifest of an export, empty if nothing has been exported yet."""
+    manifest_file = os.path.join(export_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file, 'r') as f:
+        return json.load(f)
+
+def write_manifest(export_dir, manifest):
+    """Replace the manifest atomically; it is written last, so a crash leaves the previous high-water mark."""
+    manifest_file = os.path.join(export_dir, MANIFEST_FILE)
+    with open(manifest_file + '.partial', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(manifest_file + '.partial', manifest_file)
+
+def partition_path(export_dir, account, month, export_format):
+    """Return the file holding one account's transactions for one month ('unknown' when undated)."""
+    return os.path.join(export_dir, f"account={account}", f"month={month or 'unknown'}", EXPORT_FORMATS[export_format])
+
+def as_float(value):
+    try:
+        return None if value is None else float(value)
+    except ValueError:
+        return None
+
+def as_int(value):
+    try:
+        return None if value is None else int(value)
+    except ValueError:
+        return None
+
+CONVERSIONS = {'unique_hash': row_keys.to_hex, 'tx_epoch': as_int, 'tx_amount': as_float, 'created': as_int}
+
+def to_table(rows):
+    """Build a table with SCHEMA dtypes from materialize.COLUMNS-ordered rows."""
+    columns = list(zip(*rows)) if rows else [()] * len(SCHEMA)
+    arrays = []
+    for field, values in zip(SCHEMA, columns):
+        convert = CONVERSIONS.get(field.name)
+        if convert:
+            values = [convert(value) for value in values]
+        elif not pa.types.is_dictionary(field.type):
+            values = [None if value is None else str(value) for value in values]
+        arrays.append(pa.array(values, type=field.type))
+    return pa.Table.from_arrays(arrays, schema=SCHEMA)
+
+def fetch_rows(conn, since):
+    """Return the normalized rows created at or after since, from the materialized table when it is maintained."""
+    if materialize.is_enabled(conn.cursor()):
+        return conn.execute(
+            f"SELECT {', '.join(materialize.COLUMNS)} FROM {materialize.MATERIALIZED_TABLE} WHERE created >= ?", (since,)
+        ).fetchall()
+    rows = []
+    for view_name in materialize.SOURCE_VIEWS:
+        try:
+            rows.extend(conn.execute(materialize.select_view(view_name, "v.created >= :since"), {'since': since}).fetchall())
+        except sqlite3.OperationalError as e:
+            # Views over accounts that have never been ingested reference missing tables
+            if 'no such table' not in str(e):
+                raise
+    return rows
+
+def read_partition(path, export_format):
+    """Read one partition file, memory-mapped for Arrow IPC."""
+    if export_format == 'parquet':
+        return pq.read_table(path, memory_map=True, schema=SCHEMA)
+    # The table's buffers point into the mapping, which stays open as long as they are referenced
+    return ipc.open_file(pa.memory_map(path, 'r')).read_all()
+
+def write_partition(path, table, export_format):
+    """Replace a partition file atomically."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial_path = path + '.partial'
+    if export_format == 'parquet':
+        pq.write_table(table, partial_path)
+    else:
+        with pa.OSFile(partial_path, 'wb') as sink, ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(partial_path, path)
+
+def merge_partition(path, new_rows, export_format):
+    """Fold new rows into a partition, replacing rows with the same unique_hash, sorted by transaction time."""
+    table = to_table(new_rows)
+    if os.path.exists(path):
+        existing = read_partition(path, export_format)
+        kept = existing.filter(pc.invert(pc.is_in(existing['unique_hash'], value_set=table['unique_hash'])))
+        table = pa.concat_tables([kept, table])
+    # One dictionary per column, which Arrow IPC files require
+    table = table.unify_dictionaries().combine_chunks()
+    table = table.sort_by([('tx_epoch', 'ascending'), ('unique_hash', 'ascending')])
+    write_partition(path, table, export_format)
+    return table.num_rows
+
+def export(db_file=DB_FILE, export_dir=EXPORT_DIR, export_format=None, full=False):
+    """Write the transactions created since the last export into their partitions. Returns the rows exported.
+
+    Rows are read in one snapshot of the database. Category changes to rows that were
+    already exported, after a merchant refresh, reach the export on the next full run.
+    """
+    manifest = {} if full else load_manifest(export_dir)
+    if manifest and manifest.get('row_key_version') != row_keys.ROW_KEY_VERSION:
+        # Partitions written before the row key migration hold the old hashes and would keep both copies
+        logging.info(f"'{export_dir}' was written with older row hashes, exporting every row again")
+        export_format = export_format or manifest.get('format')
+        manifest, full = {}, True
+    export_format = export_format or manifest.get('format', 'arrow')
+    if manifest and manifest.get('format') != export_format:
+        raise ValueError(f"'{export_dir}' holds {manifest.get('format')} files, run with --full to switch to {export_format}")
+    since = max(manifest.get('high_water', 0) - EXPORT_OVERLAP_SECONDS, 0)
+
+    with db.get_database(db_file).reader() as conn:
+        conn.execute("BEGIN")  # one snapshot for the rows and the high-water mark
+        with metrics.stage('export_fetch'):
+            rows = fetch_rows(conn, since)
+
+    partitions = {}
+    for row in rows:
+        # Account, and the year-month of the Eastern Time date
+        partitions.setdefault((row[1], (row[3] or '')[:7]), []).append(row)
+
+    if full and os.path.isdir(export_dir):
+        for root, _, names in os.walk(export_dir):
+            for name in names:
+                if name in EXPORT_FORMATS.values():
+                    os.remove(os.path.join(root, name))
+    os.makedirs(export_dir, exist_ok=True)
+
+    written = manifest.get('partitions', {})
+    with metrics.stage('export_write'):
+        for (account, month), partition_rows in sorted(partitions.items(), key=lambda item: (str(item[0][0]), item[0][1])):
+            path = partition_path(export_dir, account, month, export_format)
+            written[os.path.relpath(path, export_dir)] = merge_partition(path, partition_rows, export_format)
+
+    high_water = max([manifest.get('high_water', 0)] + [row[9] or 0 for row in rows])
+    write_manifest(export_dir, {
+        'format': export_format,
+        'row_key_version': row_keys.ROW_KEY_VERSION,
+        'high_water': high_water,
+        'exported': int(time.time()),
+        'partitions': written,
+    })
+    metrics.count('exported_rows_total', len(rows))
+    logging.info(f"Exported {len(rows)} transactions into {len(partitions)} partitions of '{export_dir}'")
+    return len(rows)
+
+def load_table(export_dir=EXPORT_DIR, accounts=None, months=None, columns=None):
+    """Load exported transactions as one Arrow table, memory-mapping Arrow IPC partitions without copying.
+
+    accounts and months ('YYYY-MM') select partitions by path, so other files are never opened.
+    """
+    export_format = load_manifest(export_dir).get('format', 'arrow')
+    tables = []
+    for account in sorted(os.listdir(export_dir)):
+        if not account.startswith('account=') or (accounts and account[len('account='):] not in accounts):
+            continue
+        for month in sorted(os.listdir(os.path.join(export_dir, account))):
+            if months and month[len('month='):] not in months:
+                continue
+            path = os.path.join(export_dir, account, month, EXPORT_FORMATS[export_format])
+            if os.path.exists(path):
+                table = read_partition(path, export_format)
+                tables.append(table.select(columns) if columns else table)
+    if not tables:
+        schema = pa.schema([SCHEMA.field(name) for name in columns]) if columns else SCHEMA
+        return schema.empty_table()
+    return pa.concat_tables(tables)
+
+def load_dataframe(export_dir=EXPORT_DIR, accounts=None, months=None, columns=None):
+    """Load exported transactions into pandas; Account and the categories become categoricals."""
+    return load_table(export_dir, accounts, months, columns).to_pandas()
+
+def main():
+    parser = argparse.ArgumentParser(description="Export normalized transactions as partitioned columnar files.")
+    parser.add_argument('--db', type=str, default=DB_FILE, help="Path to the SQLite database.")
+    parser.add_argument('--output', type=str, default=EXPORT_DIR, help="Export directory.")
+    parser.add_argument('--format', choices=list(EXPORT_FORMATS), help="File format, arrow unless the export already uses parquet.")
+    parser.add_argument('--full', action='store_true', help="Rewrite every partition instead of exporting new rows.")
+    args = parser.parse_args()
+    export(args.db, args.output, args.format, args.full)
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,29 @@
-import sqlite3
+import os
+import errno
+import shutil
+import itertools
 import pandas as pd
 import csv
 import time
 from datetime import datetime
-import re
 import argparse
-import yaml
 import hashlib
+import numpy as np
+import db
+import dates
+import ingest_plan
+import journal
+import metrics
+import merchant_keys
+import schema
+import materialize
+import row_keys
 
-def load_config(config_file, account_name):
-    """Load configuration from YAML for the specified account name."""
-    with open(config_file, 'r') as f:
-        config = yaml.safe_load(f)
-    # Set defaults for parameters if they are not specified
-    return config.get(account_name, {
-        'header_row': 1,
-        'ignore_hash': [],
-        'required_column': [],
-        'headers': None,
-        'column_types': {},
-        'hash_columns': []
-    })
+INGEST_MODES = ingest_plan.INGEST_MODES
+# Data rows per committed chunk in stream mode, overridable per account with chunk_size
+STREAM_CHUNK_SIZE = 50000
+# SQLite caps the number of bound parameters per statement (999 on older builds)
+DUPLICATE_PROBE_CHUNK = 500
 
 def detect_column_type(column_name, column_types):
     """Detects column type based on config or defaults to TEXT."""
@@ -31,59 +34,6 @@ def detect_column_type(column_name, column_types):
         return 'NUMERIC'
     return 'TEXT'  # Default to TEXT
 
-def prepare_data(value, col_type):
-    """Prepare data for insertion based on column type, handling datetime and numeric parsing."""
-    if col_type == "DATETIME":
-        try:
-            timestamp = pd.to_datetime(value, errors='raise')
-            # Determine UTC offset based on month (rough guide for EDT and EST)
-            if timestamp.month in [4, 5, 6, 7, 8, 9, 10]:  # Typically EDT months
-                offset_hours = 4
-            else:
-                offset_hours = 5
-            return int((timestamp + pd.Timedelta(hours=offset_hours)).timestamp()) if not pd.isnull(timestamp) else None
-        except:
-            return None
-    elif col_type == "NUMERIC":
-        try:
-            value = re.sub(r'[^\d.-]', '', str(value))
-            return float(value)
-        except ValueError:
-            return None
-    elif isinstance(value, str):
-        # Trim and reduce whitespace for string values
-        return ' '.join(value.strip().split())  # Trim and replace multiple spaces with a single space
-    return value  # For TEXT and other types
-
-def generate_unique_hash(row_values, table_name):
-    """Generate a SHA-256 hash using row values and table name."""
-    hash_input = table_name + ''.join(map(str, row_values))
-    return hashlib.sha256(hash_input.encode()).hexdigest()
-
-
-def generate_unique_hash_y(row_values, table_name, hash_columns):
-    """Generate a SHA-256 hash using specified row values and hash columns."""
-    if hash_columns:
-        # Filter values based on hash_columns if provided
-        hash_input = table_name + ''.join(str(row_values[col]) for col in hash_columns if col in row_values)
-    else:
-        # Concatenate all values into a single string if no specific hash_columns provided
-        hash_input = table_name + ''.join(str(value) for value in row_values.values())
-    return hashlib.sha256(hash_input.encode()).hexdigest()
-
-def generate_unique_hash_x(row_values, table_name, hash_columns):
-    """Generate a SHA-256 hash using specified row values and hash columns."""
-    hash_input = ""
-    if False: #hash_columns:
-        # Filter values based on hash_columns if provided
-        hash_input = table_name + ''.join(str(row_values[col]) for col in hash_columns if col in row_values)
-    else:
-        # Concatenate all values into a single string if no specific hash_columns provided
-        hash_input = table_name + ''.join(str(value) for value in row_values.values())
-    hashed = hashlib.sha256(hash_input.encode()).hexdigest()
-    print(hashed)
-    return hashed
-
 def clean_data(df, config):
     """Clean data based on configuration and rules."""
     headers = config.get('headers')
@@ -98,27 +48,461 @@ def clean_data(df, config):
 
 def check_duplicate_hash(cursor, table_name, unique_hash):
     """Check if a unique_hash already exists in the table."""
-    cursor.execute(f"SELECT 1 FROM '{table_name}' WHERE unique_hash = ?", (unique_hash,))
+    cursor.execute(f"SELECT 1 FROM '{table_name}' WHERE unique_hash = ? AND {schema.NOT_DUPLICATE}", (unique_hash,))
     return cursor.fetchone() is not None
 
-def insert_csv_to_db(account_name, csv_file, config_file='config.yaml', db_file='financials.db'):
-    config = load_config(config_file, account_name)
-    ignore_hashes = set(config.get('ignore_hash', []))
-    required_columns = config.get('required_column', [])
-    column_types = config.get('column_types', {})
-    hash_columns = config.get('hash_columns', [])
+def prepare_column(values, col_type):
+    """Prepare a whole non-DATETIME column at once, converting each distinct NUMERIC value only once."""
+    convert = ingest_plan.CONVERTERS.get(col_type, ingest_plan.normalize_text)
+    if col_type != "NUMERIC":
+        return [convert(value) for value in values]
+    codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+    # Missing values get code -1, which picks up the trailing None
+    converted = np.asarray([convert(value) for value in uniques] + [None], dtype=object)
+    return converted[codes].tolist()
 
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
+def prepare_datetime_columns(account_name, df, plan):
+    """Convert every DATETIME column at once, returning {column: (UTC epochs, legacy epochs for hashing)}."""
+    date_format = plan.config.get('date_format')
+    return {
+        column: dates.convert_column(df[column].to_numpy(dtype=object), account_name, column, date_format)
+        for column in plan.layout(df.columns)['datetime_columns']
+    }
+
+def local_date_values(df, layout, datetime_columns):
+    """Return each row's tx_local_date, the Eastern Time date of the account's primary date column."""
+    date_column = layout['date_column']
+    if date_column is None:
+        return [None] * len(df)
+    return dates.local_dates(datetime_columns[date_column][0])
+
+def insert_statement(account_name, columns):
+    """Build the INSERT statement for an account table and the given CSV columns."""
+    column_names = ['unique_hash', 'Tags', 'created'] + list(columns) + ['tx_local_date', 'merchant_key']
+    column_list = ', '.join(f'"{column}"' for column in column_names)
+    placeholders = ', '.join(['?'] * len(column_names))
+    return f'INSERT INTO "{account_name}" ({column_list}) VALUES ({placeholders})'
+
+def missing_required_mask(df, required_columns):
+    """Return a boolean array flagging rows with an empty value in any required column."""
+    mask = np.zeros(len(df), dtype=bool)
+    for col in required_columns:
+        if col in df.columns:
+            mask |= (df[col].isna() | (df[col] == "")).to_numpy(dtype=bool)
+    return mask
+
+def fetch_existing_hashes(cursor, table_name, hashes):
+    """Return the subset of hashes already present in the table using chunked set lookups."""
+    existing = set()
+    unique_hashes = list(set(hashes))
+    for start in range(0, len(unique_hashes), DUPLICATE_PROBE_CHUNK):
+        chunk = unique_hashes[start:start + DUPLICATE_PROBE_CHUNK]
+        placeholders = ', '.join(['?'] * len(chunk))
+        cursor.execute(
+            f'SELECT unique_hash FROM "{table_name}" WHERE unique_hash IN ({placeholders}) AND {schema.NOT_DUPLICATE}', chunk
+        )
+        existing.update(row[0] for row in cursor.fetchall())
+    return existing
+
+def new_row_counts():
+    """Return zeroed per-outcome row counts: stored new, stored tagged duplicate, skipped or ignored (ignore_hash)."""
+    return {'inserted': 0, 'duplicate': 0, 'skipped': 0, 'ignored': 0}
+
+def record_row_counts(account_name, counts):
+    """Add committed row counts to findb_rows_total."""
+    for outcome, rows in counts.items():
+        metrics.count('rows_total', rows, account=account_name, outcome=outcome)
+
+def prepare_rows(account_name, df, plan):
+    """Convert and hash rows one at a time, without touching the database.
+
+    Returns the column list, the (row key, values, tx_local_date, merchant key) of
+    each row to write and the counts of ignored and skipped rows, ready for insert_rows.
+    """
+    layout = plan.layout(df.columns)
+    columns = layout['columns']
+    converters = layout['converters']
+    hash_indices = layout['hash_indices']
+    hash_types = layout['hash_types']
+    required_columns = layout['required_columns']
+    merchant_position = layout['merchant_position']
+
+    datetime_columns = prepare_datetime_columns(account_name, df, plan)
+    # UTC epochs to store and legacy epochs for version 1 ignore_hash entries, by column position
+    epochs = [datetime_columns[column][0] if column in datetime_columns else None for column in columns]
+    legacy_epochs = [datetime_columns[column][1] if column in datetime_columns else None for column in columns]
+    local_dates = local_date_values(df, layout, datetime_columns)
+    missing_required = missing_required_mask(df, required_columns)
+    key_cache = merchant_keys.KeyCache(plan.merchant_rules)
+    counts = new_row_counts()
+    rows = []
+
+    # df.values yields the same cell objects iterrows would, without building a Series per row
+    for position, raw_row in enumerate(df.values):
+        row_values = [
+            convert(value) if convert is not None else epochs[i][position]
+            for i, (convert, value) in enumerate(zip(converters, raw_row))
+        ]
+        unique_hash = row_keys.row_key(account_name, [row_values[i] for i in hash_indices], hash_types)
+        ignored = unique_hash in plan.ignore_keys
+        if plan.ignore_legacy_hashes and not ignored:
+            legacy_values = [
+                row_values[i] if legacy_epochs[i] is None else legacy_epochs[i][position]
+                for i in hash_indices
+            ]
+            ignored = row_keys.legacy_hash(legacy_values, account_name) in plan.ignore_legacy_hashes
+        if ignored:
+            counts['ignored'] += 1
+            continue
+        # Skip rows missing values in required columns
+        if missing_required[position]:
+            print(f"Skipping row with hash {row_keys.to_hex(unique_hash)} due to missing required columns: {required_columns}")
+            counts['skipped'] += 1
+            continue
+        merchant_key = key_cache.key(row_values[merchant_position]) if merchant_position is not None else None
+        rows.append((unique_hash, row_values, local_dates[position], merchant_key))
+
+    return {'columns': columns, 'rows': rows, 'counts': counts}
+
+def insert_rows(cursor, account_name, prepared_rows, plan):
+    """Insert prepared rows one at a time, probing the table for each duplicate hash. Returns the row counts."""
+    columns = prepared_rows['columns']
+    insert_query = insert_statement(account_name, columns)
+    duplicate_query = insert_statement(plan.duplicate_table, columns) if plan.duplicate_table else insert_query
+    counts = dict(prepared_rows['counts'])
+    probe_timer = metrics.StageTimer('duplicate_probe', account=account_name)
+    insert_timer = metrics.StageTimer('insert', account=account_name)
+
+    for unique_hash, row_values, local_date, merchant_key in prepared_rows['rows']:
+        # Check for duplicates
+        with probe_timer:
+            tags = "duplicate" if check_duplicate_hash(cursor, account_name, unique_hash) else ""
+        created_timestamp = int(time.time())  # Current timestamp in epoch seconds
+        insert_values = [unique_hash, tags, created_timestamp] + row_values + [local_date, merchant_key]
+        with insert_timer:
+            cursor.execute(duplicate_query if tags else insert_query, insert_values)
+        counts['duplicate' if tags else 'inserted'] += 1
+
+    for timer in (probe_timer, insert_timer):
+        timer.record()
+    return counts
+
+def prepare_bulk_rows(account_name, df, plan):
+    """Convert whole columns and hash them in one batch, without touching the database.
+
+    Returns the column list, the prepared column values, the row keys, the merchant
+    keys and the mask of rows missing a required column, ready for write_bulk_rows.
+    """
+    layout = plan.layout(df.columns)
+    columns = layout['columns']
+    # df.values yields the same cell objects iterrows would, without building a Series per row
+    raw_values = df.values
+    with metrics.stage('parse_dates', account=account_name):
+        datetime_columns = prepare_datetime_columns(account_name, df, plan)
+    with metrics.stage('prepare_columns', account=account_name):
+        prepared = [
+            datetime_columns[column][0] if column in datetime_columns
+            else prepare_column(raw_values[:, i], plan.column_types.get(column, "TEXT"))
+            for i, column in enumerate(columns)
+        ]
+    hash_indices = layout['hash_indices']
+    with metrics.stage('hash', account=account_name):
+        hashes = row_keys.row_keys(account_name, [prepared[i] for i in hash_indices], layout['hash_types'], len(df))
+        ignored_legacy = None
+        if plan.ignore_legacy_hashes:
+            # Version 1 hashes were computed over the legacy DATETIME values
+            legacy_prepared = [
+                datetime_columns[columns[i]][1] if columns[i] in datetime_columns else prepared[i]
+                for i in hash_indices
+            ]
+            legacy_source = zip(*legacy_prepared) if hash_indices else ([] for _ in range(len(df)))
+            ignored_legacy = [
+                row_keys.legacy_hash(values, account_name) in plan.ignore_legacy_hashes for values in legacy_source
+            ]
+
+    merchant_position = layout['merchant_position']
+    if merchant_position is not None:
+        key_cache = merchant_keys.KeyCache(plan.merchant_rules)
+        keys = [key_cache.key(description) for description in prepared[merchant_position]]
+    else:
+        keys = [None] * len(df)
+
+    return {
+        'columns': columns,
+        'prepared': prepared,
+        'merchant_keys': keys,
+        'local_dates': local_date_values(df, layout, datetime_columns),
+        'hashes': hashes,
+        'ignored_legacy': ignored_legacy,
+        'missing_required': missing_required_mask(df, layout['required_columns']),
+    }
+
+def write_bulk_rows(cursor, account_name, bulk_rows, plan, known_hashes=None):
+    """Resolve duplicates with one set-based lookup and write prepared rows with executemany. Returns the row counts.
+
+    known_hashes holds keys already written to the table in the same transaction,
+    e.g. by earlier files of a backfill; they are tagged without probing the table,
+    and the set is updated with this file's keys.
+    """
+    layout = plan.layout(bulk_rows['columns'])
+    required_columns = layout['required_columns']
+    columns = bulk_rows['columns']
+    hashes = bulk_rows['hashes']
+    local_dates = bulk_rows['local_dates']
+    ignored_legacy = bulk_rows['ignored_legacy']
+    missing_required = bulk_rows['missing_required']
+    merchant_keys_column = bulk_rows['merchant_keys']
+
+    seen = known_hashes if known_hashes is not None else set()
+    with metrics.stage('duplicate_probe', account=account_name):
+        seen.update(fetch_existing_hashes(cursor, account_name, [h for h in hashes if h not in seen]))
+    created_timestamp = int(time.time())  # Current timestamp in epoch seconds
+    counts = new_row_counts()
+    insert_rows_values = []
+    duplicate_rows_values = insert_rows_values if plan.duplicate_table is None else []
+    for index, values in enumerate(zip(*bulk_rows['prepared'])):
+        unique_hash = hashes[index]
+        if unique_hash in plan.ignore_keys or (ignored_legacy and ignored_legacy[index]):
+            counts['ignored'] += 1
+            continue
+        if missing_required[index]:
+            print(f"Skipping row with hash {row_keys.to_hex(unique_hash)} due to missing required columns: {required_columns}")
+            counts['skipped'] += 1
+            continue
+        # Rows earlier in the same file count as duplicates, exactly like the per-row probe
+        tags = "duplicate" if unique_hash in seen else ""
+        seen.add(unique_hash)
+        counts['duplicate' if tags else 'inserted'] += 1
+        merchant_key = merchant_keys_column[index]
+        (duplicate_rows_values if tags else insert_rows_values).append(
+            [unique_hash, tags, created_timestamp] + list(values) + [local_dates[index], merchant_key]
+        )
+
+    with metrics.stage('insert', account=account_name):
+        if insert_rows_values:
+            cursor.executemany(insert_statement(account_name, columns), insert_rows_values)
+        if duplicate_rows_values is not insert_rows_values and duplicate_rows_values:
+            cursor.executemany(insert_statement(plan.duplicate_table, columns), duplicate_rows_values)
+    return counts
+
+def read_csv_file(csv_file, config):
+    """Load a CSV file and apply the configured header handling."""
     # Load CSV file based on whether headers are specified
     headers = config.get('headers')
     if headers:
-        df = pd.read_csv(csv_file, header=None)  # No header row in the CSV
+        # No header row in the CSV; read as strings like files with one, so no value depends on dtype inference
+        df = pd.read_csv(csv_file, header=None, dtype=str)
         df.columns = headers  # Apply custom headers
     else:
         df = pd.read_csv(csv_file, header=None)
         df = clean_data(df, config)
+    return df
+
+def iter_csv_chunks(csv_file, config, chunk_size):
+    """Yield DataFrames of about chunk_size data rows with the configured header handling applied.
 
+    Unlike read_csv_file the file is never loaded whole. Every chunk is read as
+    strings, which is what a whole-file read yields, so no value depends on the
+    dtype pandas would infer for the chunk it falls in.
+    """
+    headers = config.get('headers')
+    if headers:
+        for chunk in pd.read_csv(csv_file, header=None, dtype=str, chunksize=chunk_size):
+            chunk.columns = headers  # Apply custom headers
+            yield chunk
+        return
+
+    header_row = config.get('header_row', 1)
+    header = None
+    # The first chunk must reach the header row
+    for chunk in pd.read_csv(csv_file, header=None, dtype=str, chunksize=max(chunk_size, header_row)):
+        if header is None:
+            header = chunk.iloc[header_row - 1]
+            chunk = clean_data(chunk, config)
+        else:
+            chunk.columns = header
+            chunk = chunk.loc[:, chunk.columns.notna()].reset_index(drop=True)
+        if len(chunk):
+            yield chunk
+
+def file_digest(csv_file):
+    """Return the SHA-256 of a file's content, read in blocks."""
+    digest = hashlib.sha256()
+    with open(csv_file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+PROGRESS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS {table_name} (
+        file_hash TEXT NOT NULL,
+        account_name TEXT NOT NULL,
+        file_path TEXT,
+        rows_committed INTEGER NOT NULL,
+        completed INTEGER NOT NULL DEFAULT 0,
+        updated INTEGER,
+        PRIMARY KEY (account_name, file_hash)
+    )
+"""
+
+def create_progress_table(cursor):
+    """Create the ingest_progress table tracking rows committed per streamed file of an account.
+
+    Tables keyed by file_hash alone are rebuilt with their rows, in the caller's transaction.
+    """
+    key_columns = [row[1] for row in sorted(cursor.execute("PRAGMA table_info(ingest_progress)").fetchall(),
+                                            key=lambda row: row[5]) if row[5]]
+    if key_columns != ['file_hash']:
+        cursor.execute(PROGRESS_TABLE_SQL.format(table_name='ingest_progress'))
+        return
+    cursor.execute("DROP TABLE IF EXISTS ingest_progress_rebuild")
+    cursor.execute(PROGRESS_TABLE_SQL.format(table_name='ingest_progress_rebuild'))
+    # The INSERT opens the transaction, so the swap below commits or rolls back as a whole
+    cursor.execute("""
+        INSERT INTO ingest_progress_rebuild (file_hash, account_name, file_path, rows_committed, completed, updated)
+        SELECT file_hash, account_name, file_path, rows_committed, completed, updated FROM ingest_progress
+        WHERE account_name IS NOT NULL
+    """)
+    cursor.execute("DROP TABLE ingest_progress")
+    cursor.execute("ALTER TABLE ingest_progress_rebuild RENAME TO ingest_progress")
+
+def get_resume_position(cursor, file_hash, account_name):
+    """Return how many data rows of an unfinished streamed ingest of this file content into an account are committed."""
+    row = cursor.execute(
+        "SELECT rows_committed FROM ingest_progress WHERE account_name = ? AND file_hash = ? AND completed = 0",
+        (account_name, file_hash)
+    ).fetchone()
+    return row[0] if row else 0
+
+def set_progress(cursor, file_hash, account_name, csv_file, rows_committed, completed=False):
+    """Record streamed ingest progress, in the same transaction as the rows it covers."""
+    cursor.execute(
+        "INSERT OR REPLACE INTO ingest_progress (file_hash, account_name, file_path, rows_committed, completed, updated) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (file_hash, account_name, csv_file, rows_committed, int(completed), int(time.time()))
+    )
+
+def write_streamed_file(conn, prepared):
+    """Ingest a file chunk by chunk, committing each chunk together with the file's progress.
+
+    If a previous run died part way through the same file content, the rows it
+    already committed are skipped, so they are neither inserted again nor tagged
+    as duplicates of themselves. Returns the number of data rows in the file.
+    """
+    account_name = prepared['account_name']
+    csv_file = prepared['csv_file']
+    plan = prepared['plan']
+    config = plan.config
+    chunk_size = config.get('chunk_size', STREAM_CHUNK_SIZE)
+    cursor = conn.cursor()
+
+    file_hash = prepared['file_hash']
+    create_progress_table(cursor)
+    resume_position = get_resume_position(cursor, file_hash, account_name)
+    conn.commit()
+    if resume_position:
+        print(f"Resuming '{csv_file}' after {resume_position} already committed rows")
+
+    position = 0
+    chunks = iter_csv_chunks(csv_file, config, chunk_size)
+    read_timer = metrics.StageTimer('read_csv', account=account_name)
+    while True:
+        with read_timer:
+            chunk = next(chunks, None)
+        if chunk is None:
+            break
+        chunk_end = position + len(chunk)
+        if chunk_end <= resume_position:
+            position = chunk_end
+            continue
+        if position < resume_position:
+            chunk = chunk.iloc[resume_position - position:].reset_index(drop=True)
+        try:
+            create_account_table(cursor, account_name, chunk.columns, plan.column_types)
+            schema.migrate_account(cursor, account_name, config)
+
+            chunk_started = int(time.time())
+            counts = write_bulk_rows(cursor, account_name, prepare_bulk_rows(account_name, chunk, plan), plan)
+            set_progress(cursor, file_hash, account_name, csv_file, chunk_end)
+            refresh_materialized(cursor, account_name, chunk_started)
+            metrics.timed_commit(conn, account=account_name)
+        except Exception:
+            conn.rollback()
+            raise
+        record_row_counts(account_name, counts)
+        position = chunk_end
+        print(f"Committed {position} rows of '{csv_file}'")
+
+    read_timer.record()
+    set_progress(cursor, file_hash, account_name, csv_file, position, completed=True)
+    journal.record(cursor, file_hash, account_name, csv_file, journal.COMMITTED, position)
+    conn.commit()
+    return position
+
+def move_to_completed(account_name, file_path, completed_path):
+    """Move a committed file to completed/<account>/ under a timestamped name, atomically. Returns the new path.
+
+    Names already taken get a counter, and a completed/ on another filesystem is
+    filled through a temporary file, so the file only ever appears there whole.
+    """
+    completed_folder = os.path.join(completed_path, account_name)
+    os.makedirs(completed_folder, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    filename = os.path.basename(file_path)
+    completed_file = os.path.join(completed_folder, f"{timestamp}_{filename}")
+    for attempt in itertools.count(1):
+        if not os.path.exists(completed_file):
+            break
+        completed_file = os.path.join(completed_folder, f"{timestamp}_{attempt}_{filename}")
+    try:
+        os.rename(file_path, completed_file)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        partial_file = completed_file + '.partial'
+        shutil.copy2(file_path, partial_file)
+        with open(partial_file, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(partial_file, completed_file)
+        os.remove(file_path)
+    return completed_file
+
+def prepare_file(account_name, csv_file, config_file='config.yaml'):
+    """Parse a CSV file and convert and hash its rows without touching the database.
+
+    This is the CPU-bound half of an ingest and is safe to run concurrently; the
+    result is handed to write_prepared_file, which must run on a single writer.
+    Stream mode defers reading to the writer so the file is never held in memory.
+    """
+    # Compiled once and validated up front, recompiled only when the config file changes
+    plan = ingest_plan.get_plan(config_file, account_name)
+    config = plan.config
+    ingest_mode = plan.ingest_mode
+
+    prepared = {
+        'account_name': account_name,
+        'csv_file': csv_file,
+        'config': config,
+        'plan': plan,
+        'stream': ingest_mode == 'stream',
+        'rows': None,
+        'bulk_rows': None,
+    }
+    # The journal identifies a file by its content, so a renamed copy is still recognized
+    with metrics.stage('file_digest', account=account_name):
+        prepared['file_hash'] = file_digest(csv_file)
+    if not prepared['stream']:
+        with metrics.stage('read_csv', account=account_name):
+            df = read_csv_file(csv_file, config)
+        if ingest_mode == 'bulk':
+            prepared['bulk_rows'] = prepare_bulk_rows(account_name, df, plan)
+        else:
+            with metrics.stage('prepare', account=account_name):
+                prepared['rows'] = prepare_rows(account_name, df, plan)
+    return prepared
+
+def create_account_table(cursor, account_name, columns, column_types):
+    """Create the account table for the given CSV columns if it doesn't already exist."""
     # Check if table exists and create if not
     table_exists = cursor.execute(
         "SELECT name FROM sqlite_master WHERE type='table' AND name=?", (account_name,)
@@ -127,58 +511,95 @@ def insert_csv_to_db(account_name, csv_file, config_file='config.yaml', db_file=
     if not table_exists:
         # Define default columns with their types
         column_definitions = [
-            '"unique_hash" TEXT',
+            '"unique_hash" BLOB',
             '"Tags" TEXT',
             '"created" INTEGER'
         ]
         # Append additional columns from CSV based on configuration or detect type dynamically
-        for column in df.columns:
+        for column in columns:
             col_type = detect_column_type(column, column_types)
             column_definitions.append(f'"{column}" {col_type}')
+        # Eastern Time date of the primary date column, used by the views instead of per-row offset math
+        column_definitions.append('"tx_local_date" TEXT')
+        # Canonical merchant key (see merchant_keys.py) that merchant.py and the views group by
+        column_definitions.append('"merchant_key" TEXT')
 
         create_table_query = f'CREATE TABLE "{account_name}" ({", ".join(column_definitions)})'
         cursor.execute(create_table_query)
 
-    for _, row in df.iterrows():
-        row_values = {column: prepare_data(row[column], column_types.get(column, "TEXT")) for column in df.columns}
-        if hash_columns:
-            hash_values = [row_values[col] for col in hash_columns if col in row_values]
+def refresh_materialized(cursor, account_name, ingest_started):
+    """Fold rows created since ingest_started into the materialized table, if it is enabled."""
+    if materialize.is_enabled(cursor):
+        with metrics.stage('materialize', account=account_name):
+            materialize.refresh_account(cursor, account_name, ingest_started)
+
+def write_prepared_file(conn, prepared):
+    """Write a prepared file to the database and commit it as one transaction (one per chunk when streaming).
+
+    The file is journaled as committed in the same transaction as its rows; see
+    ingest_prepared_file for the whole journaled write. Returns the number of rows read.
+    """
+    if prepared['stream']:
+        return write_streamed_file(conn, prepared)
+    account_name = prepared['account_name']
+    plan = prepared['plan']
+    config = plan.config
+    # Both row and bulk mode hand the writer nothing but the rows to insert
+    rows = prepared['bulk_rows'] if prepared['bulk_rows'] is not None else prepared['rows']
+    cursor = conn.cursor()
+    try:
+        create_account_table(cursor, account_name, rows['columns'], plan.column_types)
+
+        # Index new tables and upgrade tables created by older versions
+        schema.migrate_account(cursor, account_name, config)
+
+        ingest_started = int(time.time())
+        if prepared['bulk_rows'] is not None:
+            counts = write_bulk_rows(cursor, account_name, rows, plan)
         else:
-            hash_values = list(row_values.values())
-        unique_hash = generate_unique_hash(hash_values, account_name)
-        # Skip rows missing values in required columns
-        missing_required = any(pd.isna(row[col]) or row[col] == "" for col in required_columns if col in df.columns)
-        if missing_required:
-            print(f"Skipping row with hash {unique_hash} due to missing required columns: {required_columns}")
-            continue
-        # if unique_hash in ignore_hashes or any(row_values.get(col) in [None, ""] for col in required_columns):
-        #      continue
+            counts = insert_rows(cursor, account_name, rows, plan)
 
-        # Check for duplicates
-        tags = "duplicate" if check_duplicate_hash(cursor, account_name, unique_hash) else ""
-        # Capture the current timestamp in UTC epoch seconds for the 'created' column
-        # created_timestamp = int(time.time())
-        # if check_duplicate_hash(cursor, account_name, unique_hash):
-        #     continue
-
-        # Prepare row for insertion
-        # tags = ""  # Default value for Tags
-        created_timestamp = int(time.time())  # Current timestamp in epoch seconds
-        insert_values = [unique_hash, tags, created_timestamp] + [row_values[col] for col in df.columns]
-        placeholders = ', '.join(['?'] * len(insert_values))
-        insert_query = f'INSERT INTO "{account_name}" VALUES ({placeholders})'
-        cursor.execute(insert_query, insert_values)
-    
-    conn.commit()
-    conn.close()
+        # Fold this file's rows into the materialized all_transactions table in the same transaction
+        refresh_materialized(cursor, account_name, ingest_started)
+
+        # In the same transaction as the rows, so recovery never ingests a committed file twice
+        journal.record(cursor, prepared['file_hash'], account_name, prepared['csv_file'], journal.COMMITTED,
+                       sum(counts.values()))
+        metrics.timed_commit(conn, account=account_name)
+    except Exception:
+        conn.rollback()
+        raise
+    record_row_counts(account_name, counts)
+    return sum(counts.values())
+
+def ingest_prepared_file(conn, prepared):
+    """Journal a prepared file as started once, then write it, retrying only the write while the database is busy.
+
+    Returns the number of rows read from the file.
+    """
+    db.with_retry(journal.record_now, conn, prepared['file_hash'], prepared['account_name'], prepared['csv_file'],
+                  journal.STARTED)
+    return db.with_retry(write_prepared_file, conn, prepared)
+
+def insert_csv_to_db(account_name, csv_file, config_file='config.yaml', db_file='financials.db', profile=None):
+    """Prepare and write a file; profile=True runs both halves under cProfile (None defers to FINDB_PROFILE)."""
+    with metrics.profiled(csv_file, 'prepare', profile):
+        prepared = prepare_file(account_name, csv_file, config_file)
+    with db.get_database(db_file).writer() as conn, metrics.profiled(csv_file, 'write', profile):
+        ingest_prepared_file(conn, prepared)
 
 def main():
     parser = argparse.ArgumentParser(description="Insert CSV data into an SQLite table.")
     parser.add_argument('account_name', type=str, help="The account name for the data.")
     parser.add_argument('csv_file', type=str, help="Path to the CSV file.")
     parser.add_argument('--config', type=str, default='config.yaml', help="Path to the YAML configuration file.")
+    parser.add_argument('--profile', action='store_true', default=None,
+                        help=f"Write cProfile stats for this file to {metrics.PROFILE_DIR}/.")
+    parser.add_argument('--metrics-file', type=str, help="Write the ingest metrics here in Prometheus text format.")
     args = parser.parse_args()
-    insert_csv_to_db(args.account_name, args.csv_file, args.config)
+    insert_csv_to_db(args.account_name, args.csv_file, args.config, profile=args.profile)
+    if args.metrics_file:
+        metrics.write_file(args.metrics_file)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,203 @@
+import os
+import re
+import logging
+import threading
+import yaml
+import dates
+import merchant_keys
+import row_keys
+
+# config.yaml is compiled once into a plan per account. The column-dependent part of a
+# plan (converters, hash indices, required columns) is compiled the first time a file
+# with a given header is seen, so rows only index into precomputed lists.
+
+INGEST_MODES = ('row', 'bulk', 'stream')
+COLUMN_TYPES = ('TEXT', 'NUMERIC', 'DATETIME')
+# Used for accounts config.yaml doesn't mention
+DEFAULT_ACCOUNT_CONFIG = {
+    'header_row': 1,
+    'ignore_hash': [],
+    'required_column': [],
+    'headers': None,
+    'column_types': {},
+    'hash_columns': [],
+    'ingest_mode': 'row',
+    'date_format': None
+}
+# Every key an account may set, with the check its value must pass
+STRING_LIST = 'list of strings'
+ACCOUNT_KEYS = {
+    'header_row': 'positive integer',
+    'headers': STRING_LIST,
+    'ignore_hash': STRING_LIST,
+    'required_column': STRING_LIST,
+    'hash_columns': STRING_LIST,
+    'column_types': 'mapping of column to type',
+    'ingest_mode': 'ingest mode',
+    'chunk_size': 'positive integer',
+    'date_format': 'format or mapping of column to format',
+    'date_column': 'string',
+    'merchant_column': 'string',
+    'merchant_rules': 'mapping',
+    'duplicate_table': 'boolean',
+}
+# Rows tagged duplicate go to <account>_duplicates instead of the account table when duplicate_table is set
+DUPLICATE_TABLE_SUFFIX = '_duplicates'
+
+NUMERIC_STRIP = re.compile(r'[^\d.-]')
+HEX_KEY = re.compile(f'[0-9a-fA-F]{{{row_keys.KEY_BYTES * 2}}}')
+
+def parse_numeric(value):
+    """Strip currency symbols and separators and parse a float, None if nothing parseable is left."""
+    try:
+        return float(NUMERIC_STRIP.sub('', str(value)))
+    except ValueError:
+        return None
+
+def normalize_text(value):
+    """Trim and collapse whitespace in strings, leaving other values as they are."""
+    if isinstance(value, str):
+        return ' '.join(value.strip().split())
+    return value
+
+CONVERTERS = {'TEXT': normalize_text, 'NUMERIC': parse_numeric}
+
+def _check_value(kind, value):
+    if kind == 'positive integer':
+        return isinstance(value, int) and not isinstance(value, bool) and value > 0
+    if kind == STRING_LIST:
+        return isinstance(value, list) and all(isinstance(item, str) for item in value)
+    if kind == 'mapping of column to type':
+        return isinstance(value, dict) and all(col_type in COLUMN_TYPES for col_type in value.values())
+    if kind == 'ingest mode':
+        return value in INGEST_MODES
+    if kind == 'string':
+        return isinstance(value, str)
+    if kind == 'format or mapping of column to format':
+        return isinstance(value, str) or (isinstance(value, dict) and all(isinstance(fmt, str) for fmt in value.values()))
+    if kind == 'boolean':
+        return isinstance(value, bool)
+    return isinstance(value, dict)
+
+def validate_account(account_name, config):
+    """Return the problems in an account's configuration, an empty list if there are none."""
+    if not isinstance(config, dict):
+        return [f"{account_name}: expected a mapping of settings, got {type(config).__name__}"]
+    problems = []
+    for key, value in config.items():
+        if key not in ACCOUNT_KEYS:
+            problems.append(f"{account_name}: unknown setting '{key}'")
+        elif value is not None and not _check_value(ACCOUNT_KEYS[key], value):
+            problems.append(f"{account_name}.{key}: expected a {ACCOUNT_KEYS[key]}, got {value!r}")
+    if problems:
+        return problems
+
+    headers = config.get('headers')
+    if headers:
+        for key in ('required_column', 'hash_columns'):
+            missing = [column for column in config.get(key) or [] if column not in headers]
+            if missing:
+                problems.append(f"{account_name}.{key}: {missing} not in headers")
+    date_column = config.get('date_column')
+    if date_column and (config.get('column_types') or {}).get(date_column) != 'DATETIME':
+        problems.append(f"{account_name}.date_column: '{date_column}' is not a DATETIME column")
+    try:
+        rules = merchant_keys.compile_rules(config)
+    except (re.error, TypeError, AttributeError) as e:
+        problems.append(f"{account_name}.merchant_rules: {e}")
+    else:
+        if rules['max_tokens'] and not isinstance(rules['max_tokens'], int):
+            problems.append(f"{account_name}.merchant_rules: max_tokens must be an integer")
+        if not _check_value(STRING_LIST, (config.get('merchant_rules') or {}).get('cluster_prefixes', [])):
+            problems.append(f"{account_name}.merchant_rules.cluster_prefixes: expected a {STRING_LIST}")
+    return problems
+
+class IngestPlan:
+    """An account's validated configuration with everything derivable from it computed once."""
+
+    def __init__(self, account_name, config):
+        self.account_name = account_name
+        self.config = config
+        self.ingest_mode = config.get('ingest_mode') or 'row'
+        self.column_types = config.get('column_types') or {}
+        self.required_columns = config.get('required_column') or []
+        self.hash_columns = config.get('hash_columns') or []
+        ignore_hashes = config.get('ignore_hash') or []
+        # Row keys by their hex form, and version 1 hashes from before the migration to row keys
+        self.ignore_keys = frozenset(row_keys.from_hex(h) for h in ignore_hashes if HEX_KEY.fullmatch(h))
+        self.ignore_legacy_hashes = frozenset(h for h in ignore_hashes if len(h) == row_keys.LEGACY_HASH_LENGTH)
+        self.merchant_column = config.get('merchant_column')
+        self.merchant_rules = merchant_keys.compile_rules(config)
+        self.duplicate_table = account_name + DUPLICATE_TABLE_SUFFIX if config.get('duplicate_table') else None
+        self.layouts = {}
+
+    def layout(self, columns):
+        """Return the compiled column layout of a file with these columns, cached per header."""
+        columns = tuple(columns)
+        layout = self.layouts.get(columns)
+        if layout is None:
+            layout = self.layouts[columns] = self.compile_layout(columns)
+        return layout
+
+    def compile_layout(self, columns):
+        column_types = [self.column_types.get(column, 'TEXT') for column in columns]
+        datetime_columns = [column for column, col_type in zip(columns, column_types) if col_type == 'DATETIME']
+        if self.hash_columns:
+            # Duplicated names in hash_columns are hashed twice
+            hash_indices = [columns.index(column) for column in self.hash_columns if column in columns]
+        else:
+            hash_indices = list(range(len(columns)))
+        return {
+            'columns': list(columns),
+            # None for DATETIME columns, which are converted a whole column at a time
+            'converters': [CONVERTERS.get(col_type) for col_type in column_types],
+            'datetime_columns': datetime_columns,
+            'date_column': dates.primary_date_column(self.config, datetime_columns),
+            'hash_indices': hash_indices,
+            'hash_types': [column_types[i] for i in hash_indices],
+            'required_columns': [column for column in self.required_columns if column in columns],
+            'merchant_position': columns.index(self.merchant_column) if self.merchant_column in columns else None,
+        }
+
+def compile_plans(config):
+    """Validate a parsed config.yaml and compile a plan per account, raising ValueError listing every problem."""
+    if config is None:
+        config = {}
+    if not isinstance(config, dict):
+        raise ValueError("Invalid configuration: expected a mapping of account names to settings")
+    problems = []
+    for account_name, account_config in config.items():
+        problems.extend(validate_account(account_name, account_config or {}))
+    if problems:
+        raise ValueError("Invalid configuration:\n  " + "\n  ".join(problems))
+    return {account_name: IngestPlan(account_name, account_config or {}) for account_name, account_config in config.items()}
+
+_cache = {}  # absolute config path -> (mtime_ns, size, plans)
+_cache_lock = threading.Lock()
+
+def load_plans(config_file):
+    """Return the plans of a config file, recompiling them only when its mtime or size changed."""
+    path = os.path.abspath(config_file)
+    stat = os.stat(path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    with _cache_lock:
+        cached = _cache.get(path)
+        if cached and cached[0] == signature:
+            return cached[1]
+        with open(path, 'r') as f:
+            try:
+                config = yaml.safe_load(f)
+            except yaml.YAMLError as e:
+                raise ValueError(f"Invalid configuration in '{config_file}': {e}") from e
+        plans = compile_plans(config)
+        if cached:
+            logging.info(f"Reloaded ingest plans from '{config_file}'")
+        _cache[path] = (signature, plans)
+        return plans
+
+def get_plan(config_file, account_name):
+    """Return the current plan of an account, a default plan if the config doesn't mention it."""
+    plan = load_plans(config_file).get(account_name)
+    if plan is None:
+        plan = IngestPlan(account_name, dict(DEFAULT_ACCOUNT_CONFIG))
+    return plan
@@ -0,0 +1,92 @@
+import time
+import sqlite3
+import argparse
+import db
+
+# Database file path
+DB_FILE = 'financials.db'
+
+# One row per state change of an ingested file, keyed by the SHA-256 of its content. 'committed'
+# is written in the same transaction as the file's rows, so a file whose latest state is
+# 'committed' is in the database even if the process died before moving it out of the dropzone;
+# recovery then only finishes the move instead of ingesting it again.
+STARTED = 'started'
+COMMITTED = 'committed'
+MOVED = 'moved'
+FAILED = 'failed'
+
+def create_journal_table(cursor):
+    """Create the ingest_journal table if it doesn't already exist."""
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS ingest_journal (
+        id INTEGER PRIMARY KEY,
+        file_hash TEXT NOT NULL,
+        account_name TEXT,
+        file_path TEXT,
+        state TEXT NOT NULL,
+        rows INTEGER,
+        recorded INTEGER
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS ingest_journal_file_hash_idx ON ingest_journal (file_hash, id)")
+
+def record(cursor, file_hash, account_name, file_path, state, rows=None):
+    """Append a state change; the caller commits it, together with the rows it covers for 'committed'."""
+    create_journal_table(cursor)
+    cursor.execute(
+        "INSERT INTO ingest_journal (file_hash, account_name, file_path, state, rows, recorded) VALUES (?, ?, ?, ?, ?, ?)",
+        (file_hash, account_name, file_path, state, rows, int(time.time()))
+    )
+
+def record_now(conn, file_hash, account_name, file_path, state, rows=None):
+    """Append a state change in its own transaction."""
+    try:
+        record(conn.cursor(), file_hash, account_name, file_path, state, rows)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def latest_state(cursor, file_hash, account_name):
+    """Return the latest state recorded for this file content in an account, None if it was never ingested."""
+    try:
+        row = cursor.execute(
+            "SELECT state FROM ingest_journal WHERE file_hash = ? AND account_name = ? ORDER BY id DESC LIMIT 1",
+            (file_hash, account_name)
+        ).fetchone()
+    except sqlite3.OperationalError as e:
+        # Databases nothing was ingested into since the journal was added lack the table
+        if 'no such table' not in str(e):
+            raise
+        return None
+    return row[0] if row else None
+
+def is_committed(cursor, file_hash, account_name):
+    """True if this file content was committed to the account and not moved out of the dropzone since."""
+    return latest_state(cursor, file_hash, account_name) == COMMITTED
+
+def unfinished(cursor):
+    """Return (file_hash, account_name, file_path, state, rows, recorded) of files whose latest state is not 'moved'."""
+    return cursor.execute("""
+        SELECT j.file_hash, j.account_name, j.file_path, j.state, j.rows, j.recorded
+        FROM ingest_journal j
+        WHERE j.id = (SELECT MAX(id) FROM ingest_journal WHERE file_hash = j.file_hash AND account_name = j.account_name)
+          AND j.state != ?
+        ORDER BY j.id
+    """, (MOVED,)).fetchall()
+
+def main():
+    parser = argparse.ArgumentParser(description="Show ingested files that were not moved to completed/, with their journal state.")
+    parser.add_argument('--db', type=str, default=DB_FILE, help="Path to the SQLite database.")
+    args = parser.parse_args()
+
+    with db.get_database(args.db).writer() as conn:
+        create_journal_table(conn.cursor())
+        rows = unfinished(conn.cursor())
+    for file_hash, account_name, file_path, state, rows_count, recorded in rows:
+        print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(recorded))} {state:9} {account_name:12} "
+              f"{rows_count if rows_count is not None else '-':>8} rows {file_hash[:12]} {file_path}")
+    print(f"{len(rows)} file(s) not moved to completed/")
+
+if __name__ == "__main__":
+    main()
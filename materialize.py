@@ -0,0 +1,163 @@
+import sqlite3
+import logging
+import argparse
+import db
+
+# Database file path
+DB_FILE = 'financials.db'
+
+# Materialized copy of the all_transactions view, only maintained once it has been built with --rebuild
+MATERIALIZED_TABLE = 'all_transactions_mat'
+
+# Per-account views unioned by all_transactions in views.sql
+SOURCE_VIEWS = [
+    'amexcc_view',
+    'amexsv_view',
+    'psecuch_view',
+    'psecucc_view',
+    'paypal_view',
+    'venmo_view',
+    'chasecc_view',
+    'citicc_view',
+    'chasemo_view',
+    'psecupe_view',
+    'psecuxd_view',
+    'psecudr_view',
+    'mint_view',
+    'amazon_view',
+]
+
+def create_materialized_table(cursor):
+    """Create the materialized all_transactions table and its indexes if they don't already exist."""
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {MATERIALIZED_TABLE} (
+        unique_hash BLOB PRIMARY KEY,
+        Account TEXT,
+        tx_epoch INTEGER,
+        tx_date TEXT,
+        tx_merchant TEXT,
+        tx_amount NUMERIC,
+        source_category TEXT,
+        tx_category TEXT,
+        tx_note TEXT,
+        created INTEGER,
+        merchant_key TEXT
+    )
+    """)
+    for column in ('tx_date', 'tx_merchant', 'Account', 'merchant_key'):
+        cursor.execute(
+            f'CREATE INDEX IF NOT EXISTS "{MATERIALIZED_TABLE}_{column.lower()}_idx" ON {MATERIALIZED_TABLE} ({column})'
+        )
+
+def is_enabled(cursor):
+    """Return True if the materialized table has been built and should be maintained."""
+    columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({MATERIALIZED_TABLE})").fetchall()]
+    if columns and 'merchant_key' not in columns:
+        # Built before merchant keys: stop maintaining it rather than fail every ingest
+        logging.warning(f"{MATERIALIZED_TABLE} is out of date, reload views.sql and run materialize.py --rebuild")
+        return False
+    return bool(columns)
+
+# tx_category of a per-account view row (aliased v) joined to its merchant (aliased m), the same logic as
+# the all_transactions view: the manual category, categorize.py's when it is confident (0.8 is
+# categorize.CONFIDENCE_THRESHOLD) and the LLM has none, then the source categories
+TX_CATEGORY = """COALESCE(
+        m.category,
+        CASE WHEN COALESCE(m.gpt_category, '') = '' AND m.auto_confidence >= 0.8 THEN m.auto_category END,
+        m.tx_category,
+        v.tx_category
+    )"""
+
+# Columns of the materialized table, in the order select_view produces them
+COLUMNS = ['unique_hash', 'Account', 'tx_epoch', 'tx_date', 'tx_merchant', 'tx_amount', 'source_category', 'tx_category',
+           'tx_note', 'created', 'merchant_key']
+
+def select_view(view_name, where='1'):
+    """Return the SELECT producing materialized rows (COLUMNS) from one per-account view (aliased v)."""
+    return f"""
+    SELECT
+        v.source_hash,
+        v.Account,
+        v.tx_date,
+        v.tx_local_date,
+        v.tx_merchant,
+        v.tx_amount,
+        v.tx_category,
+        {TX_CATEGORY},
+        v.tx_note,
+        v.created,
+        v.merchant_key
+    FROM {view_name} v
+    LEFT JOIN merchant m ON v.merchant_key = m.merchant_id
+    WHERE {where}
+    """
+
+def materialize_view(cursor, view_name, where='1', params=None):
+    """Upsert the rows of one per-account view matching a filter on the view (aliased v), keyed by unique_hash."""
+    query = f"INSERT OR REPLACE INTO {MATERIALIZED_TABLE} ({', '.join(COLUMNS)}) {select_view(view_name, where)}"
+    try:
+        cursor.execute(query, params or {})
+    except sqlite3.OperationalError as e:
+        # Views over accounts that have never been ingested reference missing tables
+        if 'no such table' not in str(e):
+            raise
+        logging.debug(f"Skipping '{view_name}': {e}")
+        return 0
+    return cursor.rowcount
+
+def refresh_account(cursor, account_name, since):
+    """Append or update the materialized rows contributed by an account's rows created at or after since.
+
+    amexcc_view's Amazon enrichment follows amazon_amex_link, so reconcile.py refreshes the rows it links.
+    """
+    view_name = f"{account_name}_view"
+    if view_name not in SOURCE_VIEWS:
+        return 0
+    return materialize_view(cursor, view_name, "v.created >= :since", {'since': since})
+
+def refresh_merchants(cursor, merchant_ids):
+    """Re-materialize the rows of the given merchants after their merchant table entries changed."""
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS refresh_merchant (merchant_id TEXT PRIMARY KEY)")
+    cursor.execute("DELETE FROM temp.refresh_merchant")
+    cursor.executemany("INSERT OR IGNORE INTO temp.refresh_merchant VALUES (?)", [(m,) for m in merchant_ids])
+    refreshed = sum(
+        materialize_view(cursor, view_name, "v.merchant_key IN (SELECT merchant_id FROM temp.refresh_merchant)")
+        for view_name in SOURCE_VIEWS
+    )
+    cursor.execute("DELETE FROM temp.refresh_merchant")
+    return refreshed
+
+def rebuild(db_file=DB_FILE):
+    """Drop and fully rebuild the materialized table, needed whenever views.sql changes."""
+    def rebuild_table(conn):
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f"DROP TABLE IF EXISTS {MATERIALIZED_TABLE}")
+            create_materialized_table(cursor)
+            total = 0
+            for view_name in SOURCE_VIEWS:
+                rows = materialize_view(cursor, view_name)
+                logging.info(f"Materialized {rows} rows from '{view_name}'")
+                total += rows
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return total
+
+    with db.get_database(db_file).writer() as conn:
+        return db.with_retry(rebuild_table, conn)
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Maintain the materialized all_transactions table.")
+    parser.add_argument('--db', type=str, default=DB_FILE, help="Path to the SQLite database.")
+    parser.add_argument('--rebuild', action='store_true', help="Drop and rebuild the table from the views.")
+    args = parser.parse_args()
+    if not args.rebuild:
+        parser.error("nothing to do, pass --rebuild to build the materialized table")
+    total = rebuild(args.db)
+    logging.info(f"Rebuilt {MATERIALIZED_TABLE} with {total} rows")
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,35 @@
 import sqlite3
+import os
 import logging
+import argparse
+import time
+import db
+import ingest_plan
+import materialize
+import merchant_keys
+import metrics
+import schema
 
 # Set up logging configuration
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # Database file path
 DB_FILE = 'financials.db'
+CONFIG_FILE = 'config.yaml'
 
-def create_merchant_table_if_not_exists():
+# Version 1 keys merchants by canonical merchant key instead of raw description
+MERCHANT_TABLE_VERSION = 1
+# Columns merged into the canonical merchant when raw description rows are folded into it
+MERCHANT_FIELDS = ['city', 'region', 'country', 'phone_number', 'url', 'category', 'tx_category', 'gpt_category']
+# Columns added after the table was first released; the auto_* ones hold categorize.py's results
+AUTO_COLUMNS = [('gpt_category', 'TEXT'), ('auto_category', 'TEXT'), ('auto_confidence', 'REAL'), ('auto_source', 'TEXT')]
+
+# Rows created this many seconds before the high-water mark are scanned again, so rows committed
+# by an ingest that was still running during the previous refresh are not missed
+REFRESH_OVERLAP_SECONDS = 300
+
+def create_merchant_table_if_not_exists(cursor):
     """Create the merchant table if it doesn't already exist, with an additional tx_category field."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
     create_table_query = """
     CREATE TABLE IF NOT EXISTS merchant (
         merchant_id TEXT PRIMARY KEY,
@@ -21,56 +39,339 @@ def create_merchant_table_if_not_exists():
         phone_number TEXT,
         url TEXT,
         category TEXT,
-        tx_category TEXT
+        tx_category TEXT,
+        gpt_category TEXT,
+        auto_category TEXT,
+        auto_confidence REAL,
+        auto_source TEXT
     )
     """
     cursor.execute(create_table_query)
-    conn.commit()
-    conn.close()
 
-def get_unique_merchants_with_categories():
-    """Fetch unique merchants with their categories from all_transactions view that are not already in the merchant table."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    select_query = """
-        SELECT tx_merchant AS merchant_id, GROUP_CONCAT(DISTINCT tx_category) AS tx_categories
-        FROM all_transactions 
-        WHERE tx_merchant NOT IN (SELECT merchant_id FROM merchant)
-        GROUP BY tx_merchant
+    # Tables created before merchant_meta.py stored gpt_category, or before categorize.py, lack the columns
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(merchant)").fetchall()]
+    for column, column_type in AUTO_COLUMNS:
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE merchant ADD COLUMN {column} {column_type}")
+
+    # Single row holding the created high-water mark of the last refresh
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS merchant_refresh (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        high_water INTEGER NOT NULL,
+        refreshed INTEGER
+    )
+    """)
+
+    # The merchant_rules signature each account's stored keys were last recomputed with
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS merchant_key_rules (
+        table_name TEXT PRIMARY KEY,
+        rules TEXT NOT NULL,
+        applied INTEGER
+    )
+    """)
+
+def create_rekey_table(cursor):
+    """Create or empty temp.merchant_rekey, the (old merchant_id, merchant_key) pairs fold_merchants folds."""
+    # DDL is not rolled back, so a failed pass on the shared writer leaves the table behind
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS merchant_rekey (merchant_id TEXT, merchant_key TEXT)")
+    cursor.execute("DELETE FROM temp.merchant_rekey")
+
+def select_views(cursor, query, params=()):
+    """Run a query once per per-account view ({view} in the query), skipping views over missing tables."""
+    for view_name in materialize.SOURCE_VIEWS:
+        try:
+            cursor.execute(query.format(view=view_name), params)
+        except sqlite3.OperationalError as e:
+            # Views over accounts that have never been ingested reference missing tables
+            if 'no such table' not in str(e):
+                raise
+
+def fold_merchants(cursor):
+    """Fold the merchants listed in temp.merchant_rekey into their new merchant keys.
+
+    Values already set on the new merchant win; empty ones are filled from the old
+    rows, which are then removed unless a transaction still carries their key. An
+    old merchant split over several new keys passes nothing on, as there is no
+    telling which of them its values described. Returns the new merchant keys.
     """
-    
-    cursor.execute(select_query)
-    result = cursor.fetchall()
-    conn.close()
-    return {row[0]: row[1] for row in result}
+    cursor.execute("""
+        INSERT OR IGNORE INTO merchant (merchant_id)
+        SELECT DISTINCT r.merchant_key FROM temp.merchant_rekey r JOIN merchant o ON o.merchant_id = r.merchant_id
+    """)
+    for field in MERCHANT_FIELDS:
+        cursor.execute(f"""
+            UPDATE merchant SET {field} = (
+                SELECT o.{field} FROM temp.merchant_rekey r JOIN merchant o ON o.merchant_id = r.merchant_id
+                WHERE r.merchant_key = merchant.merchant_id AND o.{field} IS NOT NULL
+                  AND r.merchant_id NOT IN (
+                      SELECT merchant_id FROM temp.merchant_rekey GROUP BY merchant_id HAVING COUNT(DISTINCT merchant_key) > 1
+                  )
+                ORDER BY o.merchant_id LIMIT 1
+            )
+            WHERE {field} IS NULL AND merchant_id IN (SELECT merchant_key FROM temp.merchant_rekey)
+        """)
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS merchant_in_use (merchant_key TEXT)")
+    cursor.execute("DELETE FROM temp.merchant_in_use")
+    select_views(cursor, """
+        INSERT INTO temp.merchant_in_use
+        SELECT DISTINCT merchant_key FROM {view} WHERE merchant_key IN (SELECT merchant_id FROM temp.merchant_rekey)
+    """)
+    cursor.execute("""
+        DELETE FROM merchant
+        WHERE merchant_id IN (SELECT merchant_id FROM temp.merchant_rekey)
+          AND merchant_id NOT IN (SELECT merchant_key FROM temp.merchant_in_use)
+    """)
+    folded = cursor.rowcount
+    cursor.execute("DELETE FROM temp.merchant_in_use")
+    merchant_ids = [row[0] for row in cursor.execute("SELECT DISTINCT merchant_key FROM temp.merchant_rekey")]
+    cursor.execute("DELETE FROM temp.merchant_rekey")
+    return folded, merchant_ids
 
+def rekey_merchants(cursor):
+    """Fold merchants stored under raw descriptions into their canonical merchant keys, once per database."""
+    schema.create_version_table(cursor)
+    if schema.get_table_version(cursor, 'merchant') >= MERCHANT_TABLE_VERSION:
+        return
 
-def insert_merchants(merchants_with_categories):
-    """Insert unique merchants into the merchant table with aggregated tx_category values."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
+    create_rekey_table(cursor)
+    select_views(cursor, """
+        INSERT INTO temp.merchant_rekey
+        SELECT DISTINCT tx_merchant, merchant_key FROM {view}
+        WHERE merchant_key IS NOT NULL AND tx_merchant != merchant_key
+          AND tx_merchant IN (SELECT merchant_id FROM merchant)
+    """)
+    folded, _ = fold_merchants(cursor)
+    logging.info(f"Folded {folded} raw description merchants into canonical merchant keys")
+    schema.set_table_version(cursor, 'merchant', MERCHANT_TABLE_VERSION)
+
+def account_tables(cursor):
+    """Return the account tables holding merchant keys, without their duplicate side tables."""
+    tables = [row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+    return [table for table in tables
+            if not table.endswith(ingest_plan.DUPLICATE_TABLE_SUFFIX)
+            and set(schema.ROW_COLUMNS) <= set(schema.get_table_columns(cursor, table))]
+
+def rekey_account(cursor, table, plan, since=0):
+    """Recompute the stored merchant keys of an account's rows created at or after since from its merchant column,
+    queueing changes in temp.merchant_rekey.
+
+    Keys only change where the account's merchant_rules did since the rows were stored;
+    every row sharing a changed description moves. Returns the number of descriptions
+    whose key changed.
+    """
+    column = plan.merchant_column
+    targets = [target for target in (table, table + ingest_plan.DUPLICATE_TABLE_SUFFIX) if schema.get_table_columns(cursor, target)]
+    cache = merchant_keys.KeyCache(plan.merchant_rules)
+    changed = {}
+    for target in targets:
+        for description, key in cursor.execute(f'SELECT DISTINCT "{column}", merchant_key FROM "{target}" WHERE "{column}" IS NOT NULL AND created >= ?', (since,)):
+            new_key = cache.key(description)
+            if new_key != key:
+                changed[description] = new_key
+    if not changed:
+        return 0
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS merchant_key_change (description TEXT PRIMARY KEY, merchant_key TEXT)")
+    cursor.execute("DELETE FROM temp.merchant_key_change")
+    cursor.executemany("INSERT INTO temp.merchant_key_change VALUES (?, ?)", changed.items())
+    for target in targets:
+        cursor.execute(f"""
+            INSERT INTO temp.merchant_rekey
+            SELECT DISTINCT t.merchant_key, c.merchant_key FROM "{target}" t
+            JOIN temp.merchant_key_change c ON c.description = t."{column}"
+            WHERE t.merchant_key != c.merchant_key
+        """)
+        cursor.execute(f"""
+            UPDATE "{target}" SET merchant_key = (
+                SELECT merchant_key FROM temp.merchant_key_change c WHERE c.description = "{target}"."{column}"
+            )
+            WHERE "{column}" IN (SELECT description FROM temp.merchant_key_change)
+        """)
+    cursor.execute("DELETE FROM temp.merchant_key_change")
+    return len(changed)
 
-    insert_query = """
-    INSERT OR IGNORE INTO merchant (merchant_id, tx_category) VALUES (?, ?)
+def recompute_merchant_keys(cursor, config_file=CONFIG_FILE, since=0):
+    """Move every account's stored merchant keys to the keys its current merchant_rules give its descriptions.
+
+    Only accounts whose rules changed since the last pass are scanned in full; the others
+    only check rows created at or after since, which an ingest run with another config
+    could have keyed differently. The rows, their duplicate side table, the merchant table and the materialized rows
+    all move to the new key; rows already exported keep the old key until a full export.
+    Returns the new keys of the merchants that moved.
+    """
+    plans = ingest_plan.load_plans(config_file) if config_file and os.path.exists(config_file) else {}
+    create_rekey_table(cursor)
+    changed_total = 0
+    for table in account_tables(cursor):
+        plan = plans.get(table)
+        # Accounts without a merchant column key rows in their view, there is nothing stored
+        if plan is None or plan.merchant_column not in schema.get_table_columns(cursor, table):
+            continue
+        signature = merchant_keys.rules_signature(plan.merchant_rules)
+        row = cursor.execute("SELECT rules FROM merchant_key_rules WHERE table_name = ?", (table,)).fetchone()
+        if row and row[0] == signature:
+            changed_total += rekey_account(cursor, table, plan, since)
+            continue
+        changed_total += rekey_account(cursor, table, plan)
+        cursor.execute(
+            "INSERT OR REPLACE INTO merchant_key_rules (table_name, rules, applied) VALUES (?, ?, ?)",
+            (table, signature, int(time.time()))
+        )
+    if not changed_total:
+        return []
+    _, merchant_ids = fold_merchants(cursor)
+    refresh_materialized_transactions(cursor, merchant_ids)
+    logging.info(f"Recomputed the merchant keys of {changed_total} descriptions")
+    return merchant_ids
+
+def get_high_water(cursor):
+    """Return the created high-water mark of the last refresh, 0 if there was none."""
+    row = cursor.execute("SELECT high_water FROM merchant_refresh WHERE id = 1").fetchone()
+    return row[0] if row else 0
+
+def set_high_water(cursor, high_water):
+    """Record the created high-water mark reached by a refresh."""
+    cursor.execute(
+        "INSERT OR REPLACE INTO merchant_refresh (id, high_water, refreshed) VALUES (1, ?, ?)",
+        (high_water, int(time.time()))
+    )
+
+def collect_merchant_categories(cursor, since, merchant_ids=()):
+    """Gather the distinct (merchant_key, tx_category) pairs of transactions created at or after since.
+
+    Each per-account view is scanned on its indexed created column rather than through
+    the sorted all_transactions view. Transactions of merchant_ids, the keys a rekey
+    just moved rows to, are gathered whenever they were created, on the indexed
+    merchant_key column. Returns the highest created value seen.
+    """
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS merchant_seen (merchant_key TEXT, tx_category TEXT)")
+    cursor.execute("DELETE FROM temp.merchant_seen")
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS merchant_collect (merchant_id TEXT PRIMARY KEY)")
+    cursor.execute("DELETE FROM temp.merchant_collect")
+    cursor.executemany("INSERT OR IGNORE INTO temp.merchant_collect VALUES (?)", [(merchant_id,) for merchant_id in merchant_ids])
+    high_water = since
+    for view_name in materialize.SOURCE_VIEWS:
+        try:
+            cursor.execute(f"""
+                INSERT INTO temp.merchant_seen
+                SELECT DISTINCT merchant_key, tx_category FROM {view_name}
+                WHERE created >= ? AND merchant_key IS NOT NULL
+            """, (since,))
+            if merchant_ids:
+                cursor.execute(f"""
+                    INSERT INTO temp.merchant_seen
+                    SELECT DISTINCT merchant_key, tx_category FROM {view_name}
+                    WHERE merchant_key IN (SELECT merchant_id FROM temp.merchant_collect)
+                """)
+            latest = cursor.execute(f"SELECT MAX(created) FROM {view_name} WHERE created >= ?", (since,)).fetchone()[0]
+        except sqlite3.OperationalError as e:
+            # Views over accounts that have never been ingested reference missing tables
+            if 'no such table' not in str(e):
+                raise
+            continue
+        if latest is not None:
+            high_water = max(high_water, latest)
+    cursor.execute("DELETE FROM temp.merchant_collect")
+    return high_water
+
+def get_unique_merchants_with_categories(cursor):
+    """Return {merchant_key: tx_categories} for collected merchants not yet in the merchant table.
+
+    An anti-join against the merchant primary key, over the collected pairs only.
     """
+    cursor.execute("""
+        SELECT s.merchant_key AS merchant_id, GROUP_CONCAT(DISTINCT s.tx_category) AS tx_categories
+        FROM temp.merchant_seen s
+        LEFT JOIN merchant m ON m.merchant_id = s.merchant_key
+        WHERE m.merchant_id IS NULL
+        GROUP BY s.merchant_key
+    """)
+    return {row[0]: row[1] for row in cursor.fetchall()}
+
+def merge_categories(existing, new):
+    """Append the categories of a comma-separated list that are missing from another, keeping its order."""
+    categories = [category for category in (existing or '').split(',') if category]
+    for category in (new or '').split(','):
+        if category and category not in categories:
+            categories.append(category)
+    return ','.join(categories) or None
+
+def get_changed_merchant_categories(cursor):
+    """Return {merchant_id: tx_categories} for existing merchants whose collected categories add new values."""
+    cursor.execute("""
+        SELECT m.merchant_id, m.tx_category, GROUP_CONCAT(DISTINCT s.tx_category)
+        FROM temp.merchant_seen s
+        JOIN merchant m ON m.merchant_id = s.merchant_key
+        -- amexcc_view reports the merchant's own category in place of the source category
+        WHERE s.tx_category IS NOT NULL AND s.tx_category IS NOT m.category
+        GROUP BY m.merchant_id
+    """)
+    changed = {}
+    for merchant_id, existing, seen in cursor.fetchall():
+        merged = merge_categories(existing, seen)
+        if merged != existing:
+            changed[merchant_id] = merged
+    return changed
 
-    for merchant_id, tx_categories in merchants_with_categories.items():
-        cursor.execute(insert_query, (merchant_id, tx_categories))
-        if cursor.rowcount > 0:  # rowcount will be 1 if the row was inserted
-            logging.info(f"Inserted merchant with ID {merchant_id} and categories {tx_categories}")
-    
-    conn.commit()
-    conn.close()
+def upsert_merchants(cursor, merchants_with_categories):
+    """Insert new merchants and update the tx_category of existing ones with a single executemany."""
+    cursor.executemany("""
+    INSERT INTO merchant (merchant_id, tx_category) VALUES (?, ?)
+    ON CONFLICT (merchant_id) DO UPDATE SET tx_category = excluded.tx_category
+    """, list(merchants_with_categories.items()))
+
+def refresh_materialized_transactions(cursor, merchant_ids):
+    """Update the categories of materialized transactions for inserted or updated merchants."""
+    if materialize.is_enabled(cursor):
+        refreshed = materialize.refresh_merchants(cursor, merchant_ids)
+        logging.info(f"Refreshed {refreshed} materialized transactions for {len(merchant_ids)} merchants")
+
+def refresh_merchants(conn, full=False, config_file=CONFIG_FILE):
+    """Recompute merchant keys, then add merchants and merge categories from transactions ingested since the last
+    refresh, in one transaction."""
+    cursor = conn.cursor()
+    try:
+        create_merchant_table_if_not_exists(cursor)
+        rekey_merchants(cursor)
+        since = 0 if full else max(get_high_water(cursor) - REFRESH_OVERLAP_SECONDS, 0)
+        with metrics.stage('merchant_rekey'):
+            rekeyed = recompute_merchant_keys(cursor, config_file, since)
+        with metrics.stage('merchant_collect'):
+            high_water = collect_merchant_categories(cursor, since, rekeyed)
+        with metrics.stage('merchant_anti_join'):
+            new_merchants = get_unique_merchants_with_categories(cursor)
+            changed_merchants = get_changed_merchant_categories(cursor)
+        cursor.execute("DELETE FROM temp.merchant_seen")
+
+        merchants_with_categories = {**changed_merchants, **new_merchants}
+        if merchants_with_categories:
+            with metrics.stage('merchant_upsert'):
+                upsert_merchants(cursor, merchants_with_categories)
+            with metrics.stage('merchant_materialize'):
+                refresh_materialized_transactions(cursor, list(merchants_with_categories))
+        set_high_water(cursor, max(high_water, get_high_water(cursor)))
+        metrics.timed_commit(conn, table='merchant')
+    except Exception:
+        conn.rollback()
+        raise
+    metrics.count('merchants_total', len(new_merchants), outcome='inserted')
+    metrics.count('merchants_total', len(changed_merchants), outcome='updated')
+    logging.info(f"Inserted {len(new_merchants)} merchants and merged new categories into {len(changed_merchants)}")
+    return merchants_with_categories
 
 def main():
-    create_merchant_table_if_not_exists()
-    
-    merchants_with_categories = get_unique_merchants_with_categories()
-    if not merchants_with_categories:
-        return
-    
-    insert_merchants(merchants_with_categories)
+    parser = argparse.ArgumentParser(description="Update the merchant table from newly ingested transactions.")
+    parser.add_argument('--db', type=str, default=DB_FILE, help="Path to the SQLite database.")
+    parser.add_argument('--full', action='store_true', help="Scan every transaction instead of those since the last run.")
+    parser.add_argument('--config', type=str, default=CONFIG_FILE, help="Path to the YAML configuration file (merchant_rules).")
+    parser.add_argument('--metrics-file', type=str, help="Write the refresh metrics here in Prometheus text format.")
+    args = parser.parse_args()
+
+    with db.get_database(args.db).writer() as conn:
+        db.with_retry(refresh_merchants, conn, args.full, args.config)
+    if args.metrics_file:
+        metrics.write_file(args.metrics_file)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,90 @@
+import json
+import re
+
+# Canonical merchant keys group description variants of the same merchant, e.g.
+# "AplPay STARBUCKS  #1234" and "STARBUCKS #998" both become "STARBUCKS".
+# Accounts can extend the defaults in config.yaml:
+#
+#   amexcc:
+#     merchant_rules:
+#       strip_patterns: ["^APLPAY "]   # regexes removed from the upper-cased description
+#       noise_tokens: ["STORE"]        # whole tokens dropped
+#       max_tokens: 4                  # keep at most this many leading tokens
+#       cluster_prefixes: ["UBER TRIP"]  # keys starting with one of these become it
+#
+# A key is a pure function of the description and the rules, so it never depends on the
+# order files arrived in. Prefixes only cluster when an account lists them: a shared
+# leading "POS PURCHASE" or "ACH DEBIT" says nothing about the merchant behind it.
+DEFAULT_STRIP_PATTERNS = [
+    r'^(SQ ?\*|TST ?\*|PAYPAL ?\*|PP ?\*|SP ?\*)\s*',  # payment processor prefixes
+    r'\b\d{3}[-.]\d{3}[-.]\d{4}\b',  # phone numbers
+    r'#\s*\w+',  # store and terminal numbers
+    r'\b\w*\d{3,}\w*\b',  # tokens carrying long digit runs (store ids, references)
+    r'[^\w&\' ]+',  # punctuation
+]
+DEFAULT_NOISE_TOKENS = []
+
+def compile_rules(config):
+    """Compile an account's merchant_rules on top of the defaults."""
+    rules = config.get('merchant_rules') or {}
+    patterns = DEFAULT_STRIP_PATTERNS[:-1] + list(rules.get('strip_patterns', [])) + DEFAULT_STRIP_PATTERNS[-1:]
+    return {
+        # Punctuation goes last so account patterns can still match it
+        'strip': [re.compile(pattern, re.IGNORECASE) for pattern in patterns],
+        'noise': {token.upper() for token in DEFAULT_NOISE_TOKENS + list(rules.get('noise_tokens', []))},
+        'max_tokens': rules.get('max_tokens'),
+        'prefixes': {tuple(prefix.upper().split()) for prefix in rules.get('cluster_prefixes', [])},
+    }
+
+def rules_signature(rules):
+    """Return compiled rules as stable text, which changes whenever the keys they give could."""
+    return json.dumps({
+        'strip': [pattern.pattern for pattern in rules['strip']],
+        'noise': sorted(rules['noise']),
+        'max_tokens': rules['max_tokens'],
+        'prefixes': sorted(' '.join(prefix) for prefix in rules['prefixes']),
+    })
+
+def tokenize(description, rules):
+    """Apply an account's rules to a description, returning the key tokens."""
+    text = description.upper()
+    for pattern in rules['strip']:
+        text = pattern.sub(' ', text)
+    tokens = [token for token in text.split() if token not in rules['noise']]
+    if rules['max_tokens']:
+        tokens = tokens[:rules['max_tokens']]
+    # The longest listed prefix wins, one set probe per token
+    for length in range(len(tokens), 0, -1):
+        if tuple(tokens[:length]) in rules['prefixes']:
+            return tuple(tokens[:length])
+    return tuple(tokens)
+
+def merchant_key(description, rules):
+    """Return the canonical key of a description, which depends only on the description and the account's rules."""
+    if not isinstance(description, str) or not description.strip():
+        return None
+    tokens = tokenize(description, rules)
+    if not tokens:
+        # Nothing survives the rules, fall back to the collapsed description
+        tokens = tuple(description.upper().split())
+    return ' '.join(tokens)
+
+class KeyCache:
+    """merchant_key for one account's rules, computed once per distinct description."""
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.cache = {}
+
+    def key(self, description):
+        if not isinstance(description, str):
+            return None
+        key = self.cache.get(description)
+        if key is None and description not in self.cache:
+            key = self.cache[description] = merchant_key(description, self.rules)
+        return key
+
+def build_key_map(descriptions, rules):
+    """Map every distinct description to its key."""
+    cache = KeyCache(rules)
+    return {description: cache.key(description) for description in set(descriptions) if isinstance(description, str)}
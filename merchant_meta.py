@@ -1,16 +1,14 @@
-import sqlite3
 import json
+import os
+import time
+import asyncio
+import argparse
+import categorize
+import db
+from collections import deque
 from langchain.prompts import PromptTemplate
 from langchain_openai import OpenAI
 
-print("hello")
-# Load OpenAI API key from file
-with open("openai_key.txt", "r") as key_file:
-    openai_api_key = key_file.read().strip()
-
-# Initialize the OpenAI LLM with the loaded key
-llm = OpenAI(openai_api_key=openai_api_key)
-
 # Define the system prompt to request JSON format
 template = """I will provide a list of merchant names. You will respond with a JSON array of objects, each object containing the following keys:
 - merchant (this value must exactly match the input value for merchant)
@@ -31,108 +29,297 @@ prompt = PromptTemplate(input_variables=["data"], template=template)
 
 # Database file path
 DB_FILE = 'financials.db'
+# Responses already paid for, keyed by normalized merchant name
+CACHE_FILE = 'merchant_meta_cache.db'
+OPENAI_KEY_FILE = 'openai_key.txt'
 
-def get_merchants_without_metadata(batch_size=3):
-    """Retrieve merchant IDs from the merchant table where metadata fields are empty."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT merchant_id FROM merchant
-        WHERE city IS NULL AND region IS NULL AND country IS NULL
-        LIMIT ?
-    """, (batch_size,))
-    
-    merchants = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    
-    return merchants
-
-def fetch_merchant_metadata(merchants, retry_limit=3):
-    """Fetch metadata for a list of merchants using the ChatGPT API, adjusting for response truncation and errors."""
-    all_metadata = []
-    retries = retry_limit
-
-    while retries > 0:
-        try:
-            merchant_data = "\n".join(merchants)
-            formatted_prompt = prompt.format(data=merchant_data)
-
-            print(f"DEBUG: Processing batch with {len(merchants)} merchants:\n{merchant_data}")
-            response = llm.invoke(formatted_prompt)
-            print(f"DEBUG: Received response length: {len(response)}")
-
-            if response.startswith("[") and response.endswith("]"):
-                json_data = json.loads(response)
-                
-                for item in json_data:
-                    all_metadata.append({
-                        "merchant_id": item.get("merchant", "").strip(),
-                        "city": item.get("city", "").strip(),
-                        "region": item.get("region", "").strip(),
-                        "country": item.get("country", "").strip(),
-                        "phone_number": item.get("phone_number", "").strip(),
-                        "url": item.get("URL", "").strip(),
-                        "gpt_category": item.get("gpt_category", "").strip()
-                    })
-                break
+# Pipeline defaults, all overridable on the command line
+CONCURRENCY = 8
+REQUESTS_PER_MINUTE = 60
+TOKENS_PER_MINUTE = 90000
+BATCH_SIZE = 10
+MAX_BATCH_SIZE = 25
+MAX_ATTEMPTS = 3
+# Completion budget reserved per merchant in a batch
+TOKENS_PER_MERCHANT = 80
+
+def create_llm(base_url=None):
+    """Create the OpenAI LLM, optionally pointed at another endpoint such as a local stub."""
+    openai_api_key = os.environ.get('OPENAI_API_KEY')
+    if not openai_api_key:
+        # Load OpenAI API key from file
+        with open(OPENAI_KEY_FILE, "r") as key_file:
+            openai_api_key = key_file.read().strip()
+    return OpenAI(openai_api_key=openai_api_key, base_url=base_url)
+
+def normalize_merchant(merchant):
+    """Return the cache key for a merchant name: upper case with collapsed whitespace."""
+    return ' '.join(merchant.upper().split())
+
+def estimate_tokens(text):
+    """Roughly estimate the number of tokens in a text (about four characters per token)."""
+    return len(text) // 4 + 1
+
+class RateLimiter:
+    """Keep requests and estimated tokens within per-minute budgets across concurrent batches."""
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.request_capacity = float(requests_per_minute)
+        self.token_capacity = float(tokens_per_minute)
+        self.requests = self.request_capacity
+        self.tokens = self.token_capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        self.requests = min(self.request_capacity, self.requests + elapsed * self.request_capacity / 60)
+        self.tokens = min(self.token_capacity, self.tokens + elapsed * self.token_capacity / 60)
+
+    async def acquire(self, tokens):
+        """Wait until one request and the given number of tokens fit in the budget, then take them."""
+        tokens = min(tokens, self.token_capacity)
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.requests >= 1 and self.tokens >= tokens:
+                    self.requests -= 1
+                    self.tokens -= tokens
+                    return
+                wait = max(
+                    (1 - self.requests) * 60 / self.request_capacity,
+                    (tokens - self.tokens) * 60 / self.token_capacity,
+                )
+                await asyncio.sleep(max(wait, 0.01))
+
+class BatchSizer:
+    """Adapt the batch size: halve it when a response comes back truncated, grow it back on success."""
+
+    def __init__(self, size, max_size):
+        self.size = size
+        self.max_size = max_size
+
+    def truncated(self):
+        self.size = max(1, self.size // 2)
+
+    def succeeded(self):
+        self.size = min(self.max_size, self.size + 1)
+
+def open_cache(cache_file=CACHE_FILE):
+    """Open the on-disk response cache, creating it if needed."""
+    conn = db.connect(cache_file)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS merchant_meta_cache (
+        merchant_key TEXT PRIMARY KEY,
+        response TEXT NOT NULL,
+        fetched INTEGER
+    )
+    """)
+    conn.commit()
+    return conn
+
+def get_cached(cache, merchant_keys):
+    """Return {merchant_key: response item} for the keys already in the cache."""
+    cached = {}
+    keys = list(merchant_keys)
+    for start in range(0, len(keys), 500):
+        chunk = keys[start:start + 500]
+        placeholders = ', '.join(['?'] * len(chunk))
+        rows = cache.execute(
+            f"SELECT merchant_key, response FROM merchant_meta_cache WHERE merchant_key IN ({placeholders})", chunk
+        ).fetchall()
+        cached.update((key, json.loads(response)) for key, response in rows)
+    return cached
+
+def put_cached(cache, items):
+    """Store response items keyed by normalized merchant name, committing right away."""
+    cache.executemany(
+        "INSERT OR REPLACE INTO merchant_meta_cache (merchant_key, response, fetched) VALUES (?, ?, ?)",
+        [(key, json.dumps(item), int(time.time())) for key, item in items.items()]
+    )
+    cache.commit()
+
+def get_merchants_without_metadata(batch_size=None):
+    """Retrieve merchant IDs from the merchant table where metadata fields are empty, all of them by default.
 
+    Merchants categorize.py already categorized with confidence are left out.
+    """
+    with db.get_database(DB_FILE).reader() as conn:
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(merchant)").fetchall()]
+        # Tables categorize.py has never run on lack the column
+        confident = "AND (auto_confidence IS NULL OR auto_confidence < ?)" if 'auto_confidence' in columns else ""
+        cursor = conn.execute(f"""
+            SELECT merchant_id FROM merchant
+            WHERE city IS NULL AND region IS NULL AND country IS NULL {confident}
+            LIMIT ?
+        """, ((categorize.CONFIDENCE_THRESHOLD,) if confident else ()) + (batch_size if batch_size is not None else -1,))
+        return [row[0] for row in cursor.fetchall()]
+
+def parse_response(response):
+    """Parse a JSON array response into {normalized merchant: item}, None if it is truncated or malformed."""
+    response = response.strip()
+    if not (response.startswith("[") and response.endswith("]")):
+        return None
+    try:
+        json_data = json.loads(response)
+    except json.JSONDecodeError:
+        return None
+    return {
+        normalize_merchant(item.get("merchant", "")): item
+        for item in json_data if isinstance(item, dict)
+    }
+
+def to_metadata(merchant_id, item):
+    """Map a response item to the merchant table columns."""
+    return {
+        "merchant_id": merchant_id,
+        "city": (item.get("city") or "").strip(),
+        "region": (item.get("region") or "").strip(),
+        "country": (item.get("country") or "").strip(),
+        "phone_number": (item.get("phone_number") or "").strip(),
+        "url": (item.get("URL") or "").strip(),
+        "gpt_category": (item.get("gpt_category") or "").strip()
+    }
+
+async def fetch_batch(llm, limiter, merchants):
+    """Fetch metadata for one batch of merchants, returning parsed items or None when truncated."""
+    merchant_data = "\n".join(merchants)
+    formatted_prompt = prompt.format(data=merchant_data)
+    max_tokens = TOKENS_PER_MERCHANT * len(merchants)
+    await limiter.acquire(estimate_tokens(formatted_prompt) + max_tokens)
+    print(f"DEBUG: Processing batch with {len(merchants)} merchants")
+    response = await llm.ainvoke(formatted_prompt, max_tokens=max_tokens)
+    return parse_response(response)
+
+async def enrich_merchants(merchants, llm, cache, concurrency=CONCURRENCY, requests_per_minute=REQUESTS_PER_MINUTE,
+                           tokens_per_minute=TOKENS_PER_MINUTE, batch_size=BATCH_SIZE, max_batch_size=MAX_BATCH_SIZE):
+    """Fetch metadata for merchants not in the cache with concurrent, rate-limited batches.
+
+    Every parsed response is written to the cache as soon as it arrives. Truncated
+    responses shrink the batch size and requeue the batch, merchants missing from a
+    response or failing alone are retried up to MAX_ATTEMPTS times. Returns
+    {merchant_id: response item}.
+    """
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    sizer = BatchSizer(batch_size, max_batch_size)
+    pending = deque(merchants)
+    attempts = {merchant: 0 for merchant in merchants}
+    results = {}
+
+    def retry(batch):
+        for merchant in batch:
+            attempts[merchant] += 1
+            if attempts[merchant] < MAX_ATTEMPTS:
+                pending.append(merchant)
             else:
+                print(f"ERROR: Giving up on merchant '{merchant}' after {MAX_ATTEMPTS} attempts")
+
+    async def worker():
+        while pending:
+            batch = [pending.popleft() for _ in range(min(sizer.size, len(pending)))]
+            try:
+                items = await fetch_batch(llm, limiter, batch)
+            except Exception as e:
+                print(f"ERROR: Exception occurred: {e}")
+                retry(batch)
+                await asyncio.sleep(1)
+                continue
+
+            if items is None:
                 print("DEBUG: Response truncated or malformed. Retrying with fewer merchants.")
-                merchants = merchants[:len(merchants) - 1]  # Reduce the list size for retrying
+                sizer.truncated()
+                if len(batch) == 1:
+                    retry(batch)
+                else:
+                    # The batch was too large, not the merchants' fault: requeue without using up an attempt
+                    pending.extend(batch)
+                continue
 
-        except json.JSONDecodeError:
-            print("ERROR: JSON decoding failed. Retrying...")
-            retries -= 1
-        
-        except Exception as e:
-            print(f"ERROR: Exception occurred: {e}")
-            retries -= 1
+            found = {normalize_merchant(merchant): merchant for merchant in batch if normalize_merchant(merchant) in items}
+            put_cached(cache, {key: items[key] for key in found})
+            results.update((merchant, items[key]) for key, merchant in found.items())
+            missing = [merchant for merchant in batch if normalize_merchant(merchant) not in found]
+            if missing:
+                retry(missing)
+            else:
+                sizer.succeeded()
 
-    return all_metadata
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return results
 
 def update_merchant_metadata(metadata_list):
-    """Update merchant table with metadata for each merchant."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
+    """Update merchant table with metadata for each merchant in one transaction."""
     update_query = """
     UPDATE merchant
     SET city = ?, region = ?, country = ?, phone_number = ?, url = ?, gpt_category = ?
     WHERE merchant_id = ?
     """
-    
-    for metadata in metadata_list:
-        print(f"DEBUG: Updating metadata for merchant ID: {metadata['merchant_id']}")
-        cursor.execute(update_query, (
-            metadata['city'],
-            metadata['region'],
-            metadata['country'],
-            metadata['phone_number'],
-            metadata['url'],
-            metadata['gpt_category'],
-            metadata['merchant_id']
-        ))
-    
-    conn.commit()
+    rows = [(
+        metadata['city'],
+        metadata['region'],
+        metadata['country'],
+        metadata['phone_number'],
+        metadata['url'],
+        metadata['gpt_category'],
+        metadata['merchant_id']
+    ) for metadata in metadata_list]
+
+    def write(conn):
+        try:
+            conn.executemany(update_query, rows)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    with db.get_database(DB_FILE).writer() as conn:
+        db.with_retry(write, conn)
     print(f"DEBUG: Finished updating merchant metadata. Total rows updated: {len(metadata_list)}")
-    conn.close()
 
-print("Script started")  # Ensure this is the very first line in the file
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Enrich merchants with metadata from the LLM.")
+    parser.add_argument('--limit', type=int, default=None, help="Only enrich this many merchants.")
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY, help="Batches in flight at once.")
+    parser.add_argument('--requests-per-minute', type=int, default=REQUESTS_PER_MINUTE, help="Request budget.")
+    parser.add_argument('--tokens-per-minute', type=int, default=TOKENS_PER_MINUTE, help="Estimated token budget.")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="Initial merchants per request.")
+    parser.add_argument('--max-batch-size', type=int, default=MAX_BATCH_SIZE, help="Largest batch size to grow to.")
+    parser.add_argument('--base-url', type=str, default=None, help="OpenAI-compatible endpoint, e.g. a local stub.")
+    parser.add_argument('--cache', type=str, default=CACHE_FILE, help="Path to the response cache database.")
+    args = parser.parse_args(argv)
 
-def main():
     print("Starting main function in merchant_meta.py")
-    merchants = get_merchants_without_metadata()
-    print(f"Retrieved merchants without metadata: {merchants}")
+    merchants = get_merchants_without_metadata(args.limit)
+    print(f"Retrieved {len(merchants)} merchants without metadata")
     if not merchants:
         print("DEBUG: No merchants found without metadata.")
         return
-    
-    # Fetch metadata using ChatGPT for merchants
-    merchant_data = fetch_merchant_metadata(merchants)
-    print(f"Fetched merchant metadata: {merchant_data}")
-    if merchant_data:
-        update_merchant_metadata(merchant_data)
+
+    cache = open_cache(args.cache)
+    try:
+        cached = get_cached(cache, {normalize_merchant(merchant) for merchant in merchants})
+        results = {merchant: cached[normalize_merchant(merchant)]
+                   for merchant in merchants if normalize_merchant(merchant) in cached}
+        uncached = [merchant for merchant in merchants if merchant not in results]
+        print(f"DEBUG: {len(results)} merchants served from cache, {len(uncached)} to fetch")
+
+        if uncached:
+            # Fetch metadata using ChatGPT for merchants
+            results.update(asyncio.run(enrich_merchants(
+                uncached, create_llm(args.base_url), cache,
+                concurrency=args.concurrency,
+                requests_per_minute=args.requests_per_minute,
+                tokens_per_minute=args.tokens_per_minute,
+                batch_size=args.batch_size,
+                max_batch_size=args.max_batch_size,
+            )))
+    finally:
+        cache.close()
+
+    if results:
+        update_merchant_metadata([to_metadata(merchant, item) for merchant, item in results.items()])
     else:
         print("DEBUG: No metadata returned for merchants.")
 
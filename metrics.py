@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import fnmatch
+import logging
+import cProfile
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Structured events are JSON lines on this logger
+EVENT_LOGGER = 'findb.events'
+PREFIX = 'findb_'
+# Upper bounds in seconds of the histogram buckets stage and commit timings are counted into
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+# A glob matched against a CSV file name switches cProfile on for that file
+PROFILE_ENV = 'FINDB_PROFILE'
+PROFILE_DIR = 'profiles'
+
+_lock = threading.Lock()
+_counters = {}  # (name, labels) -> value
+_gauges = {}  # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+_help = {}
+_event_logger = logging.getLogger(EVENT_LOGGER)
+# Events go only to the handlers configure_event_log adds, not to the scripts' console logging
+_event_logger.propagate = False
+
+def _key(name, labels):
+    return PREFIX + name, tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+def describe(name, text):
+    """Set the HELP text of a metric."""
+    _help[PREFIX + name] = text
+
+def count(name, value=1, **labels):
+    """Add to a counter."""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def gauge(name, value, **labels):
+    """Set a gauge to its current value."""
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+def observe(name, seconds, **labels):
+    """Count a duration into a histogram."""
+    key = _key(name, labels)
+    with _lock:
+        values = _histograms.setdefault(key, [0] * (len(BUCKETS) + 2))
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                values[i] += 1
+        values[-2] += seconds
+        values[-1] += 1
+
+def event(name, **fields):
+    """Log a structured event as one JSON line."""
+    _event_logger.info(json.dumps({'ts': round(time.time(), 3), 'event': name, **fields}, default=str))
+
+@contextmanager
+def stage(name, **labels):
+    """Time a stage into findb_stage_seconds{stage=name, ...} and log it as a stage event."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        observe('stage_seconds', seconds, stage=name, **labels)
+        event('stage', stage=name, seconds=round(seconds, 6), **labels)
+
+class StageTimer:
+    """Accumulates a stage repeated inside a loop, recorded once as a single observation."""
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+        self.seconds = 0.0
+        self.started = None
+
+    def start(self):
+        self.started = time.perf_counter()
+
+    def stop(self):
+        self.seconds += time.perf_counter() - self.started
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def record(self):
+        observe('stage_seconds', self.seconds, stage=self.name, **self.labels)
+        event('stage', stage=self.name, seconds=round(self.seconds, 6), **self.labels)
+
+def timed_commit(conn, **labels):
+    """Commit and record the latency into findb_commit_seconds."""
+    started = time.perf_counter()
+    conn.commit()
+    observe('commit_seconds', time.perf_counter() - started, **labels)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+def render():
+    """Return every metric in the Prometheus text exposition format."""
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        histograms = {key: list(values) for key, values in _histograms.items()}
+    lines = []
+    for metric_type, series in (('counter', counters), ('gauge', gauges), ('histogram', histograms)):
+        for name in sorted({name for name, _ in series}):
+            if name in _help:
+                lines.append(f'# HELP {name} {_help[name]}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for (series_name, labels), value in sorted(series.items()):
+                if series_name != name:
+                    continue
+                if metric_type != 'histogram':
+                    lines.append(f'{name}{_format_labels(labels)} {value}')
+                    continue
+                # Bucket counts are cumulative already, each observation counts into every bucket it fits
+                for bound, bucket_count in zip(BUCKETS, value):
+                    lines.append(f'{name}_bucket{_format_labels(labels, [("le", bound)])} {bucket_count}')
+                lines.append(f'{name}_bucket{_format_labels(labels, [("le", "+Inf")])} {value[-1]}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {round(value[-2], 6)}')
+                lines.append(f'{name}_count{_format_labels(labels)} {value[-1]}')
+    return '\n'.join(lines) + '\n'
+
+def write_file(metrics_file):
+    """Write the metrics for a node-exporter textfile collector, replacing the file atomically."""
+    partial_file = metrics_file + '.partial'
+    with open(partial_file, 'w') as f:
+        f.write(render())
+    os.replace(partial_file, metrics_file)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves GET /metrics."""
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(port, host='127.0.0.1'):
+    """Serve /metrics from a daemon thread, returning the server."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
+
+def configure_event_log(event_log_file):
+    """Append structured events to a file in addition to any other handlers."""
+    handler = logging.FileHandler(event_log_file)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    _event_logger.addHandler(handler)
+    _event_logger.setLevel(logging.INFO)
+
+def should_profile(csv_file, pattern=None):
+    """Return True if the file name matches the profile pattern (by default the FINDB_PROFILE environment variable)."""
+    pattern = os.environ.get(PROFILE_ENV) if pattern is None else pattern
+    return bool(pattern) and fnmatch.fnmatch(os.path.basename(csv_file), pattern)
+
+@contextmanager
+def profiled(csv_file, label, enabled=None, profile_dir=PROFILE_DIR):
+    """Run the block under cProfile if enabled for this file, dumping stats to profile_dir.
+
+    cProfile only follows the calling thread, so the service profiles the prepare and
+    write halves of a file separately, each labelled.
+    """
+    if enabled is None:
+        enabled = should_profile(csv_file)
+    if not enabled:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(profile_dir, exist_ok=True)
+        profile_file = os.path.join(profile_dir, f"{os.path.basename(csv_file)}.{label}.{time.strftime('%Y%m%d%H%M%S')}.prof")
+        profiler.dump_stats(profile_file)
+        event('profile_written', csv_file=csv_file, label=label, profile_file=profile_file)
+
+describe('stage_seconds', 'Time spent per ingest, merchant and service stage.')
+describe('commit_seconds', 'SQLite commit latency.')
+describe('rows_total', 'CSV rows processed per account by outcome (inserted, duplicate, skipped).')
+describe('files_total', 'Dropzone files processed by outcome.')
+describe('queue_depth', 'Files waiting in the ingest pipeline by state.')
+describe('exported_rows_total', 'Transactions written to the columnar export by export.py.')
+describe('links_total', 'Amazon orders linked to Amex charges by reconcile.py.')
+describe('merchants_total', 'Merchants written by the merchant refresh by outcome (inserted, updated).')
+describe('categorized_total', 'Merchants categorized by categorize.py by outcome (rule, model, llm when left for the LLM).')
@@ -0,0 +1,211 @@
+import os
+import sys
+import csv
+import json
+import base64
+import sqlite3
+import argparse
+import threading
+from collections import OrderedDict
+from heapq import merge
+import db
+import ingest_plan
+import materialize
+import merchant_keys
+import row_keys
+
+# Database file path
+DB_FILE = 'financials.db'
+CONFIG_FILE = 'config.yaml'
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 10000
+# Pages kept per database; the cache is dropped whenever anything commits to the file
+CACHE_SIZE = 256
+
+# Source account of each per-account view, e.g. psecupe_view reports its rows as 'psecuch' in Account
+SOURCE_ACCOUNTS = {view_name[:-len('_view')]: view_name for view_name in materialize.SOURCE_VIEWS}
+
+COLUMNS = ['unique_hash', 'source', 'account', 'tx_date', 'tx_epoch', 'tx_merchant', 'tx_amount', 'tx_category',
+           'tx_note', 'merchant_key']
+
+def encode_cursor(tx_date, unique_hash):
+    """Return the opaque cursor for the page after the row with this keyset position."""
+    return base64.urlsafe_b64encode(json.dumps([tx_date, row_keys.to_hex(unique_hash)]).encode()).decode()
+
+def decode_cursor(cursor):
+    """Return the (tx_date, unique_hash) position of a cursor from encode_cursor."""
+    try:
+        tx_date, unique_hash = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return tx_date, row_keys.from_hex(unique_hash)
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor '{cursor}'") from e
+
+def normalize_merchant_key(merchant, plan=None):
+    """Return the key a merchant filter matches in an account: the key ingest stores for it under the
+    account's merchant_rules, the default rules without a plan."""
+    rules = plan.merchant_rules if plan else merchant_keys.compile_rules({})
+    return merchant_keys.merchant_key(merchant, rules)
+
+def view_query(view_name, source, filters):
+    """Build the page query of one per-account view, with every filter pushed down into its WHERE clause.
+
+    The views are simple selects over their account table, so SQLite flattens them and
+    the date range and keyset position seek the (tx_local_date, unique_hash) index.
+    """
+    where = ["v.tx_local_date IS NOT NULL"]
+    if filters.get('start'):
+        where.append("v.tx_local_date >= :start")
+    if filters.get('end'):
+        where.append("v.tx_local_date <= :end")
+    if filters.get('merchant'):
+        where.append("v.merchant_key = :merchant")
+    if filters.get('category'):
+        where.append(f"{materialize.TX_CATEGORY} = :category")
+    if filters.get('after'):
+        where.append("(v.tx_local_date, v.source_hash) > (:after_date, :after_hash)")
+    return f"""
+    SELECT
+        v.source_hash,
+        '{source}',
+        v.Account,
+        v.tx_local_date,
+        v.tx_date,
+        v.tx_merchant,
+        v.tx_amount,
+        {materialize.TX_CATEGORY},
+        v.tx_note,
+        v.merchant_key
+    FROM {view_name} v
+    LEFT JOIN merchant m ON v.merchant_key = m.merchant_id
+    WHERE {' AND '.join(where)}
+    ORDER BY v.tx_local_date, v.source_hash
+    LIMIT :limit
+    """
+
+def fetch_page(conn, accounts=None, start=None, end=None, merchant=None, category=None, after=None, limit=DEFAULT_LIMIT,
+               config_file=CONFIG_FILE):
+    """Return one page of transactions ordered by (tx_date, unique_hash) and the cursor of the next page.
+
+    Each selected account's view is asked for at most limit + 1 rows past the cursor
+    and the sorted results are merged, so no query sorts the whole union. A merchant
+    filter is keyed per account with the merchant_rules of config_file.
+    """
+    unknown = [account for account in accounts or [] if account not in SOURCE_ACCOUNTS]
+    if unknown:
+        raise ValueError(f"Unknown accounts {unknown}, expected some of {sorted(SOURCE_ACCOUNTS)}")
+    if not 0 < limit <= MAX_LIMIT:
+        raise ValueError(f"limit must be between 1 and {MAX_LIMIT}")
+    filters = {'start': start, 'end': end, 'merchant': merchant, 'category': category, 'after': after}
+    params = {key: value for key, value in filters.items() if key != 'after'}
+    params['limit'] = limit + 1
+    if after:
+        params['after_date'], params['after_hash'] = decode_cursor(after)
+    plans = ingest_plan.load_plans(config_file) if merchant and os.path.exists(config_file) else {}
+
+    results = []
+    for source in accounts or SOURCE_ACCOUNTS:
+        if merchant:
+            params['merchant'] = normalize_merchant_key(merchant, plans.get(source))
+        try:
+            results.append(conn.execute(view_query(SOURCE_ACCOUNTS[source], source, filters), params).fetchall())
+        except sqlite3.OperationalError as e:
+            # Views over accounts that have never been ingested reference missing tables
+            if 'no such table' not in str(e):
+                raise
+    rows = []
+    for row in merge(*results, key=lambda row: (row[3], row_keys.sort_key(row[0]))):
+        rows.append(row)
+        if len(rows) > limit:
+            break
+    next_cursor = encode_cursor(rows[limit - 1][3], rows[limit - 1][0]) if len(rows) > limit else None
+    return [dict(zip(COLUMNS, (row_keys.to_hex(row[0]),) + row[1:])) for row in rows[:limit]], next_cursor
+
+class TransactionQuery:
+    """Filtered, paginated reads from the read pool with an LRU cache of pages.
+
+    The cache is keyed by the database's data_version, which changes whenever any
+    connection commits, so pages never outlive the rows ingested after them.
+    """
+
+    def __init__(self, db_file=DB_FILE, cache_size=CACHE_SIZE, config_file=CONFIG_FILE):
+        self.database = db.get_database(db_file)
+        self.config_file = config_file
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.cache_version = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def page(self, accounts=None, start=None, end=None, merchant=None, category=None, after=None, limit=DEFAULT_LIMIT):
+        """Return (rows, next_cursor) for the filters, from the cache if nothing was committed since."""
+        key = (tuple(sorted(accounts)) if accounts else None, start, end, merchant, category, after, limit)
+        version = self.database.data_version()
+        with self.lock:
+            if version != self.cache_version:
+                self.cache.clear()
+                self.cache_version = version
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return self.cache[key]
+            self.misses += 1
+        with self.database.reader() as conn:
+            conn.execute("BEGIN")  # every view is read from the same snapshot
+            result = fetch_page(conn, accounts, start, end, merchant, category, after, limit, self.config_file)
+        with self.lock:
+            # A commit during the read leaves this page keyed to the old version, never served again
+            if version == self.cache_version:
+                self.cache[key] = result
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return result
+
+    def iter_rows(self, **filters):
+        """Yield every matching transaction, one page at a time."""
+        after = filters.pop('after', None)
+        while True:
+            rows, after = self.page(after=after, **filters)
+            yield from rows
+            if after is None:
+                return
+
+def main():
+    parser = argparse.ArgumentParser(description="Query transactions with filters and keyset pagination.")
+    parser.add_argument('--db', type=str, default=DB_FILE, help="Path to the SQLite database.")
+    parser.add_argument('--config', type=str, default=CONFIG_FILE, help="Path to the YAML configuration file (merchant_rules).")
+    parser.add_argument('--account', action='append', choices=sorted(SOURCE_ACCOUNTS),
+                        help="Only this source account, may be repeated.")
+    parser.add_argument('--start', type=str, help="First transaction date, YYYY-MM-DD (Eastern Time).")
+    parser.add_argument('--end', type=str, help="Last transaction date, YYYY-MM-DD (Eastern Time).")
+    parser.add_argument('--merchant', type=str, help="Merchant, as a key ('STARBUCKS') or a description ('SQ *STARBUCKS #1234').")
+    parser.add_argument('--category', type=str, help="Transaction category.")
+    parser.add_argument('--limit', type=int, default=DEFAULT_LIMIT, help="Rows per page.")
+    parser.add_argument('--after', type=str, help="Cursor printed by the previous page.")
+    parser.add_argument('--all', action='store_true', help="Follow cursors and print every matching row.")
+    parser.add_argument('--csv', action='store_true', help="Print CSV instead of JSON lines.")
+    args = parser.parse_args()
+
+    query = TransactionQuery(args.db, config_file=args.config)
+    filters = {'accounts': args.account, 'start': args.start, 'end': args.end, 'merchant': args.merchant,
+               'category': args.category, 'limit': args.limit}
+    if args.all:
+        rows, next_cursor = query.iter_rows(after=args.after, **filters), None
+    else:
+        rows, next_cursor = query.page(after=args.after, **filters)
+
+    writer = csv.DictWriter(sys.stdout, fieldnames=COLUMNS) if args.csv else None
+    if writer:
+        writer.writeheader()
+    for row in rows:
+        if writer:
+            writer.writerow(row)
+        else:
+            print(json.dumps(row))
+    if next_cursor:
+        # On stderr so the rows stay machine-readable
+        print(f"Next page: --after {next_cursor}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
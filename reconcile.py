@@ -0,0 +1,207 @@
+import sqlite3
+import logging
+import argparse
+import time
+import db
+import materialize
+import metrics
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Database file path
+DB_FILE = 'financials.db'
+
+# Amazon orders are linked to the Amex charges they produced, so amexcc_view can show what was bought.
+# A charge matches an order of the same amount in cents posted on the order's Eastern Time date or up
+# to MATCH_WINDOW_DAYS later, since Amazon charges when the order ships. The closest day wins, and each
+# charge and each order is linked at most once.
+LINK_TABLE = 'amazon_amex_link'
+MATCH_WINDOW_DAYS = 7
+CHARGE_TABLE = 'amexcc'
+CHARGE_AMOUNT = 'Amount'
+ORDER_TABLE = 'amazon'
+ORDER_AMOUNT = '"Total Owed"'
+
+# Rows created this many seconds before the high-water mark are matched again, like the merchant refresh
+RECONCILE_OVERLAP_SECONDS = 300
+
+def cents(table_alias, amount_column):
+    """SQL for an amount in integer cents, identical to the expression the key indexes are built on."""
+    prefix = f"{table_alias}." if table_alias else ""
+    return f"CAST(ROUND({prefix}{amount_column} * 100) AS INTEGER)"
+
+def create_link_tables(cursor):
+    """Create the link table and the refresh high-water table."""
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {LINK_TABLE} (
+        amex_hash BLOB PRIMARY KEY,
+        amazon_hash BLOB NOT NULL UNIQUE,
+        amount_cents INTEGER NOT NULL,
+        lag_days INTEGER NOT NULL,
+        linked INTEGER NOT NULL
+    )
+    """)
+    # Single row holding the created high-water mark of the last reconciliation
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS reconcile_refresh (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        high_water INTEGER NOT NULL,
+        refreshed INTEGER
+    )
+    """)
+
+def create_key_index(cursor, table_name):
+    """Create the (cents, day) key index of the charge or order table, if it exists."""
+    amount_column = {CHARGE_TABLE: CHARGE_AMOUNT, ORDER_TABLE: ORDER_AMOUNT}[table_name]
+    try:
+        cursor.execute(
+            f'CREATE INDEX IF NOT EXISTS "{table_name}_amount_cents_day_idx" '
+            f'ON "{table_name}" ({cents(None, amount_column)}, tx_local_date)'
+        )
+    except sqlite3.OperationalError as e:
+        # Accounts that have never been ingested have no table yet
+        if 'no such table' not in str(e):
+            raise
+
+def create_reconcile_tables(cursor):
+    """Create the link table, the refresh high-water table and the (cents, day) key indexes."""
+    create_link_tables(cursor)
+    for table_name in (CHARGE_TABLE, ORDER_TABLE):
+        create_key_index(cursor, table_name)
+
+def get_high_water(cursor):
+    """Return the created high-water mark of the last reconciliation, 0 if there was none."""
+    row = cursor.execute("SELECT high_water FROM reconcile_refresh WHERE id = 1").fetchone()
+    return row[0] if row else 0
+
+def set_high_water(cursor, high_water):
+    """Record the created high-water mark reached by a reconciliation."""
+    cursor.execute(
+        "INSERT OR REPLACE INTO reconcile_refresh (id, high_water, refreshed) VALUES (1, ?, ?)",
+        (high_water, int(time.time()))
+    )
+
+def tables_exist(cursor):
+    """Return True once both the charge and the order table have been created."""
+    found = cursor.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name IN (?, ?)", (CHARGE_TABLE, ORDER_TABLE)
+    ).fetchone()[0]
+    return found == 2
+
+def find_candidates(cursor, since):
+    """Return (amex_hash, amazon_hash, cents, lag_days) for unlinked pairs where either row was created at or after since.
+
+    Both sides are probed through the (cents, tx_local_date) index of the other table:
+    an equality on cents and a date range, never an expression over every row.
+    """
+    unlinked = f"""
+        AND (c.Tags != 'duplicate' OR c.Tags IS NULL) AND (o.Tags != 'duplicate' OR o.Tags IS NULL)
+        AND NOT EXISTS (SELECT 1 FROM {LINK_TABLE} l WHERE l.amex_hash = c.unique_hash)
+        AND NOT EXISTS (SELECT 1 FROM {LINK_TABLE} l WHERE l.amazon_hash = o.unique_hash)
+    """
+    lag = "CAST(julianday(c.tx_local_date) - julianday(o.tx_local_date) AS INTEGER)"
+    params = {'since': since, 'window': f'+{MATCH_WINDOW_DAYS} days', 'back': f'-{MATCH_WINDOW_DAYS} days'}
+    # New orders against every charge in their window
+    cursor.execute(f"""
+        SELECT c.unique_hash, o.unique_hash, {cents('o', ORDER_AMOUNT)}, {lag}
+        FROM "{ORDER_TABLE}" o
+        JOIN "{CHARGE_TABLE}" c
+          ON {cents('c', CHARGE_AMOUNT)} = {cents('o', ORDER_AMOUNT)}
+         AND c.tx_local_date BETWEEN o.tx_local_date AND date(o.tx_local_date, :window)
+        WHERE o.created >= :since {unlinked}
+    """, params)
+    candidates = set(cursor.fetchall())
+    # New charges against every order in their window
+    cursor.execute(f"""
+        SELECT c.unique_hash, o.unique_hash, {cents('c', CHARGE_AMOUNT)}, {lag}
+        FROM "{CHARGE_TABLE}" c
+        JOIN "{ORDER_TABLE}" o
+          ON {cents('o', ORDER_AMOUNT)} = {cents('c', CHARGE_AMOUNT)}
+         AND o.tx_local_date BETWEEN date(c.tx_local_date, :back) AND c.tx_local_date
+        WHERE c.created >= :since {unlinked}
+    """, params)
+    candidates.update(cursor.fetchall())
+    return candidates
+
+def assign_links(candidates):
+    """Pick one-to-one links from candidate pairs, closest day first, deterministically on ties."""
+    links = []
+    linked_charges = set()
+    linked_orders = set()
+    for amex_hash, amazon_hash, amount_cents, lag_days in sorted(candidates, key=lambda c: (c[3], c[0], c[1])):
+        if amex_hash in linked_charges or amazon_hash in linked_orders:
+            continue
+        linked_charges.add(amex_hash)
+        linked_orders.add(amazon_hash)
+        links.append((amex_hash, amazon_hash, amount_cents, lag_days))
+    return links
+
+def insert_links(cursor, links):
+    """Store new links."""
+    linked = int(time.time())
+    cursor.executemany(
+        f"INSERT INTO {LINK_TABLE} (amex_hash, amazon_hash, amount_cents, lag_days, linked) VALUES (?, ?, ?, ?, ?)",
+        [link + (linked,) for link in links]
+    )
+
+def refresh_materialized_charges(cursor, links, full):
+    """Re-materialize the amexcc_view rows whose Amazon enrichment changed, all of them after a full run."""
+    if not materialize.is_enabled(cursor):
+        return
+    if full:
+        refreshed = materialize.materialize_view(cursor, 'amexcc_view')
+    else:
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS reconcile_new (amex_hash BLOB PRIMARY KEY)")
+        cursor.execute("DELETE FROM temp.reconcile_new")
+        cursor.executemany("INSERT INTO temp.reconcile_new VALUES (?)", [(link[0],) for link in links])
+        refreshed = materialize.materialize_view(
+            cursor, 'amexcc_view', "v.source_hash IN (SELECT amex_hash FROM temp.reconcile_new)"
+        )
+    logging.info(f"Refreshed {refreshed} materialized transactions for {len(links)} links")
+
+def reconcile(conn, full=False):
+    """Link Amazon orders to Amex charges created since the last reconciliation, in one transaction.
+
+    full drops every link and matches all rows again. Returns the number of new links.
+    """
+    cursor = conn.cursor()
+    try:
+        create_reconcile_tables(cursor)
+        if not tables_exist(cursor):
+            conn.commit()
+            return 0
+        if full:
+            cursor.execute(f"DELETE FROM {LINK_TABLE}")
+        since = 0 if full else max(get_high_water(cursor) - RECONCILE_OVERLAP_SECONDS, 0)
+        high_water = max(
+            cursor.execute(f'SELECT COALESCE(MAX(created), 0) FROM "{table_name}"').fetchone()[0]
+            for table_name in (CHARGE_TABLE, ORDER_TABLE)
+        )
+
+        with metrics.stage('reconcile_match'):
+            links = assign_links(find_candidates(cursor, since))
+        if links:
+            insert_links(cursor, links)
+        if links or full:
+            refresh_materialized_charges(cursor, links, full)
+        set_high_water(cursor, max(high_water, get_high_water(cursor)))
+        metrics.timed_commit(conn, table=LINK_TABLE)
+    except Exception:
+        conn.rollback()
+        raise
+    metrics.count('links_total', len(links))
+    logging.info(f"Linked {len(links)} Amazon orders to Amex charges")
+    return len(links)
+
+def main():
+    parser = argparse.ArgumentParser(description="Link Amazon orders to the Amex charges they produced.")
+    parser.add_argument('--db', type=str, default=DB_FILE, help="Path to the SQLite database.")
+    parser.add_argument('--full', action='store_true', help="Drop every link and match all rows again.")
+    args = parser.parse_args()
+
+    with db.get_database(args.db).writer() as conn:
+        db.with_retry(reconcile, conn, args.full)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+import math
+import struct
+import hashlib
+import numbers
+import numpy as np
+import pandas as pd
+
+# Row identity keys: unique_hash in the account tables is a 16-byte BLOB, the BLAKE2b digest
+# of the row's hash columns as they are stored. Each value is encoded with a type tag and,
+# for strings, a length prefix, so ("1", "23") and ("12", "3") no longer hash alike.
+#
+# Version 1 was the SHA-256 hex of table_name + ''.join(map(str, values)) over legacy
+# DATETIME epochs. Schema migration 6 re-keys existing rows from their stored values, so
+# a statement ingested again after the migration still finds its earlier rows.
+ROW_KEY_VERSION = 2
+KEY_BYTES = 16
+LEGACY_HASH_LENGTH = 64
+
+NULL = b'\x00'
+INT = b'\x01'
+REAL = b'\x02'
+TEXT = b'\x03'
+BIG_INT = b'\x04'
+PACK_INT = struct.Struct('>q').pack
+PACK_REAL = struct.Struct('>d').pack
+PACK_LENGTH = struct.Struct('>I').pack
+INT64_MIN, INT64_MAX = -2**63, 2**63 - 1
+
+def sqlite_real_text(value):
+    """Render a float the way SQLite stores it in a TEXT column ('%!.15g')."""
+    if math.isinf(value):
+        return 'Inf' if value > 0 else '-Inf'
+    mantissa, _, exponent = ('%.15g' % value).partition('e')
+    if '.' not in mantissa:
+        mantissa += '.0'
+    return mantissa + ('e' + exponent if exponent else '')
+
+def canonical(value, col_type):
+    """Return a value as SQLite hands it back from a column of this config type.
+
+    Missing values become None, numbers in TEXT columns become the text SQLite
+    stores, and whole floats in NUMERIC and DATETIME columns become integers.
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return value
+    if isinstance(value, numbers.Integral):
+        return str(int(value)) if col_type == 'TEXT' else int(value)
+    if isinstance(value, numbers.Real):
+        value = float(value)
+        if math.isnan(value):
+            return None
+        if col_type == 'TEXT':
+            return sqlite_real_text(value)
+        if value.is_integer() and INT64_MIN <= value <= INT64_MAX:
+            return int(value)
+        return value
+    return str(value)
+
+def encode_value(value):
+    """Type-tagged, self-delimiting encoding of a canonical value."""
+    if value is None:
+        return NULL
+    if isinstance(value, str):
+        data = value.encode()
+        return TEXT + PACK_LENGTH(len(data)) + data
+    if isinstance(value, int):
+        if INT64_MIN <= value <= INT64_MAX:
+            return INT + PACK_INT(value)
+        data = str(value).encode()
+        return BIG_INT + PACK_LENGTH(len(data)) + data
+    return REAL + PACK_REAL(value)
+
+def encode_column(values, col_type):
+    """Encode a whole column, each distinct value once."""
+    values = np.asarray(values, dtype=object)
+    if col_type == 'TEXT' and 'mixed' in pd.api.types.infer_dtype(values, skipna=True):
+        # factorize merges 1, 1.0 and True, which TEXT columns store as different text
+        return [encode_value(canonical(value, col_type)) for value in values]
+    codes, uniques = pd.factorize(values)
+    # Missing values get code -1, which picks up the trailing NULL
+    encoded = np.asarray([encode_value(canonical(value, col_type)) for value in uniques] + [NULL], dtype=object)
+    return encoded[codes].tolist()
+
+def key_prefix(table_name):
+    """The scheme version and table name every key of a table starts from."""
+    data = table_name.encode()
+    return bytes([ROW_KEY_VERSION]) + PACK_LENGTH(len(data)) + data
+
+def row_keys(table_name, columns, col_types, rows=None):
+    """Return the keys of rows given column-wise, one list of values per hash column.
+
+    rows is the row count, needed when there are no hash columns.
+    """
+    prefix = key_prefix(table_name)
+    if not columns:
+        return [hashlib.blake2b(prefix, digest_size=KEY_BYTES).digest()] * (rows or 0)
+    encoded = [encode_column(values, col_type) for values, col_type in zip(columns, col_types)]
+    base = hashlib.blake2b(prefix, digest_size=KEY_BYTES)
+    keys = []
+    for fields in zip(*encoded):
+        digest = base.copy()
+        digest.update(b''.join(fields))
+        keys.append(digest.digest())
+    return keys
+
+def row_key(table_name, values, col_types):
+    """Return the key of a single row's hash column values."""
+    fields = b''.join(encode_value(canonical(value, col_type)) for value, col_type in zip(values, col_types))
+    return hashlib.blake2b(key_prefix(table_name) + fields, digest_size=KEY_BYTES).digest()
+
+def legacy_hash(values, table_name):
+    """Version 1 unique_hash, still matched against 64-character ignore_hash entries."""
+    hash_input = table_name + ''.join(map(str, values))
+    return hashlib.sha256(hash_input.encode()).hexdigest()
+
+def to_hex(key):
+    """Printable form of a stored unique_hash, legacy hex values unchanged."""
+    return key.hex() if isinstance(key, bytes) else key
+
+def from_hex(text):
+    """Inverse of to_hex: 32 hex characters are a key, anything else a legacy hash."""
+    if len(text) == KEY_BYTES * 2:
+        return bytes.fromhex(text)
+    return text
+
+def sort_key(key):
+    """Order keys as SQLite does when a table still holds legacy values: TEXT sorts before BLOB."""
+    return (isinstance(key, bytes), key)
@@ -0,0 +1,294 @@
+import sqlite3
+import logging
+import argparse
+import re
+import time
+import yaml
+import db
+import dates
+import ingest_plan
+import materialize
+import merchant_keys
+import reconcile
+import row_keys
+
+# Database file path
+DB_FILE = 'financials.db'
+CONFIG_FILE = 'config.yaml'
+
+# Bump when a new entry is appended to ACCOUNT_MIGRATIONS
+SCHEMA_VERSION = 7
+
+# Columns every account table has besides the CSV columns
+ROW_COLUMNS = ('unique_hash', 'Tags', 'created', 'tx_local_date', 'merchant_key')
+# Columns of other tables holding an account table's unique_hash, and the account they point into (None for any).
+# Links are written by reconcile.py.
+ROW_KEY_REFERENCES = [
+    (materialize.MATERIALIZED_TABLE, 'unique_hash', None),
+    ('amazon_amex_link', 'amex_hash', 'amexcc'),
+    ('amazon_amex_link', 'amazon_hash', 'amazon'),
+]
+
+# Must match the filter used by the views so the partial index can serve duplicate probes
+NOT_DUPLICATE = "(Tags != 'duplicate' OR Tags IS NULL)"
+
+def index_name(table_name, *columns):
+    """Build a stable index name from a table name and column names."""
+    parts = [table_name] + [re.sub(r'\W+', '_', column.strip()).strip('_').lower() for column in columns]
+    return '_'.join(parts) + '_idx'
+
+def create_version_table(cursor):
+    """Create the schema_version table if it doesn't already exist."""
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS schema_version (
+        table_name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL,
+        migrated INTEGER
+    )
+    """)
+
+def get_table_version(cursor, table_name):
+    """Return the recorded schema version for a table, 0 if it was never migrated."""
+    row = cursor.execute("SELECT version FROM schema_version WHERE table_name = ?", (table_name,)).fetchone()
+    return row[0] if row else 0
+
+def set_table_version(cursor, table_name, version):
+    """Record the schema version a table has been migrated to."""
+    cursor.execute(
+        "INSERT OR REPLACE INTO schema_version (table_name, version, migrated) VALUES (?, ?, ?)",
+        (table_name, version, int(time.time()))
+    )
+
+def get_table_columns(cursor, table_name):
+    """Return the column names of a table, empty if the table doesn't exist."""
+    return [row[1] for row in cursor.execute(f'PRAGMA table_info("{table_name}")').fetchall()]
+
+def create_unique_hash_index(cursor, table_name):
+    """Create a unique index on unique_hash for rows that are not tagged as duplicates.
+
+    Tables holding conflicting hashes from before duplicate tagging fall back to a plain index.
+    """
+    name = index_name(table_name, 'unique_hash')
+    try:
+        cursor.execute(
+            f'CREATE UNIQUE INDEX IF NOT EXISTS "{name}" ON "{table_name}" (unique_hash) WHERE {NOT_DUPLICATE}'
+        )
+    except sqlite3.IntegrityError:
+        logging.warning(f"Table '{table_name}' has conflicting unique_hash values, creating a non-unique index")
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS "{name}" ON "{table_name}" (unique_hash) WHERE {NOT_DUPLICATE}')
+
+def add_account_indexes(cursor, table_name, config):
+    """Migration 1: index unique_hash, the DATETIME columns and the merchant column of an account table."""
+    columns = get_table_columns(cursor, table_name)
+    create_unique_hash_index(cursor, table_name)
+
+    indexed_columns = [column for column, col_type in config.get('column_types', {}).items() if col_type == "DATETIME"]
+    if config.get('merchant_column'):
+        indexed_columns.append(config['merchant_column'])
+    for column in indexed_columns:
+        if column in columns:
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS "{index_name(table_name, column)}" ON "{table_name}" ("{column}")')
+
+def localize_datetime_columns(cursor, table_name, config):
+    """Migration 2: re-convert DATETIME columns with real DST rules and add the indexed tx_local_date column.
+
+    Values go back to the Eastern Time wall clock the month-based guess started from and
+    through the same conversion as ingest, so migrated rows store what a fresh ingest
+    stores; time-only columns the old parser dated with the ingest day move to 1900-01-01.
+    """
+    columns = get_table_columns(cursor, table_name)
+    if 'tx_local_date' not in columns:
+        cursor.execute(f'ALTER TABLE "{table_name}" ADD COLUMN "tx_local_date" TEXT')
+
+    datetime_columns = [column for column, col_type in config.get('column_types', {}).items()
+                        if col_type == "DATETIME" and column in columns]
+    date_column = dates.primary_date_column(config, datetime_columns)
+    for column in datetime_columns:
+        rows = cursor.execute(
+            f'SELECT rowid, "{column}", created FROM "{table_name}" WHERE "{column}" IS NOT NULL'
+        ).fetchall()
+        if not rows:
+            continue
+        row_ids, epochs, created = zip(*rows)
+        parsed, ambiguous = dates.legacy_naive(epochs)
+        if column != date_column and dates.is_time_only(parsed, created, dates.column_format(config.get('date_format'), column)):
+            logging.info(f"Column '{column}' of '{table_name}' holds times of day, moving them to 1900-01-01")
+            parsed = dates.time_of_day(parsed)
+        elif ambiguous.any() and (parsed != parsed.dt.normalize()).any():
+            # Date-only columns hold midnights, which only April 1 decodes to
+            logging.warning(f"{int(ambiguous.sum())} '{column}' values of '{table_name}' fall in the hour the "
+                            f"month-based conversion stored twice (March 31 23:00 EST, April 1 00:00 EDT); "
+                            f"they are read as April 1")
+        cursor.executemany(
+            f'UPDATE "{table_name}" SET "{column}" = ? WHERE rowid = ?', zip(dates.to_epoch(parsed), row_ids)
+        )
+
+    if date_column:
+        cursor.connection.create_function('local_date', 1, dates.local_date, deterministic=True)
+        cursor.execute(f'UPDATE "{table_name}" SET tx_local_date = local_date("{date_column}")')
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS "{index_name(table_name, "tx_local_date")}" ON "{table_name}" (tx_local_date)')
+
+def add_merchant_keys(cursor, table_name, config):
+    """Migration 3: add the indexed merchant_key column and fill it from the account's merchant_column.
+
+    Rows get the same keys a fresh ingest stores.
+    """
+    columns = get_table_columns(cursor, table_name)
+    if 'merchant_key' not in columns:
+        cursor.execute(f'ALTER TABLE "{table_name}" ADD COLUMN "merchant_key" TEXT')
+
+    merchant_column = config.get('merchant_column')
+    if merchant_column in columns:
+        descriptions = [row[0] for row in cursor.execute(f'SELECT DISTINCT "{merchant_column}" FROM "{table_name}"')]
+        key_map = merchant_keys.build_key_map(descriptions, merchant_keys.compile_rules(config))
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS merchant_key_map (description TEXT PRIMARY KEY, merchant_key TEXT)")
+        cursor.execute("DELETE FROM temp.merchant_key_map")
+        cursor.executemany("INSERT INTO temp.merchant_key_map VALUES (?, ?)", key_map.items())
+        cursor.execute(f'''
+            UPDATE "{table_name}" SET merchant_key = (
+                SELECT merchant_key FROM temp.merchant_key_map WHERE description = "{table_name}"."{merchant_column}"
+            )
+        ''')
+        cursor.execute("DROP TABLE temp.merchant_key_map")
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS "{index_name(table_name, "merchant_key")}" ON "{table_name}" (merchant_key)')
+
+def add_created_index(cursor, table_name, config):
+    """Migration 4: index created, the high-water column of incremental merchant and materialized refreshes."""
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS "{index_name(table_name, "created")}" ON "{table_name}" (created)')
+
+def add_keyset_index(cursor, table_name, config):
+    """Migration 5: index (tx_local_date, unique_hash), the keyset query.py pages on, replacing the tx_local_date index."""
+    cursor.execute(
+        f'CREATE INDEX IF NOT EXISTS "{index_name(table_name, "tx_local_date", "unique_hash")}" '
+        f'ON "{table_name}" (tx_local_date, unique_hash)'
+    )
+    cursor.execute(f'DROP INDEX IF EXISTS "{index_name(table_name, "tx_local_date")}"')
+
+def add_row_keys(cursor, table_name, config):
+    """Migration 6: replace version 1 hex unique_hash values with row keys computed from the stored hash columns.
+
+    Hashes held by the materialized table and the Amazon links are mapped to the new
+    keys in the same transaction.
+    """
+    columns = [column for column in get_table_columns(cursor, table_name) if column not in ROW_COLUMNS]
+    layout = ingest_plan.IngestPlan(table_name, config).layout(columns)
+    hash_columns = [columns[i] for i in layout['hash_indices']]
+    select_list = ', '.join(['rowid', 'unique_hash'] + [f'"{column}"' for column in hash_columns])
+    rows = cursor.execute(f"SELECT {select_list} FROM \"{table_name}\" WHERE typeof(unique_hash) != 'blob'").fetchall()
+    if not rows:
+        return
+    row_ids, legacy_hashes, *hash_values = zip(*rows)
+    keys = row_keys.row_keys(table_name, hash_values, layout['hash_types'], len(rows))
+
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS row_key_map (row_id INTEGER PRIMARY KEY, legacy_hash TEXT, row_key BLOB)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS temp.row_key_map_legacy_hash_idx ON row_key_map (legacy_hash)")
+    cursor.execute("DELETE FROM temp.row_key_map")
+    cursor.executemany("INSERT INTO temp.row_key_map VALUES (?, ?, ?)", zip(row_ids, legacy_hashes, keys))
+    # Rebuilt afterwards, non-unique if two rows the old encoding told apart now share a key
+    cursor.execute(f'DROP INDEX IF EXISTS "{index_name(table_name, "unique_hash")}"')
+    cursor.execute(f'''
+        UPDATE "{table_name}" SET unique_hash = (SELECT row_key FROM temp.row_key_map WHERE row_id = "{table_name}".rowid)
+        WHERE rowid IN (SELECT row_id FROM temp.row_key_map)
+    ''')
+    create_unique_hash_index(cursor, table_name)
+
+    for reference_table, column, account_name in ROW_KEY_REFERENCES:
+        if account_name not in (None, table_name) or not get_table_columns(cursor, reference_table):
+            continue
+        cursor.execute(f'''
+            UPDATE "{reference_table}" SET "{column}" = (
+                SELECT row_key FROM temp.row_key_map WHERE legacy_hash = "{reference_table}"."{column}" LIMIT 1
+            )
+            WHERE "{column}" IN (SELECT legacy_hash FROM temp.row_key_map)
+        ''')
+    cursor.execute("DROP TABLE temp.row_key_map")
+    logging.info(f"Re-keyed {len(rows)} rows of '{table_name}'")
+
+def add_reconcile_tables(cursor, table_name, config):
+    """Migration 7: create amazon_amex_link, which amexcc_view joins, and the reconcile key index of the table.
+
+    The first table migrated creates the shared link tables.
+    """
+    reconcile.create_link_tables(cursor)
+    if table_name in (reconcile.CHARGE_TABLE, reconcile.ORDER_TABLE):
+        reconcile.create_key_index(cursor, table_name)
+
+# Ordered account table migrations, the position in the list is the version they bring a table to
+ACCOUNT_MIGRATIONS = [
+    add_account_indexes,
+    localize_datetime_columns,
+    add_merchant_keys,
+    add_created_index,
+    add_keyset_index,
+    add_row_keys,
+    add_reconcile_tables,
+]
+
+def create_duplicate_table(cursor, table_name):
+    """Create an account's duplicate side table with the account table's columns, moving its duplicate rows there.
+
+    Returns True if the table was created. The views, duplicate probes and the materialized
+    table only read rows that are not duplicates, so moving them changes no results.
+    """
+    duplicate_table = table_name + ingest_plan.DUPLICATE_TABLE_SUFFIX
+    if get_table_columns(cursor, duplicate_table):
+        return False
+    columns = cursor.execute(f'PRAGMA table_info("{table_name}")').fetchall()
+    definitions = ', '.join(f'"{column[1]}" {column[2]}' for column in columns)
+    cursor.execute(f'CREATE TABLE "{duplicate_table}" ({definitions})')
+    column_list = ', '.join(f'"{column[1]}"' for column in columns)
+    cursor.execute(f"""
+        INSERT INTO "{duplicate_table}" ({column_list})
+        SELECT {column_list} FROM "{table_name}" WHERE NOT {NOT_DUPLICATE}
+    """)
+    cursor.execute(f'DELETE FROM "{table_name}" WHERE NOT {NOT_DUPLICATE}')
+    logging.info(f"Moved {cursor.rowcount} duplicate rows of '{table_name}' to '{duplicate_table}'")
+    return True
+
+def migrate_account(cursor, table_name, config):
+    """Bring an existing account table up to SCHEMA_VERSION and create its duplicate table if configured.
+
+    Returns True if anything ran.
+    """
+    create_version_table(cursor)
+    if not get_table_columns(cursor, table_name):
+        return False
+    version = get_table_version(cursor, table_name)
+    for target_version, migration in enumerate(ACCOUNT_MIGRATIONS[version:], start=version + 1):
+        logging.info(f"Migrating table '{table_name}' to schema version {target_version}")
+        migration(cursor, table_name, config)
+        set_table_version(cursor, table_name, target_version)
+    # Not a versioned migration: it follows the account's duplicate_table setting
+    created = config.get('duplicate_table') and create_duplicate_table(cursor, table_name)
+    return version < SCHEMA_VERSION or bool(created)
+
+def migrate(db_file=DB_FILE, config_file=CONFIG_FILE):
+    """Migrate every configured account table in an existing database in place."""
+    with open(config_file, 'r') as f:
+        config = yaml.safe_load(f) or {}
+
+    def migrate_accounts(conn):
+        cursor = conn.cursor()
+        try:
+            migrated = [account_name for account_name, account_config in config.items()
+                        if migrate_account(cursor, account_name, account_config or {})]
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return migrated
+
+    with db.get_database(db_file).writer() as conn:
+        return db.with_retry(migrate_accounts, conn)
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Migrate account tables in the SQLite database to the current schema.")
+    parser.add_argument('--db', type=str, default=DB_FILE, help="Path to the SQLite database.")
+    parser.add_argument('--config', type=str, default=CONFIG_FILE, help="Path to the YAML configuration file.")
+    args = parser.parse_args()
+    migrated = migrate(args.db, args.config)
+    logging.info(f"Schema is at version {SCHEMA_VERSION}, migrated tables: {migrated or 'none'}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import json
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the OpenAI completions endpoint, for exercising merchant_meta.py without a key:
+#   python stub_llm.py --port 8099 &
+#   OPENAI_API_KEY=stub python merchant_meta.py --base-url http://127.0.0.1:8099/v1
+PORT = 8099
+
+def merchants_from_prompt(prompt):
+    """Return the merchant names listed after the MERCHANTS: marker of a merchant_meta.py prompt."""
+    _, _, listing = prompt.partition("MERCHANTS:\n")
+    return [line for line in listing.split("\n") if line.strip()]
+
+def fake_metadata(merchant):
+    """Deterministic metadata for a merchant."""
+    return {
+        "merchant": merchant,
+        "city": "Springfield",
+        "region": "PA",
+        "country": "USA",
+        "phone_number": "",
+        "URL": "",
+        "gpt_category": "STUB",
+    }
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers POST /v1/completions with a JSON array for the prompt's merchants."""
+
+    # Set by make_server
+    max_merchants = None
+    latency = 0.0
+    stats = None
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        prompts = request.get('prompt', '')
+        if isinstance(prompts, str):
+            prompts = [prompts]
+
+        choices = []
+        for index, prompt in enumerate(prompts):
+            merchants = merchants_from_prompt(prompt)
+            text = json.dumps([fake_metadata(merchant) for merchant in merchants], indent=2)
+            finish_reason = "stop"
+            if self.max_merchants is not None and len(merchants) > self.max_merchants:
+                # Cut the response off mid-array the way a hit max_tokens limit would
+                text = text[:len(text) // 2]
+                finish_reason = "length"
+            choices.append({"text": text, "index": index, "logprobs": None, "finish_reason": finish_reason})
+            with self.stats['lock']:
+                self.stats['requests'] += 1
+                self.stats['merchants'] += len(merchants)
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        body = json.dumps({
+            "id": "cmpl-stub",
+            "object": "text_completion",
+            "created": int(time.time()),
+            "model": request.get('model', 'stub'),
+            "choices": choices,
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def make_server(port=PORT, max_merchants=None, latency=0.0):
+    """Create the stub server; its stats dict counts requests and merchants served."""
+    handler = type('Handler', (StubHandler,), {
+        'max_merchants': max_merchants,
+        'latency': latency,
+        'stats': {'requests': 0, 'merchants': 0, 'lock': threading.Lock()},
+    })
+    return ThreadingHTTPServer(('127.0.0.1', port), handler)
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve canned merchant metadata on an OpenAI-compatible endpoint.")
+    parser.add_argument('--port', type=int, default=PORT, help="Port to listen on.")
+    parser.add_argument('--max-merchants', type=int, default=None,
+                        help="Truncate responses for batches larger than this, to exercise batch shrinking.")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds to wait before each response.")
+    args = parser.parse_args()
+    server = make_server(args.port, args.max_merchants, args.latency)
+    print(f"Stub LLM listening on http://127.0.0.1:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
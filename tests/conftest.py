@@ -0,0 +1,82 @@
+import os
+import sqlite3
+import sys
+import importlib.util
+from functools import lru_cache
+import pytest
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import benchmark
+import db
+import ingest
+import schema
+
+CONFIG_FILE = os.path.join(ROOT, 'config.yaml')
+VIEWS_FILE = os.path.join(ROOT, 'views.sql')
+# Rows per generated export, enough to cover the duplicate rows the generator repeats
+ROWS = 300
+# A row, a streamed and a two-DATETIME account between them cover every ingest path
+ACCOUNTS = ['amexcc', 'chasecc', 'venmo', 'paypal', 'amazon']
+
+@pytest.fixture(autouse=True)
+def close_databases():
+    """Drop the shared connections after every test, so no database outlives its tmp_path."""
+    yield
+    db.close_all()
+
+@pytest.fixture(scope='session')
+def exports(tmp_path_factory):
+    """Generated exports of ACCOUNTS, {account_name: csv_file}."""
+    with open(CONFIG_FILE, 'r') as f:
+        config = yaml.safe_load(f)
+    return benchmark.generate_exports(config, ROWS, str(tmp_path_factory.mktemp('exports')), accounts=ACCOUNTS)
+
+@pytest.fixture
+def write_config(tmp_path):
+    """Write the repo config with overrides per account, returning the file path."""
+    def write(name='config.yaml', **overrides):
+        with open(CONFIG_FILE, 'r') as f:
+            config = yaml.safe_load(f)
+        for account_name, account_overrides in overrides.items():
+            config[account_name] = dict(config.get(account_name) or {}, **account_overrides)
+        config_file = tmp_path / name
+        with open(config_file, 'w') as f:
+            yaml.safe_dump(config, f)
+        return str(config_file)
+    return write
+
+def with_mode(ingest_mode, **account_settings):
+    """Overrides setting ingest_mode (and the given settings) on every account in ACCOUNTS."""
+    return {account_name: dict(account_settings, ingest_mode=ingest_mode) for account_name in ACCOUNTS}
+
+def table_rows(db_file, table_name):
+    """Every row of a table without created, which holds the ingest time, sorted."""
+    conn = sqlite3.connect(db_file)
+    try:
+        columns = [column for column in schema.get_table_columns(conn.cursor(), table_name) if column != 'created']
+        select_list = ', '.join(f'"{column}"' for column in columns)
+        return sorted(conn.execute(f'SELECT {select_list} FROM "{table_name}"').fetchall(), key=repr)
+    finally:
+        conn.close()
+
+def fail_on_call(monkeypatch, function_name, call):
+    """Make ingest.<function_name> raise on its call-th invocation, as a crash would."""
+    original = getattr(ingest, function_name)
+    calls = []
+    def failing(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == call:
+            raise RuntimeError('simulated crash')
+        return original(*args, **kwargs)
+    monkeypatch.setattr(ingest, function_name, failing)
+
+@lru_cache(maxsize=None)
+def load_service():
+    """Import the dropzone service, which can't be imported as __main__ while pytest runs."""
+    spec = importlib.util.spec_from_file_location('service', os.path.join(ROOT, '__main__.py'))
+    service = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(service)
+    return service
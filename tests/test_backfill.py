@@ -0,0 +1,75 @@
+import os
+import shutil
+import sqlite3
+import pytest
+import backfill
+import db
+import ingest
+import journal
+from conftest import table_rows, with_mode
+
+def make_tree(root, exports, account_name, copies):
+    folder = root / account_name
+    folder.mkdir(parents=True)
+    for copy in range(copies):
+        shutil.copy(exports[account_name], folder / f'{copy}.csv')
+
+def unfinished_files(db_file):
+    conn = sqlite3.connect(db_file)
+    unfinished = [(os.path.basename(row[2]), row[3]) for row in journal.unfinished(conn.cursor())]
+    conn.close()
+    return unfinished
+
+def test_backfill_only_moves_files_committed_before_a_crash(exports, write_config, tmp_path):
+    config_file = write_config(**with_mode('bulk'))
+    db_file = str(tmp_path / 'financials.db')
+    root, completed = tmp_path / 'root', str(tmp_path / 'completed')
+    make_tree(root, exports, 'amexcc', 1)
+    # Committed, then the process died before the move
+    ingest.insert_csv_to_db('amexcc', str(root / 'amexcc' / '0.csv'), config_file, db_file)
+    db.close_all()
+    before = table_rows(db_file, 'amexcc')
+    assert unfinished_files(db_file) == [('0.csv', journal.COMMITTED)]
+
+    assert backfill.backfill(str(root), db_file, config_file, workers=1, completed_path=completed) == []
+    assert table_rows(db_file, 'amexcc') == before
+    assert os.listdir(root / 'amexcc') == [] and len(os.listdir(os.path.join(completed, 'amexcc'))) == 1
+    assert unfinished_files(db_file) == []
+
+@pytest.mark.parametrize('ingest_mode', ['bulk', 'stream'])
+def test_backfill_writes_repeated_files_as_duplicates(exports, write_config, tmp_path, ingest_mode):
+    config_file = write_config(**with_mode(ingest_mode, chunk_size=70))
+    expected, db_file = str(tmp_path / 'expected.db'), str(tmp_path / 'financials.db')
+    for _ in range(2):
+        ingest.insert_csv_to_db('venmo', exports['venmo'], config_file, expected)
+    db.close_all()
+    root = tmp_path / 'root'
+    make_tree(root, exports, 'venmo', 2)
+    assert backfill.backfill(str(root), db_file, config_file, workers=1, move=False) == []
+    assert table_rows(db_file, 'venmo') == table_rows(expected, 'venmo')
+
+def test_failed_moves_leave_the_file_for_the_next_run(exports, write_config, tmp_path, monkeypatch):
+    config_file = write_config(**with_mode('bulk'))
+    db_file = str(tmp_path / 'financials.db')
+    root, completed = tmp_path / 'root', str(tmp_path / 'completed')
+    make_tree(root, exports, 'amexcc', 1)
+    # Other content, the journal keys files by content hash
+    with open(exports['amexcc']) as f:
+        (root / 'amexcc' / '1.csv').write_text(''.join(f.readlines()[:50]))
+    move = ingest.move_to_completed
+    def failing_first(account_name, file_path, completed_path):
+        if file_path.endswith('0.csv'):
+            raise PermissionError('file in use')
+        return move(account_name, file_path, completed_path)
+    monkeypatch.setattr(ingest, 'move_to_completed', failing_first)
+
+    assert backfill.backfill(str(root), db_file, config_file, workers=1, completed_path=completed) == []
+    # The other file's move is journaled and the stuck one is still committed
+    assert os.listdir(root / 'amexcc') == ['0.csv'] and len(os.listdir(os.path.join(completed, 'amexcc'))) == 1
+    assert unfinished_files(db_file) == [('0.csv', journal.COMMITTED)]
+    before = table_rows(db_file, 'amexcc')
+
+    monkeypatch.undo()
+    assert backfill.backfill(str(root), db_file, config_file, workers=1, completed_path=completed) == []
+    assert table_rows(db_file, 'amexcc') == before
+    assert os.listdir(root / 'amexcc') == [] and unfinished_files(db_file) == []
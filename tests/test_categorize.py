@@ -0,0 +1,97 @@
+import sqlite3
+import pytest
+import yaml
+import benchmark
+import categorize
+import db
+import ingest
+import materialize
+import merchant
+from conftest import CONFIG_FILE, VIEWS_FILE
+
+def test_exact_rules_beat_the_longest_prefix():
+    rules = categorize.RuleTrie()
+    rules.add('uber', 'Travel', prefix=True)
+    rules.add('UBER  EATS', 'Dining', prefix=True)
+    rules.add('UBER EATS PASS', 'Subscriptions')
+    assert rules.match('UBER TRIP') == 'Travel'
+    assert rules.match('UBER EATS 1234') == 'Dining'
+    assert rules.match('UBER EATS PASS') == 'Subscriptions'
+    # A prefix rule matches whole tokens only
+    assert rules.match('UBERX') is None and rules.match('LYFT') is None
+
+def test_rules_file_is_validated(tmp_path):
+    rules_file = tmp_path / 'rules.yaml'
+    rules_file.write_text("exact:\n  NETFLIX COM: Entertainment\nprefix:\n  SHELL: Fuel\n")
+    rules = categorize.load_rules(str(rules_file))
+    assert rules.size == 2 and rules.match('SHELL OIL') == 'Fuel' and rules.match('NETFLIX COM') == 'Entertainment'
+    assert categorize.load_rules(str(tmp_path / 'missing.yaml')).size == 0
+    for text in ("rules:\n  SHELL: Fuel\n", "prefix:\n  SHELL: ''\n", "prefix: [SHELL]\n"):
+        rules_file.write_text(text)
+        with pytest.raises(ValueError):
+            categorize.load_rules(str(rules_file))
+
+EXAMPLES = [
+    (categorize.features('SHELL OIL', 'Gas'), 'Fuel'),
+    (categorize.features('EXXON MOBIL', 'Gas'), 'Fuel'),
+    (categorize.features('SHELL STATION', None), 'Fuel'),
+    (categorize.features('STARBUCKS', 'Restaurant'), 'Dining'),
+    (categorize.features('BLUE BOTTLE COFFEE', 'Restaurant'), 'Dining'),
+]
+
+def test_model_predicts_from_name_tokens_and_source_categories():
+    model = categorize.TokenModel.train(EXAMPLES)
+    assert model.categories == ['Dining', 'Fuel']
+    (shell, shell_confidence), (coffee, coffee_confidence) = model.predict([
+        categorize.features('SHELL EXPRESS', 'Gas'),
+        categorize.features('JOES COFFEE', 'Restaurant'),
+    ])
+    assert (shell, coffee) == ('Fuel', 'Dining')
+    assert shell_confidence > categorize.CONFIDENCE_THRESHOLD and 0.5 < coffee_confidence < 1
+    assert categorize.TokenModel.train([]) is None and model.predict([]) == []
+
+def test_confidence_needs_a_known_name_token_and_two_categories():
+    model = categorize.TokenModel.train(EXAMPLES)
+    # The source category alone points at Fuel, but says nothing about this merchant
+    category, confidence = model.predict([categorize.features('ACME WIDGETS', 'Gas')])[0]
+    assert category == 'Fuel' and confidence == 0.0
+    single = categorize.TokenModel.train(EXAMPLES[:3])
+    assert single.predict([categorize.features('SHELL OIL', 'Gas')]) == [('Fuel', 0.0)]
+
+def test_classify_prefers_rules_over_the_model():
+    rules = categorize.RuleTrie()
+    rules.add('SHELL', 'Car', prefix=True)
+    model = categorize.TokenModel.train(EXAMPLES)
+    results = categorize.classify([('SHELL OIL', 'Gas'), ('EXXON', 'Gas')], rules, model)
+    assert results['SHELL OIL'] == ('Car', 1.0, 'rule')
+    assert results['EXXON'][0] == 'Fuel' and results['EXXON'][2] == 'model'
+    assert categorize.classify([('EXXON', None)], rules, None) == {'EXXON': (None, 0.0, 'model')}
+
+def test_confident_auto_categories_are_shown_until_the_llm_answers(tmp_path):
+    db_file = str(tmp_path / 'financials.db')
+    with open(CONFIG_FILE, 'r') as f:
+        config = yaml.safe_load(f)
+    # all_transactions reads every account's table
+    for account_name, csv_file in benchmark.generate_exports(config, 20, str(tmp_path / 'exports')).items():
+        ingest.insert_csv_to_db(account_name, csv_file, CONFIG_FILE, db_file)
+    with db.get_database(db_file).writer() as conn:
+        benchmark.load_views(conn, VIEWS_FILE)
+        merchant.refresh_merchants(conn, full=True, config_file=CONFIG_FILE)
+        first, second = [row[0] for row in conn.execute(
+            "SELECT merchant_id FROM merchant WHERE category IS NULL ORDER BY merchant_id LIMIT 2")]
+    materialize.rebuild(db_file)
+    rules_file = tmp_path / 'rules.yaml'
+    rules_file.write_text(f"exact:\n  {first}: Ruled\n  {second}: Ruled\n")
+    with db.get_database(db_file).writer() as conn:
+        conn.execute("UPDATE merchant SET gpt_category = 'Answered' WHERE merchant_id = ?", (second,))
+        conn.commit()
+        categorize.categorize(conn, rules_file=str(rules_file))
+
+    conn = sqlite3.connect(db_file)
+    for merchant_id, expected in ((first, {'Ruled'}), (second, None)):
+        shown = {row[0] for row in conn.execute("SELECT tx_category FROM all_transactions WHERE merchant_key = ?", (merchant_id,))}
+        materialized = {row[0] for row in conn.execute(
+            f"SELECT tx_category FROM {materialize.MATERIALIZED_TABLE} WHERE merchant_key = ?", (merchant_id,))}
+        assert shown and materialized == shown
+        assert shown == expected if expected else 'Ruled' not in shown
+    conn.close()
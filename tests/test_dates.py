@@ -0,0 +1,43 @@
+from datetime import datetime, timezone
+import pandas as pd
+import dates
+import ingest_plan
+
+def utc_epoch(*args):
+    return int(datetime(*args, tzinfo=timezone.utc).timestamp())
+
+def test_daylight_saving_rules():
+    epochs, legacy = dates.convert_column(
+        ['2024-01-15 12:00:00', '2024-07-04 12:00:00', '2023-11-05 01:30:00', '2024-03-10 02:30:00', None])
+    assert epochs == [
+        utc_epoch(2024, 1, 15, 17),
+        utc_epoch(2024, 7, 4, 16),
+        # Fall back: the first (EDT) 01:30
+        utc_epoch(2023, 11, 5, 5, 30),
+        # Spring forward: 02:30 does not exist and moves to 03:00 EDT
+        utc_epoch(2024, 3, 10, 7),
+        None,
+    ]
+    # The month-based guess treated March as EST
+    assert legacy[3] == utc_epoch(2024, 3, 10, 7, 30)
+
+def test_date_format_per_column():
+    date_format = {'Date': '%d/%m/%Y'}
+    day_first, _ = dates.convert_column(['01/02/2024'], 'testcc', 'Date', date_format)
+    # Columns without an entry are detected
+    month_first, _ = dates.convert_column(['01/02/2024'], 'testcc', 'Posted', date_format)
+    assert dates.local_dates(day_first + month_first) == ['2024-02-01', '2024-01-02']
+
+def test_date_format_mapping_is_validated():
+    assert ingest_plan.validate_account('testcc', {'date_format': {'Date': '%d/%m/%Y'}}) == []
+    assert ingest_plan.validate_account('testcc', {'date_format': '%m/%d/%Y'}) == []
+    assert ingest_plan.validate_account('testcc', {'date_format': {'Date': 5}})
+    assert ingest_plan.validate_account('testcc', {'date_format': ['%m/%d/%Y']})
+
+def test_time_only_columns_use_their_own_format():
+    parsed = pd.Series(pd.to_datetime(['2024-05-01 08:05:10', '2024-05-01 13:45:00']))
+    created = [int(datetime(2024, 5, 1, 12).timestamp())] * 2
+    date_format = {'Date': '%m/%d/%Y', 'Time': '%H:%M:%S'}
+    assert dates.is_time_only(parsed, created, dates.column_format(date_format, 'Time'))
+    assert not dates.is_time_only(parsed, created, dates.column_format(date_format, 'Date'))
+    assert dates.time_of_day(parsed).tolist() == [pd.Timestamp('1900-01-01 08:05:10'), pd.Timestamp('1900-01-01 13:45:00')]
@@ -0,0 +1,104 @@
+import csv
+import json
+import sqlite3
+import pytest
+import benchmark
+import db
+import export
+import ingest
+import merchant
+from conftest import VIEWS_FILE, with_mode
+
+@pytest.fixture
+def config_file(write_config):
+    return write_config(**with_mode('bulk'))
+
+@pytest.fixture
+def db_file(exports, config_file, tmp_path):
+    """Every export ingested, the views loaded and the merchant table built, without the materialized table."""
+    db_file = str(tmp_path / 'financials.db')
+    for account_name, csv_file in exports.items():
+        ingest.insert_csv_to_db(account_name, csv_file, config_file, db_file)
+    with db.get_database(db_file).writer() as conn:
+        benchmark.load_views(conn, VIEWS_FILE)
+        merchant.refresh_merchants(conn, full=True, config_file=config_file)
+    return db_file
+
+def source_rows(db_file):
+    with db.get_database(db_file).reader() as conn:
+        return export.fetch_rows(conn, 0)
+
+def manifest(export_dir):
+    with open(export_dir / export.MANIFEST_FILE) as f:
+        return json.load(f)
+
+@pytest.mark.parametrize('export_format', list(export.EXPORT_FORMATS))
+def test_export_round_trips_every_row(db_file, tmp_path, export_format):
+    export_dir = tmp_path / 'export'
+    rows = source_rows(db_file)
+    assert export.export(db_file, str(export_dir), export_format) == len(rows)
+    table = export.load_table(str(export_dir))
+    assert table.schema == export.SCHEMA
+    assert sorted(table.column('unique_hash').to_pylist()) == sorted(export.to_table(rows).column('unique_hash').to_pylist())
+    assert manifest(export_dir)['format'] == export_format
+    assert manifest(export_dir)['high_water'] == max(row[9] for row in rows)
+    assert sum(manifest(export_dir)['partitions'].values()) == len(rows)
+
+    # Each partition is sorted by transaction time
+    for relative_path in manifest(export_dir)['partitions']:
+        epochs = export.read_partition(str(export_dir / relative_path), export_format).column('tx_epoch').to_pylist()
+        assert epochs == sorted(epochs, key=lambda epoch: (epoch is None, epoch))
+
+def test_incremental_exports_merge_into_partitions(db_file, config_file, tmp_path):
+    export_dir = tmp_path / 'export'
+    export.export(db_file, str(export_dir))
+    high_water = manifest(export_dir)['high_water']
+    conn = sqlite3.connect(db_file)
+    # Outside the overlap, a change is only picked up by a full export
+    old_hash = conn.execute("SELECT unique_hash FROM amexcc WHERE Tags = '' LIMIT 1").fetchone()[0]
+    conn.execute("UPDATE amexcc SET created = ?, Category = 'Stale' WHERE unique_hash = ?",
+                 (high_water - export.EXPORT_OVERLAP_SECONDS - 10, old_hash))
+    conn.commit()
+    conn.close()
+
+    statement = tmp_path / 'statement.csv'
+    with open(statement, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Date', 'Description', 'Card Member', 'Account #', 'Amount', 'Extended Details', 'Category'])
+        writer.writerow(['03/15/2024', 'NEW SHOP', 'A MEMBER', '-1001', '12.5', '', 'Shopping'])
+    ingest.insert_csv_to_db('amexcc', str(statement), config_file, db_file)
+
+    # The new row, and every row in the overlap again, replacing its exported copy
+    assert export.export(db_file, str(export_dir)) > 1
+    hashes = export.load_table(str(export_dir)).column('unique_hash').to_pylist()
+    assert len(hashes) == len(set(hashes)) == len(source_rows(db_file))
+    frame = export.load_dataframe(str(export_dir), accounts=['amexcc'], months=['2024-03'])
+    assert 'NEW SHOP' in set(frame['tx_merchant'])
+    assert manifest(export_dir)['high_water'] == max(row[9] for row in source_rows(db_file))
+
+    categories = lambda: set(export.load_dataframe(str(export_dir), columns=['source_category'])['source_category'])
+    assert 'Stale' not in categories()
+    export.export(db_file, str(export_dir), full=True)
+    assert 'Stale' in categories()
+
+def test_dataframes_use_compact_dtypes(db_file, tmp_path):
+    export_dir = tmp_path / 'export'
+    export.export(db_file, str(export_dir))
+    frame = export.load_dataframe(str(export_dir))
+    assert str(frame['tx_epoch'].dtype) == 'int64'
+    assert str(frame['created'].dtype) == 'int64'
+    for column in ('Account', 'source_category', 'tx_category'):
+        assert str(frame[column].dtype) == 'category', column
+    assert set(frame['Account'].cat.categories) <= {'amexcc', 'chasecc', 'venmo', 'paypal', 'amazon'}
+
+    selected = export.load_dataframe(str(export_dir), accounts=['venmo'], columns=['Account', 'tx_amount'])
+    assert list(selected.columns) == ['Account', 'tx_amount'] and set(selected['Account']) == {'venmo'}
+    assert export.load_dataframe(str(export_dir), accounts=['missing']).empty
+
+def test_switching_formats_needs_a_full_export(db_file, tmp_path):
+    export_dir = tmp_path / 'export'
+    export.export(db_file, str(export_dir), 'arrow')
+    with pytest.raises(ValueError, match='--full'):
+        export.export(db_file, str(export_dir), 'parquet')
+    export.export(db_file, str(export_dir), 'parquet', full=True)
+    assert export.load_table(str(export_dir)).num_rows == len(source_rows(db_file))
@@ -0,0 +1,147 @@
+import os
+import sqlite3
+import pytest
+import ingest
+from conftest import ACCOUNTS, fail_on_call, table_rows, with_mode
+
+def ingest_twice(exports, config_file, db_file):
+    """Ingest every export twice, the second time as an overlapping statement would be."""
+    for _ in range(2):
+        for account_name, csv_file in exports.items():
+            ingest.insert_csv_to_db(account_name, csv_file, config_file, db_file)
+
+@pytest.fixture
+def row_db(exports, write_config, tmp_path):
+    db_file = str(tmp_path / 'row.db')
+    ingest_twice(exports, write_config('row.yaml', **with_mode('row')), db_file)
+    return db_file
+
+@pytest.mark.parametrize('ingest_mode, settings', [
+    ('bulk', {}),
+    ('stream', {'chunk_size': 70}),
+])
+def test_modes_store_the_same_rows_as_row_mode(exports, write_config, tmp_path, row_db, ingest_mode, settings):
+    db_file = str(tmp_path / f'{ingest_mode}.db')
+    ingest_twice(exports, write_config(f'{ingest_mode}.yaml', **with_mode(ingest_mode, **settings)), db_file)
+    for account_name in ACCOUNTS:
+        assert table_rows(db_file, account_name) == table_rows(row_db, account_name), account_name
+
+def test_second_ingest_only_adds_duplicates(exports, row_db):
+    conn = sqlite3.connect(row_db)
+    for account_name in ACCOUNTS:
+        new = conn.execute(f'SELECT unique_hash FROM "{account_name}" WHERE Tags = \'\'').fetchall()
+        duplicates = {row[0] for row in conn.execute(f'SELECT unique_hash FROM "{account_name}" WHERE Tags = \'duplicate\'')}
+        assert len(new) == len(set(new)), account_name
+        # Every row of the first ingest came back tagged in the second
+        assert {row[0] for row in new} <= duplicates, account_name
+    conn.close()
+
+def test_merchant_keys_do_not_depend_on_ingest_order(exports, write_config, tmp_path):
+    config_file = write_config(**with_mode('bulk'))
+    forward, backward = str(tmp_path / 'forward.db'), str(tmp_path / 'backward.db')
+    for account_name, csv_file in exports.items():
+        ingest.insert_csv_to_db(account_name, csv_file, config_file, forward)
+    for account_name, csv_file in reversed(list(exports.items())):
+        ingest.insert_csv_to_db(account_name, csv_file, config_file, backward)
+    for account_name in ACCOUNTS:
+        assert table_rows(forward, account_name) == table_rows(backward, account_name), account_name
+
+def test_prepare_file_hands_the_writer_only_rows(exports, write_config):
+    prepared = ingest.prepare_file('amexcc', exports['amexcc'], write_config(**with_mode('row')))
+    assert prepared['bulk_rows'] is None
+    assert 'df' not in prepared
+    unique_hash, values, tx_local_date, merchant_key = prepared['rows']['rows'][0]
+    assert isinstance(unique_hash, bytes) and tx_local_date and merchant_key
+    assert len(values) == len(prepared['rows']['columns'])
+
+def test_committed_files_are_moved_under_unique_names(tmp_path):
+    completed = tmp_path / 'completed'
+    moved = []
+    for _ in range(2):
+        file_path = tmp_path / 'statement.csv'
+        file_path.write_text('a,b\n')
+        moved.append(ingest.move_to_completed('amexcc', str(file_path), str(completed)))
+        assert not file_path.exists()
+    assert len(set(moved)) == 2
+    assert sorted(os.listdir(completed / 'amexcc')) == sorted(os.path.basename(path) for path in moved)
+
+# An account without a header row whose Reference column is numbers with one gap
+HEADERS_ACCOUNT = {
+    'headers': ['Date', 'Reference', 'Description', 'Amount'],
+    'column_types': {'Date': 'DATETIME', 'Amount': 'NUMERIC'},
+    'merchant_column': 'Description',
+}
+
+def write_headers_export(path, rows=40, gap=25):
+    with open(path, 'w') as f:
+        for row in range(rows):
+            reference = '' if row == gap else f'{1000 + row:06d}'
+            f.write(f'01/{row % 28 + 1:02d}/2024,{reference},SHOP {row % 7},-{row}.25\n')
+    return str(path)
+
+def test_streamed_chunks_read_the_same_values_as_a_whole_file(write_config, tmp_path):
+    csv_file = write_headers_export(tmp_path / 'statement.csv')
+    tables = []
+    for ingest_mode in ('bulk', 'stream'):
+        config_file = write_config(f'{ingest_mode}.yaml', testsv=dict(HEADERS_ACCOUNT, ingest_mode=ingest_mode, chunk_size=10))
+        db_file = str(tmp_path / f'{ingest_mode}.db')
+        ingest.insert_csv_to_db('testsv', csv_file, config_file, db_file)
+        tables.append(table_rows(db_file, 'testsv'))
+    assert tables[0] == tables[1]
+    conn = sqlite3.connect(str(tmp_path / 'stream.db'))
+    references = [row[0] for row in conn.execute('SELECT Reference FROM testsv ORDER BY rowid')]
+    conn.close()
+    # Neither the gap nor the chunk boundaries turn the numbers into floats or drop their zeros
+    assert references[:3] == ['001000', '001001', '001002'] and references[25] is None
+
+def test_streamed_ingest_resumes_after_a_crash(exports, write_config, tmp_path, monkeypatch):
+    config_file = write_config(**with_mode('stream', chunk_size=70))
+    expected, resumed = str(tmp_path / 'expected.db'), str(tmp_path / 'resumed.db')
+    ingest.insert_csv_to_db('venmo', exports['venmo'], config_file, expected)
+
+    fail_on_call(monkeypatch, 'write_bulk_rows', 3)
+    with pytest.raises(RuntimeError):
+        ingest.insert_csv_to_db('venmo', exports['venmo'], config_file, resumed)
+    monkeypatch.undo()
+    conn = sqlite3.connect(resumed)
+    (rows_committed, completed), = conn.execute("SELECT rows_committed, completed FROM ingest_progress").fetchall()
+    conn.close()
+    # Two chunks made it, less the preamble lines of the first
+    assert 0 < rows_committed < len(table_rows(expected, 'venmo')) and not completed
+
+    ingest.insert_csv_to_db('venmo', exports['venmo'], config_file, resumed)
+    # The chunks committed before the crash are neither inserted again nor tagged as duplicates
+    assert table_rows(resumed, 'venmo') == table_rows(expected, 'venmo')
+
+def test_resume_state_is_kept_per_account(write_config, tmp_path, monkeypatch):
+    csv_file = write_headers_export(tmp_path / 'statement.csv')
+    account = dict(HEADERS_ACCOUNT, ingest_mode='stream', chunk_size=10)
+    config_file = write_config(testsv=account, othersv=account)
+    db_file = str(tmp_path / 'financials.db')
+    fail_on_call(monkeypatch, 'write_bulk_rows', 3)
+    with pytest.raises(RuntimeError):
+        ingest.insert_csv_to_db('testsv', csv_file, config_file, db_file)
+    monkeypatch.undo()
+
+    # The same bytes dropped into another account start from the first row
+    ingest.insert_csv_to_db('othersv', csv_file, config_file, db_file)
+    conn = sqlite3.connect(db_file)
+    assert conn.execute('SELECT count(*) FROM othersv').fetchone() == (40,)
+    assert conn.execute('SELECT count(*) FROM testsv').fetchone() == (20,)
+    conn.close()
+
+def test_progress_keyed_by_file_hash_alone_is_rebuilt(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / 'financials.db'))
+    conn.execute("""
+        CREATE TABLE ingest_progress (file_hash TEXT PRIMARY KEY, account_name TEXT, file_path TEXT,
+                                      rows_committed INTEGER NOT NULL, completed INTEGER NOT NULL DEFAULT 0, updated INTEGER)
+    """)
+    conn.execute("INSERT INTO ingest_progress VALUES ('abc', 'venmo', 'statement.csv', 140, 0, 0)")
+    conn.commit()
+    ingest.create_progress_table(conn.cursor())
+    conn.commit()
+    assert ingest.get_resume_position(conn.cursor(), 'abc', 'venmo') == 140
+    assert ingest.get_resume_position(conn.cursor(), 'abc', 'paypal') == 0
+    ingest.set_progress(conn.cursor(), 'abc', 'paypal', 'statement.csv', 70)
+    assert conn.execute('SELECT count(*) FROM ingest_progress').fetchone() == (2,)
+    conn.close()
@@ -0,0 +1,93 @@
+import os
+import sqlite3
+import pytest
+import yaml
+import ingest
+import ingest_plan
+import row_keys
+from conftest import with_mode
+
+def write_yaml(path, config):
+    with open(path, 'w') as f:
+        yaml.safe_dump(config, f)
+    return str(path)
+
+def test_malformed_accounts_are_rejected_with_every_problem():
+    config = {
+        'amexcc': {'ingest_mode': 'fast', 'header_row': 0, 'colum_types': {}},
+        'chasecc': {
+            'headers': ['Date', 'Amount'],
+            'hash_columns': ['Date', 'Description'],
+            'column_types': {'Date': 'DATETIME'},
+            'date_column': 'Amount',
+            'merchant_rules': {'strip_patterns': ['('], 'cluster_prefixes': 'UBER TRIP'},
+        },
+        'paypal': {'merchant_rules': {'max_tokens': 'two', 'cluster_prefixes': ['UBER TRIP']}},
+        'venmo': ['Date'],
+    }
+    with pytest.raises(ValueError) as excinfo:
+        ingest_plan.compile_plans(config)
+    message = str(excinfo.value)
+    for problem in [
+        "amexcc.ingest_mode: expected a ingest mode, got 'fast'",
+        "amexcc.header_row: expected a positive integer, got 0",
+        "amexcc: unknown setting 'colum_types'",
+        "chasecc.hash_columns: ['Description'] not in headers",
+        "chasecc.date_column: 'Amount' is not a DATETIME column",
+        "chasecc.merchant_rules: missing ), unterminated subpattern",
+        "paypal.merchant_rules: max_tokens must be an integer",
+        "venmo: expected a mapping of settings, got list",
+    ]:
+        assert problem in message
+
+    errors = ingest_plan.validate_account('chasecc', {'merchant_rules': {'cluster_prefixes': 'UBER TRIP'}})
+    assert errors == ["chasecc.merchant_rules.cluster_prefixes: expected a list of strings"]
+    with pytest.raises(ValueError, match='expected a mapping of account names'):
+        ingest_plan.compile_plans(['amexcc'])
+
+def test_unparseable_yaml_is_a_value_error(tmp_path):
+    config_file = tmp_path / 'config.yaml'
+    config_file.write_text('amexcc: [unclosed\n')
+    with pytest.raises(ValueError, match='Invalid configuration in'):
+        ingest_plan.load_plans(str(config_file))
+
+def test_plans_reload_when_the_file_changes(tmp_path):
+    config_file = write_yaml(tmp_path / 'config.yaml', {'amexcc': {'ingest_mode': 'bulk'}})
+    plans = ingest_plan.load_plans(config_file)
+    assert ingest_plan.load_plans(config_file) is plans
+    assert ingest_plan.get_plan(config_file, 'amexcc').ingest_mode == 'bulk'
+    # Accounts the config doesn't mention get the defaults
+    assert ingest_plan.get_plan(config_file, 'citicc').ingest_mode == 'row'
+
+    # Same size, so only the mtime tells the edit apart
+    write_yaml(config_file, {'amexcc': {'ingest_mode': 'row'}})
+    stat = os.stat(config_file)
+    os.utime(config_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert ingest_plan.get_plan(config_file, 'amexcc').ingest_mode == 'row'
+
+    # A broken edit is reported and the next good one picked up
+    write_yaml(config_file, {'amexcc': {'ingest_mode': 'fast'}})
+    with pytest.raises(ValueError):
+        ingest_plan.load_plans(config_file)
+    write_yaml(config_file, {'amexcc': {'ingest_mode': 'stream', 'chunk_size': 50}})
+    assert ingest_plan.get_plan(config_file, 'amexcc').ingest_mode == 'stream'
+
+@pytest.mark.parametrize('ingest_mode', ['row', 'bulk'])
+def test_ignore_hash_leaves_rows_out(exports, write_config, tmp_path, ingest_mode):
+    config_file = write_config('all.yaml', **with_mode(ingest_mode))
+    ingest.insert_csv_to_db('amexcc', exports['amexcc'], config_file, str(tmp_path / 'all.db'))
+    conn = sqlite3.connect(tmp_path / 'all.db')
+    hashes = [row[0] for row in conn.execute("SELECT unique_hash FROM amexcc WHERE Tags = '' ORDER BY rowid LIMIT 3")]
+    total = conn.execute("SELECT COUNT(*) FROM amexcc").fetchone()[0]
+    conn.close()
+
+    ignore_hash = [row_keys.to_hex(key) for key in hashes]
+    config_file = write_config('ignored.yaml', **with_mode(ingest_mode, ignore_hash=ignore_hash))
+    assert ingest_plan.get_plan(config_file, 'amexcc').ignore_keys == frozenset(hashes)
+    ingest.insert_csv_to_db('amexcc', exports['amexcc'], config_file, str(tmp_path / 'ignored.db'))
+    conn = sqlite3.connect(tmp_path / 'ignored.db')
+    stored = [row[0] for row in conn.execute("SELECT unique_hash FROM amexcc")]
+    conn.close()
+    assert not set(stored) & set(hashes)
+    # Repeats of an ignored row in the file are ignored too
+    assert len(stored) <= total - len(hashes)
@@ -0,0 +1,50 @@
+import sqlite3
+import pytest
+import ingest
+import journal
+from conftest import fail_on_call, with_mode
+
+def journal_states(db_file, account_name):
+    conn = sqlite3.connect(db_file)
+    states = [row[0] for row in conn.execute(
+        "SELECT state FROM ingest_journal WHERE account_name = ? ORDER BY id", (account_name,))]
+    conn.close()
+    return states
+
+def test_failed_write_rolls_back_and_is_not_committed(exports, write_config, tmp_path, monkeypatch):
+    config_file = write_config(**with_mode('bulk'))
+    db_file = str(tmp_path / 'financials.db')
+    fail_on_call(monkeypatch, 'refresh_materialized', 1)
+    with pytest.raises(RuntimeError):
+        ingest.insert_csv_to_db('amexcc', exports['amexcc'], config_file, db_file)
+    conn = sqlite3.connect(db_file)
+    assert conn.execute('SELECT count(*) FROM amexcc').fetchone() == (0,)
+    assert not journal.is_committed(conn.cursor(), ingest.file_digest(exports['amexcc']), 'amexcc')
+    conn.close()
+
+def test_busy_retries_journal_the_start_once(exports, write_config, tmp_path, monkeypatch):
+    config_file = write_config(**with_mode('row'))
+    db_file = str(tmp_path / 'financials.db')
+    original = ingest.write_prepared_file
+    calls = []
+    def locked_once(conn, prepared):
+        calls.append(1)
+        if len(calls) == 1:
+            raise sqlite3.OperationalError('database is locked')
+        return original(conn, prepared)
+    monkeypatch.setattr(ingest, 'write_prepared_file', locked_once)
+    ingest.insert_csv_to_db('amexcc', exports['amexcc'], config_file, db_file)
+    assert len(calls) == 2
+    assert journal_states(db_file, 'amexcc') == [journal.STARTED, journal.COMMITTED]
+
+def test_resumed_stream_is_journaled_once_per_attempt(exports, write_config, tmp_path, monkeypatch):
+    config_file = write_config(**with_mode('stream', chunk_size=70))
+    db_file = str(tmp_path / 'financials.db')
+    fail_on_call(monkeypatch, 'write_bulk_rows', 3)
+    with pytest.raises(RuntimeError):
+        ingest.insert_csv_to_db('venmo', exports['venmo'], config_file, db_file)
+    monkeypatch.undo()
+    # Chunks committed before the crash, but not the file
+    assert journal_states(db_file, 'venmo') == [journal.STARTED]
+    ingest.insert_csv_to_db('venmo', exports['venmo'], config_file, db_file)
+    assert journal_states(db_file, 'venmo') == [journal.STARTED, journal.STARTED, journal.COMMITTED]
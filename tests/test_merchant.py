@@ -0,0 +1,145 @@
+import csv
+import sqlite3
+import pytest
+import yaml
+import benchmark
+import db
+import ingest
+import merchant
+from conftest import VIEWS_FILE, with_mode
+
+HEADER = ['Date', 'Description', 'Card Member', 'Account #', 'Amount', 'Extended Details', 'Category']
+SHARED_PREFIX = ['POS PURCHASE STARBUCKS NEW YORK', 'POS PURCHASE SHELL OIL', 'POS PURCHASE']
+UBER = ['UBER TRIP HELP.UBER.COM', 'UBER TRIP SAN FRANCISCO']
+
+@pytest.fixture
+def statement(tmp_path):
+    """An amexcc statement with one charge per description."""
+    csv_file = tmp_path / 'statement.csv'
+    with open(csv_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(HEADER)
+        for index, description in enumerate(SHARED_PREFIX + UBER):
+            writer.writerow(['01/15/2024', description, 'A MEMBER', '-1001', index + 1, '', 'Travel'])
+    return str(csv_file)
+
+@pytest.fixture
+def db_file(exports, statement, write_config, tmp_path):
+    """Every export and the statement ingested without cluster_prefixes, the views loaded."""
+    config_file = write_config(**with_mode('bulk'))
+    db_file = str(tmp_path / 'financials.db')
+    for account_name, csv_file in [*exports.items(), ('amexcc', statement)]:
+        ingest.insert_csv_to_db(account_name, csv_file, config_file, db_file)
+    with db.get_database(db_file).writer() as conn:
+        benchmark.load_views(conn, VIEWS_FILE)
+    return db_file
+
+def cluster_uber(write_config, prefixes=('UBER TRIP',)):
+    """Write the bulk config with amexcc clustering the given prefixes."""
+    with open(write_config(), 'r') as f:
+        rules = dict(yaml.safe_load(f)['amexcc']['merchant_rules'], cluster_prefixes=list(prefixes))
+    overrides = with_mode('bulk')
+    overrides['amexcc']['merchant_rules'] = rules
+    return write_config('clustered.yaml', **overrides)
+
+def refresh(db_file, config_file):
+    with db.get_database(db_file).writer() as conn:
+        merchant.refresh_merchants(conn, config_file=config_file)
+
+def statement_keys(db_file):
+    conn = sqlite3.connect(db_file)
+    placeholders = ', '.join('?' * len(SHARED_PREFIX + UBER))
+    rows = conn.execute(f"SELECT Description, merchant_key FROM amexcc WHERE Description IN ({placeholders})", SHARED_PREFIX + UBER)
+    keys = dict(rows.fetchall())
+    conn.close()
+    return keys
+
+def merchants(db_file):
+    conn = sqlite3.connect(db_file)
+    rows = dict(conn.execute("SELECT merchant_id, category FROM merchant").fetchall())
+    conn.close()
+    return rows
+
+def test_merchants_behind_a_shared_prefix_stay_separate(db_file, write_config):
+    refresh(db_file, write_config(**with_mode('bulk')))
+    keys = statement_keys(db_file)
+    assert [keys[description] for description in SHARED_PREFIX] == ['POS PURCHASE STARBUCKS NEW YORK', 'POS PURCHASE SHELL OIL', 'POS PURCHASE']
+    assert {keys[description] for description in UBER} == {'UBER TRIP HELP UBER COM', 'UBER TRIP SAN FRANCISCO'}
+    assert set(keys.values()) <= set(merchants(db_file))
+
+def test_listed_prefixes_cluster_at_ingest(exports, statement, write_config, tmp_path):
+    config_file = cluster_uber(write_config)
+    db_file = str(tmp_path / 'clustered.db')
+    ingest.insert_csv_to_db('amexcc', statement, config_file, db_file)
+    keys = statement_keys(db_file)
+    assert {keys[description] for description in UBER} == {'UBER TRIP'}
+    assert len({keys[description] for description in SHARED_PREFIX}) == len(SHARED_PREFIX)
+
+def test_listing_a_prefix_moves_stored_rows_and_their_merchant(db_file, write_config):
+    refresh(db_file, write_config(**with_mode('bulk')))
+    with db.get_database(db_file).writer() as conn:
+        conn.execute("UPDATE merchant SET category = 'Rides' WHERE merchant_id = 'UBER TRIP HELP UBER COM'")
+        conn.commit()
+
+    refresh(db_file, cluster_uber(write_config))
+    keys = statement_keys(db_file)
+    assert {keys[description] for description in UBER} == {'UBER TRIP'}
+    assert keys['POS PURCHASE SHELL OIL'] == 'POS PURCHASE SHELL OIL'
+    stored = merchants(db_file)
+    assert stored['UBER TRIP'] == 'Rides'
+    assert 'UBER TRIP HELP UBER COM' not in stored and 'UBER TRIP SAN FRANCISCO' not in stored
+
+    # Unlisting it splits the merchant again, without guessing whose category it was
+    refresh(db_file, write_config(**with_mode('bulk')))
+    keys = statement_keys(db_file)
+    assert {keys[description] for description in UBER} == {'UBER TRIP HELP UBER COM', 'UBER TRIP SAN FRANCISCO'}
+    stored = merchants(db_file)
+    assert stored['UBER TRIP HELP UBER COM'] is None and stored['UBER TRIP SAN FRANCISCO'] is None
+    assert 'UBER TRIP' not in stored
+
+def set_charge(db_file, description, created, category):
+    conn = sqlite3.connect(db_file)
+    conn.execute("UPDATE amexcc SET created = ?, Category = ? WHERE Description = ?", (created, category, description))
+    conn.commit()
+    conn.close()
+
+def tx_categories(db_file, merchant_id):
+    conn = sqlite3.connect(db_file)
+    row = conn.execute("SELECT tx_category FROM merchant WHERE merchant_id = ?", (merchant_id,)).fetchone()
+    conn.close()
+    return row[0].split(',')
+
+def test_incremental_passes_rescan_only_the_overlap(db_file, write_config):
+    config_file = write_config(**with_mode('bulk'))
+    refresh(db_file, config_file)
+    conn = sqlite3.connect(db_file)
+    high_water = conn.execute("SELECT high_water FROM merchant_refresh").fetchone()[0]
+    conn.close()
+    # Committed by an ingest still running during the last pass, and long before it
+    set_charge(db_file, 'POS PURCHASE SHELL OIL', high_water - merchant.REFRESH_OVERLAP_SECONDS + 10, 'Gas')
+    set_charge(db_file, 'POS PURCHASE', high_water - merchant.REFRESH_OVERLAP_SECONDS - 10, 'Fees')
+
+    refresh(db_file, config_file)
+    assert tx_categories(db_file, 'POS PURCHASE SHELL OIL') == ['Travel', 'Gas']
+    assert tx_categories(db_file, 'POS PURCHASE') == ['Travel']
+    with db.get_database(db_file).writer() as conn:
+        merchant.refresh_merchants(conn, full=True, config_file=config_file)
+    assert tx_categories(db_file, 'POS PURCHASE') == ['Travel', 'Fees']
+
+def test_stored_keys_are_rescanned_in_full_only_when_the_rules_change(db_file, write_config, monkeypatch):
+    scans = []
+    rekey_account = merchant.rekey_account
+    def recording(cursor, table, plan, since=0):
+        scans.append((table, since))
+        return rekey_account(cursor, table, plan, since)
+    monkeypatch.setattr(merchant, 'rekey_account', recording)
+    config_file = write_config(**with_mode('bulk'))
+
+    refresh(db_file, config_file)
+    assert ('amexcc', 0) in scans
+    scans.clear()
+    refresh(db_file, config_file)
+    assert scans and all(since > 0 for _, since in scans)
+    scans.clear()
+    refresh(db_file, cluster_uber(write_config))
+    assert ('amexcc', 0) in scans and all(since > 0 for table, since in scans if table != 'amexcc')
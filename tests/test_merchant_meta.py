@@ -0,0 +1,111 @@
+import asyncio
+import sqlite3
+import threading
+import time
+import pytest
+import db
+import merchant
+import merchant_meta
+import stub_llm
+from conftest import load_service
+
+MERCHANTS = [f'SHOP {name}' for name in 'ABCDEFGHIJKL']
+
+@pytest.fixture
+def stub():
+    """The stub LLM on a free port, returning (base_url, stats)."""
+    servers = []
+    def start(max_merchants=None):
+        server = stub_llm.make_server(0, max_merchants)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f'http://127.0.0.1:{server.server_address[1]}/v1', server.RequestHandlerClass.stats
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+@pytest.fixture
+def db_file(tmp_path, monkeypatch):
+    db_file = str(tmp_path / 'financials.db')
+    monkeypatch.setattr(merchant_meta, 'DB_FILE', db_file)
+    monkeypatch.setenv('OPENAI_API_KEY', 'stub')
+    with db.get_database(db_file).writer() as conn:
+        merchant.create_merchant_table_if_not_exists(conn.cursor())
+        conn.executemany("INSERT INTO merchant (merchant_id) VALUES (?)", [(name,) for name in MERCHANTS])
+        conn.commit()
+    return db_file
+
+def enriched(db_file):
+    conn = sqlite3.connect(db_file)
+    rows = conn.execute("SELECT merchant_id FROM merchant WHERE city = 'Springfield' AND gpt_category = 'STUB'").fetchall()
+    conn.close()
+    return sorted(row[0] for row in rows)
+
+def run(base_url, tmp_path, *args):
+    merchant_meta.main(['--base-url', base_url, '--cache', str(tmp_path / 'cache.db'), '--batch-size', '4', *args])
+
+def test_merchants_are_enriched_through_the_stub(db_file, stub, tmp_path):
+    base_url, stats = stub()
+    run(base_url, tmp_path)
+    assert enriched(db_file) == MERCHANTS
+    assert stats['merchants'] == len(MERCHANTS)
+
+def test_cached_responses_are_not_fetched_again(db_file, stub, tmp_path):
+    base_url, stats = stub()
+    run(base_url, tmp_path)
+    requests = stats['requests']
+    with db.get_database(db_file).writer() as conn:
+        conn.execute("UPDATE merchant SET city = NULL, region = NULL, country = NULL, gpt_category = NULL")
+        conn.commit()
+    run(base_url, tmp_path)
+    assert enriched(db_file) == MERCHANTS
+    assert stats['requests'] == requests
+
+def test_truncated_responses_shrink_the_batches(db_file, stub, tmp_path):
+    base_url, _ = stub(max_merchants=2)
+    run(base_url, tmp_path)
+    assert enriched(db_file) == MERCHANTS
+
+def test_limit_bounds_a_run(db_file, stub, tmp_path):
+    base_url, stats = stub()
+    run(base_url, tmp_path, '--limit', '5')
+    assert len(enriched(db_file)) == 5
+    assert stats['merchants'] == 5
+
+def test_rate_limiter_waits_for_the_request_budget():
+    async def acquire_all():
+        limiter = merchant_meta.RateLimiter(requests_per_minute=600, tokens_per_minute=10**6)
+        started = time.monotonic()
+        # The full bucket, then one request refilled at 10 per second
+        for _ in range(601):
+            await limiter.acquire(1)
+        return time.monotonic() - started
+    assert asyncio.run(acquire_all()) >= 0.05
+
+def test_rate_limiter_waits_for_the_token_budget():
+    async def acquire_all():
+        limiter = merchant_meta.RateLimiter(requests_per_minute=10**6, tokens_per_minute=6000)
+        started = time.monotonic()
+        await limiter.acquire(6000)
+        # 100 tokens refill per second
+        await limiter.acquire(50)
+        return time.monotonic() - started
+    assert asyncio.run(acquire_all()) >= 0.4
+
+def test_service_bounds_merchant_meta_runs(monkeypatch):
+    service = load_service()
+    calls = []
+    monkeypatch.setattr(service.subprocess, 'run', lambda args, **kwargs: calls.append(args))
+    service.DropzoneHandler().run_merchant_meta()
+    assert calls and calls[0][-2:] == ['--limit', str(service.MERCHANT_META_LIMIT)]
+    assert service.MERCHANT_META_LIMIT == 500
+
+def test_service_skips_merchant_meta_without_a_key(monkeypatch, tmp_path):
+    service = load_service()
+    monkeypatch.delenv('OPENAI_API_KEY', raising=False)
+    monkeypatch.setattr(service, 'OPENAI_KEY_FILE', str(tmp_path / 'missing.txt'))
+    handler = service.DropzoneHandler()
+    handler.start_merchant_meta()
+    handler.start_merchant_meta()
+    assert handler.merchant_meta_thread is None and handler.merchant_meta_warned
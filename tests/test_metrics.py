@@ -0,0 +1,101 @@
+import threading
+import urllib.request
+import pytest
+import ingest
+import metrics
+from conftest import with_mode
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    """An empty registry per test, so counts from other tests don't leak in."""
+    for name in ('_counters', '_gauges', '_histograms'):
+        monkeypatch.setattr(metrics, name, {})
+
+def series(text):
+    """{series with labels: value} of the sample lines of the text format."""
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+    return samples
+
+def test_counters_and_gauges_render_with_help_type_and_labels():
+    metrics.count('rows_total', 3, account='amexcc', outcome='inserted')
+    metrics.count('rows_total', 2, account='amexcc', outcome='inserted')
+    metrics.count('rows_total', outcome='skipped', account=None)
+    metrics.gauge('queue_depth', 4, state='pending "new"\n')
+    text = metrics.render()
+    lines = text.splitlines()
+    assert lines.index('# HELP findb_rows_total CSV rows processed per account by outcome (inserted, duplicate, skipped).') \
+        == lines.index('# TYPE findb_rows_total counter') - 1
+    assert '# TYPE findb_queue_depth gauge' in lines
+    assert series(text) == {
+        'findb_rows_total{account="amexcc",outcome="inserted"}': 5,
+        # Labels set to None are left out
+        'findb_rows_total{outcome="skipped"}': 1,
+        'findb_queue_depth{state="pending \\"new\\"\\n"}': 4,
+    }
+    assert text.endswith('\n')
+
+def test_histogram_buckets_are_cumulative():
+    for seconds in (0.002, 0.2, 1000):
+        metrics.observe('commit_seconds', seconds, table='merchant')
+    samples = series(metrics.render())
+    bucket = 'findb_commit_seconds_bucket{{table="merchant",le="{}"}}'
+    assert samples[bucket.format(0.001)] == 0
+    assert samples[bucket.format(0.005)] == 1
+    assert samples[bucket.format(0.5)] == 2
+    assert samples[bucket.format(300)] == 2
+    assert samples[bucket.format('+Inf')] == 3
+    assert samples['findb_commit_seconds_count{table="merchant"}'] == 3
+    assert samples['findb_commit_seconds_sum{table="merchant"}'] == pytest.approx(1000.202)
+
+def test_stage_timers_record_one_observation(monkeypatch):
+    clock = iter([0.0, 0.25, 1.0, 1.5, 2.0, 2.25])
+    monkeypatch.setattr(metrics.time, 'perf_counter', lambda: next(clock))
+    with metrics.stage('hash', account='amexcc'):
+        pass
+    timer = metrics.StageTimer('insert', account='amexcc')
+    for _ in range(2):
+        with timer:
+            pass
+    timer.record()
+    samples = series(metrics.render())
+    assert samples['findb_stage_seconds_count{account="amexcc",stage="hash"}'] == 1
+    assert samples['findb_stage_seconds_sum{account="amexcc",stage="hash"}'] == 0.25
+    # Two timed intervals of the loop, counted once
+    assert samples['findb_stage_seconds_count{account="amexcc",stage="insert"}'] == 1
+    assert samples['findb_stage_seconds_sum{account="amexcc",stage="insert"}'] == 0.75
+
+def test_concurrent_counts_are_not_lost():
+    def add():
+        for _ in range(1000):
+            metrics.count('files_total', outcome='committed')
+    threads = [threading.Thread(target=add) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert series(metrics.render())['findb_files_total{outcome="committed"}'] == 8000
+
+def test_ingest_fills_the_registry_served_over_http(exports, write_config, tmp_path):
+    ingest.insert_csv_to_db('amexcc', exports['amexcc'], write_config(**with_mode('bulk')), str(tmp_path / 'financials.db'))
+    server = metrics.serve(0)
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{server.server_address[1]}/metrics') as response:
+            assert response.headers['Content-Type'] == 'text/plain; version=0.0.4'
+            samples = series(response.read().decode())
+    finally:
+        server.shutdown()
+        server.server_close()
+    rows = {name: value for name, value in samples.items() if name.startswith('findb_rows_total{account="amexcc"')}
+    assert samples['findb_rows_total{account="amexcc",outcome="inserted"}'] > 0
+    with open(exports['amexcc']) as f:
+        assert sum(rows.values()) == len(f.readlines()) - 1
+    assert samples['findb_stage_seconds_count{account="amexcc",stage="read_csv"}'] == 1
+    assert any(name.startswith('findb_commit_seconds_count') for name in samples)
+
+    metrics_file = tmp_path / 'findb.prom'
+    metrics.write_file(str(metrics_file))
+    assert series(metrics_file.read_text()) == samples
@@ -0,0 +1,86 @@
+import pytest
+import yaml
+import benchmark
+import db
+import ingest
+import merchant
+import query
+import row_keys
+from conftest import CONFIG_FILE, VIEWS_FILE, with_mode
+
+@pytest.fixture
+def db_file(exports, write_config, tmp_path):
+    """A database with every export ingested, the views loaded and the merchant table built."""
+    config_file = write_config(**with_mode('bulk'))
+    db_file = str(tmp_path / 'financials.db')
+    for account_name, csv_file in exports.items():
+        ingest.insert_csv_to_db(account_name, csv_file, config_file, db_file)
+    with db.get_database(db_file).writer() as conn:
+        benchmark.load_views(conn, VIEWS_FILE)
+        merchant.refresh_merchants(conn, full=True, config_file=config_file)
+    return db_file
+
+def all_pages(conn, limit, **filters):
+    rows, after = [], None
+    while True:
+        page, after = query.fetch_page(conn, after=after, limit=limit, **filters)
+        assert len(page) <= limit
+        rows.extend(page)
+        if after is None:
+            return rows
+
+@pytest.mark.parametrize('filters', [
+    {},
+    {'accounts': ['amexcc', 'venmo']},
+    {'start': '2023-03-01', 'end': '2023-06-30'},
+])
+def test_pages_add_up_to_a_single_query(db_file, filters):
+    with db.get_database(db_file).reader() as conn:
+        everything, after = query.fetch_page(conn, limit=query.MAX_LIMIT, **filters)
+        assert after is None and everything
+        assert all_pages(conn, 7, **filters) == everything
+    positions = [(row['tx_date'], row_keys.sort_key(row_keys.from_hex(row['unique_hash']))) for row in everything]
+    assert positions == sorted(positions) and len(set(positions)) == len(positions)
+    if 'accounts' in filters:
+        assert {row['source'] for row in everything} == set(filters['accounts'])
+    if 'start' in filters:
+        assert all(filters['start'] <= row['tx_date'] <= filters['end'] for row in everything)
+
+def test_last_full_page_has_no_cursor(db_file):
+    with db.get_database(db_file).reader() as conn:
+        everything, _ = query.fetch_page(conn, accounts=['venmo'], limit=query.MAX_LIMIT)
+        page, after = query.fetch_page(conn, accounts=['venmo'], limit=len(everything))
+    assert page == everything and after is None
+
+def test_invalid_cursor_is_rejected(db_file):
+    with db.get_database(db_file).reader() as conn, pytest.raises(ValueError):
+        query.fetch_page(conn, after='not-a-cursor')
+
+def test_cached_pages_are_dropped_after_a_commit(db_file, write_config, tmp_path):
+    transactions = query.TransactionQuery(db_file)
+    before = list(transactions.iter_rows(accounts=['amexcc'], limit=50))
+    assert list(transactions.iter_rows(accounts=['amexcc'], limit=50)) == before
+    assert transactions.hits and transactions.misses
+
+    # A second statement with other rows
+    config_file = write_config(**with_mode('bulk'))
+    with open(CONFIG_FILE, 'r') as f:
+        config = yaml.safe_load(f)
+    other = benchmark.generate_exports(config, 20, str(tmp_path / 'other'), seed=99, accounts=['amexcc'])
+    ingest.insert_csv_to_db('amexcc', other['amexcc'], config_file, db_file)
+    assert len(list(transactions.iter_rows(accounts=['amexcc'], limit=50))) > len(before)
+
+def test_merchant_filters_use_each_accounts_rules(db_file, write_config):
+    config_file = write_config(**with_mode('bulk'))
+    with db.get_database(db_file).reader() as conn:
+        merchant_key, merchant_name = conn.execute(
+            "SELECT merchant_key, Description FROM amexcc WHERE merchant_key IS NOT NULL"
+            " AND Description NOT LIKE '%*%' AND Description NOT LIKE 'AplPay%' LIMIT 1"
+        ).fetchone()
+        by_key, _ = query.fetch_page(conn, accounts=['amexcc'], merchant=merchant_key, limit=query.MAX_LIMIT, config_file=config_file)
+        # amexcc strips the Apple Pay prefix before keying, the default rules don't
+        by_description, _ = query.fetch_page(conn, accounts=['amexcc'], merchant=f'AplPay {merchant_name} #1234',
+                                             limit=query.MAX_LIMIT, config_file=config_file)
+    assert by_key and by_key == by_description
+    assert {row['merchant_key'] for row in by_key} == {merchant_key}
+    assert query.normalize_merchant_key('AplPay STARBUCKS #1234') == 'APLPAY STARBUCKS'
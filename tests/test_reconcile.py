@@ -0,0 +1,102 @@
+import sqlite3
+import sys
+import pytest
+import db
+import reconcile
+
+CREATED = 10**6
+
+@pytest.fixture
+def db_file(tmp_path):
+    """Bare charge and order tables, with only the columns reconcile.py reads."""
+    db_file = str(tmp_path / 'financials.db')
+    conn = sqlite3.connect(db_file)
+    for table_name, amount_column in ((reconcile.CHARGE_TABLE, reconcile.CHARGE_AMOUNT), (reconcile.ORDER_TABLE, reconcile.ORDER_AMOUNT)):
+        conn.execute(f'CREATE TABLE "{table_name}" (unique_hash BLOB, Tags TEXT, created INTEGER, tx_local_date TEXT, {amount_column} NUMERIC)')
+    conn.commit()
+    conn.close()
+    return db_file
+
+def add(db_file, table_name, name, day, amount, created=CREATED, tags=''):
+    conn = sqlite3.connect(db_file)
+    conn.execute(f'INSERT INTO "{table_name}" VALUES (?, ?, ?, ?, ?)', (name.encode(), tags, created, f'2024-03-{day:02d}', amount))
+    conn.commit()
+    conn.close()
+
+def charge(db_file, name, day, amount, **kwargs):
+    add(db_file, reconcile.CHARGE_TABLE, name, day, amount, **kwargs)
+
+def order(db_file, name, day, amount, **kwargs):
+    add(db_file, reconcile.ORDER_TABLE, name, day, amount, **kwargs)
+
+def run(db_file, full=False):
+    with db.get_database(db_file).writer() as conn:
+        return reconcile.reconcile(conn, full)
+
+def links(db_file):
+    conn = sqlite3.connect(db_file)
+    rows = conn.execute(f"SELECT amex_hash, amazon_hash, lag_days FROM {reconcile.LINK_TABLE}").fetchall()
+    conn.close()
+    return {(amex_hash.decode(), amazon_hash.decode(), lag_days) for amex_hash, amazon_hash, lag_days in rows}
+
+def test_each_charge_and_order_links_once(db_file):
+    for name in ('o1', 'o2'):
+        order(db_file, name, 10, 25.5)
+    for name, day in (('c1', 11), ('c2', 12), ('c3', 13)):
+        charge(db_file, name, day, 25.5)
+    # Tagged duplicates never link
+    order(db_file, 'o3', 10, 25.5, tags='duplicate')
+    assert run(db_file) == 2
+    assert links(db_file) == {('c1', 'o1', 1), ('c2', 'o2', 2)}
+    # Nothing left to link on the next pass
+    assert run(db_file) == 0
+
+def test_charges_match_within_the_window_after_the_order(db_file):
+    order(db_file, 'before', 10, 1)
+    charge(db_file, 'before', 9, 1)
+    order(db_file, 'last', 10, 2)
+    charge(db_file, 'last', 10 + reconcile.MATCH_WINDOW_DAYS, 2)
+    order(db_file, 'late', 10, 3)
+    charge(db_file, 'late', 11 + reconcile.MATCH_WINDOW_DAYS, 3)
+    order(db_file, 'cents', 10, 4.001)
+    charge(db_file, 'cents', 10, 4)
+    run(db_file)
+    assert links(db_file) == {('last', 'last', reconcile.MATCH_WINDOW_DAYS), ('cents', 'cents', 0)}
+
+def test_the_closest_day_wins_and_ties_are_deterministic(db_file):
+    order(db_file, 'o1', 10, 9)
+    charge(db_file, 'far', 13, 9)
+    charge(db_file, 'near', 11, 9)
+    # Same day, broken on the hashes
+    for name in ('o3', 'o2'):
+        order(db_file, name, 20, 7)
+    charge(db_file, 'c1', 21, 7)
+    run(db_file)
+    assert links(db_file) == {('near', 'o1', 1), ('c1', 'o2', 1)}
+
+def test_rows_created_in_the_overlap_are_matched_again(db_file):
+    order(db_file, 'o1', 1, 5)
+    charge(db_file, 'c1', 2, 5)
+    run(db_file)
+    # Committed by an ingest still running during the last pass, and long before it
+    charge(db_file, 'recent', 3, 6, created=CREATED - reconcile.RECONCILE_OVERLAP_SECONDS + 10)
+    order(db_file, 'recent', 3, 6, created=1)
+    charge(db_file, 'old', 4, 8, created=CREATED - reconcile.RECONCILE_OVERLAP_SECONDS - 10)
+    order(db_file, 'old', 4, 8, created=1)
+    assert run(db_file) == 1
+    assert ('recent', 'recent', 0) in links(db_file)
+    assert run(db_file, full=True) == 3
+    assert ('old', 'old', 0) in links(db_file)
+
+def test_full_drops_every_link_and_matches_again(db_file, monkeypatch):
+    order(db_file, 'o1', 10, 5)
+    charge(db_file, 'c1', 10, 5)
+    order(db_file, 'o2', 12, 5)
+    run(db_file)
+    conn = sqlite3.connect(db_file)
+    conn.execute(f"UPDATE {reconcile.LINK_TABLE} SET amazon_hash = ?", (b'o2',))
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(sys, 'argv', ['reconcile.py', '--db', db_file, '--full'])
+    reconcile.main()
+    assert links(db_file) == {('c1', 'o1', 0)}
@@ -0,0 +1,105 @@
+import csv
+import logging
+import sqlite3
+import time
+import pandas as pd
+import pytest
+import ingest
+import row_keys
+import schema
+from conftest import table_rows
+
+ACCOUNT = 'testcc'
+ACCOUNT_CONFIG = {
+    'merchant_column': 'Description',
+    'column_types': {'Date': 'DATETIME', 'Time': 'DATETIME', 'Posted': 'DATETIME', 'Amount': 'NUMERIC'},
+}
+HEADER = ['Date', 'Time', 'Posted', 'Description', 'Amount']
+ROWS = [
+    ['01/15/2024', '08:05:10', '2024-01-15 08:05:10', 'STARBUCKS 123 NEW YORK', '-4.50'],
+    ['07/04/2024', '13:45:00', '2024-07-04 13:45:00', 'SHELL OIL  57442', '-41.07'],
+    # Fall back: 01:30 happens twice, both conversions take the first (EDT) one
+    ['11/05/2023', '01:30:00', '2023-11-05 01:30:00', 'Whole Foods #10', '-23'],
+    # Spring forward: 02:30 does not exist, ingest shifts it to 03:00
+    ['03/10/2024', '02:30:00', '2024-03-10 02:30:00', 'PAYROLL', '1500.00'],
+    # Midnight of the day the month-based guess switched offsets
+    ['04/01/2024', '23:59:59', '2024-04-01 00:00:00', 'AMAZON MKTPL*1X2Y3', '-19.99'],
+]
+
+def write_csv(path, rows=ROWS):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(HEADER)
+        writer.writerows(rows)
+    return str(path)
+
+def original_epoch(value):
+    """DATETIME conversion of the original ingest: inferred parse, offset guessed from the month."""
+    timestamp = pd.to_datetime(value)
+    offset_hours = 4 if timestamp.month in [4, 5, 6, 7, 8, 9, 10] else 5
+    return int((timestamp + pd.Timedelta(hours=offset_hours)).timestamp())
+
+def create_original_database(db_file, rows=ROWS):
+    """Store rows the way the original ingest did: hex SHA-256 keys and month-guessed epochs."""
+    conn = sqlite3.connect(db_file)
+    conn.execute(f'CREATE TABLE "{ACCOUNT}" ("unique_hash" TEXT, "Tags" TEXT, "created" INTEGER, "Date" INTEGER, '
+                 f'"Time" INTEGER, "Posted" INTEGER, "Description" TEXT, "Amount" NUMERIC)')
+    for date, time_of_day, posted, description, amount in rows:
+        values = [original_epoch(date), original_epoch(time_of_day), original_epoch(posted),
+                  ' '.join(description.split()), float(amount)]
+        conn.execute(f'INSERT INTO "{ACCOUNT}" VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                     [row_keys.legacy_hash(values, ACCOUNT), '', int(time.time())] + values)
+    conn.commit()
+    conn.close()
+
+@pytest.fixture
+def config_file(write_config):
+    return write_config(**{ACCOUNT: ACCOUNT_CONFIG})
+
+def test_migrated_rows_match_a_fresh_ingest(tmp_path, config_file):
+    csv_file = write_csv(tmp_path / 'statement.csv')
+    fresh, migrated = str(tmp_path / 'fresh.db'), str(tmp_path / 'migrated.db')
+    ingest.insert_csv_to_db(ACCOUNT, csv_file, config_file, fresh)
+    create_original_database(migrated)
+    assert schema.migrate(migrated, config_file) == [ACCOUNT]
+    assert table_rows(migrated, ACCOUNT) == table_rows(fresh, ACCOUNT)
+
+def test_reingest_after_migration_only_adds_duplicates(tmp_path, config_file):
+    migrated = str(tmp_path / 'migrated.db')
+    create_original_database(migrated)
+    schema.migrate(migrated, config_file)
+    ingest.insert_csv_to_db(ACCOUNT, write_csv(tmp_path / 'statement.csv'), config_file, migrated)
+    conn = sqlite3.connect(migrated)
+    tags = dict(conn.execute(f'SELECT Tags, count(*) FROM "{ACCOUNT}" GROUP BY Tags').fetchall())
+    conn.close()
+    assert tags == {'': len(ROWS), 'duplicate': len(ROWS)}
+
+def test_migration_is_idempotent(tmp_path, config_file):
+    migrated = str(tmp_path / 'migrated.db')
+    create_original_database(migrated)
+    schema.migrate(migrated, config_file)
+    before = table_rows(migrated, ACCOUNT)
+    assert schema.migrate(migrated, config_file) == []
+    assert table_rows(migrated, ACCOUNT) == before
+
+def test_migration_indexes_the_table(tmp_path, config_file):
+    migrated = str(tmp_path / 'migrated.db')
+    create_original_database(migrated)
+    schema.migrate(migrated, config_file)
+    conn = sqlite3.connect(migrated)
+    indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ?", (ACCOUNT,))}
+    version = conn.execute("SELECT version FROM schema_version WHERE table_name = ?", (ACCOUNT,)).fetchone()
+    conn.close()
+    expected = [('unique_hash',), ('Date',), ('Posted',), ('Description',), ('merchant_key',), ('created',),
+                ('tx_local_date', 'unique_hash')]
+    assert {schema.index_name(ACCOUNT, *columns) for columns in expected} <= indexes
+    assert version == (schema.SCHEMA_VERSION,)
+
+def test_hour_stored_twice_is_reported(tmp_path, config_file, caplog):
+    # 23:30 on March 31 at EST and 00:30 on April 1 at EDT were stored as the same epoch
+    rows = ROWS + [['03/31/2024', '23:30:00', '2024-03-31 23:30:00', 'LATE NIGHT', '-1.00']]
+    migrated = str(tmp_path / 'migrated.db')
+    create_original_database(migrated, rows)
+    with caplog.at_level(logging.WARNING):
+        schema.migrate(migrated, config_file)
+    assert any("'Posted'" in message and 'stored twice' in message for message in caplog.messages)
@@ -0,0 +1,91 @@
+import threading
+import time
+import types
+import pytest
+from conftest import load_service
+
+service = load_service()
+
+class FakeEngine:
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, account_name, file_path):
+        self.submitted.append((account_name, file_path))
+
+    def pending_count(self):
+        return 0
+
+    def pending_snapshot(self):
+        return {}
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+@pytest.fixture
+def fast_scheduler(monkeypatch):
+    monkeypatch.setattr(service, 'POLL_INTERVAL', 0.01)
+    monkeypatch.setattr(service, 'STABLE_SECONDS', 0.05)
+    monkeypatch.setattr(service, 'QUIET_SECONDS', 0.05)
+
+def test_files_are_submitted_once_they_stop_changing(tmp_path, monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(service, 'time', types.SimpleNamespace(monotonic=lambda: now[0]))
+    scheduler = service.DropzoneScheduler(FakeEngine(), on_quiet=None)
+    file_path = tmp_path / 'statement.csv'
+    file_path.write_text('a,b\n')
+    scheduler.note_file('amexcc', str(file_path))
+    scheduler.note_file('amexcc', str(file_path))
+    assert scheduler._poll_ready() == {}
+
+    # Still being written: the stability timer starts over
+    now[0] = 1.5
+    file_path.write_text('a,b\n1,2\n')
+    assert scheduler._poll_ready() == {}
+    now[0] = 3.0
+    assert scheduler._poll_ready() == {}
+    now[0] = 1.5 + service.STABLE_SECONDS
+    assert scheduler._poll_ready() == {'amexcc': [str(file_path)]}
+    assert scheduler._poll_ready() == {} and scheduler.pending_files() == set()
+
+def test_deleted_files_are_forgotten(tmp_path):
+    scheduler = service.DropzoneScheduler(FakeEngine(), on_quiet=None)
+    scheduler.note_file('amexcc', str(tmp_path / 'gone.csv'))
+    assert scheduler._poll_ready() == {} and scheduler.pending_files() == set()
+
+def test_merchant_pass_runs_once_per_quiet_period(fast_scheduler):
+    passes = []
+    scheduler = service.DropzoneScheduler(FakeEngine(), on_quiet=lambda: passes.append(threading.current_thread()))
+    scheduler.start()
+    try:
+        # Once after startup
+        wait_for(lambda: len(passes) == 1)
+        for _ in range(3):
+            scheduler.note_committed()
+        wait_for(lambda: len(passes) == 2)
+        time.sleep(0.2)
+        assert len(passes) == 2
+    finally:
+        scheduler.stop()
+    assert scheduler.thread not in passes
+
+def test_files_are_submitted_while_the_merchant_pass_runs(tmp_path, fast_scheduler):
+    engine = FakeEngine()
+    running, release = threading.Event(), threading.Event()
+    def merchant_pass():
+        running.set()
+        release.wait(5)
+    scheduler = service.DropzoneScheduler(engine, on_quiet=merchant_pass)
+    scheduler.start()
+    try:
+        wait_for(running.is_set)
+        file_path = tmp_path / 'statement.csv'
+        file_path.write_text('a,b\n')
+        scheduler.note_file('amexcc', str(file_path))
+        wait_for(lambda: engine.submitted == [('amexcc', str(file_path))])
+    finally:
+        release.set()
+        scheduler.stop()
@@ -2,20 +2,24 @@
 DROP VIEW amexsv_view;
 CREATE VIEW amexsv_view AS
 SELECT
-    substr(unique_hash, 1, 5) || '...' || substr(unique_hash, -4) AS unique_hash,
+    substr(lower(hex(unique_hash)), 1, 5) || '...' || substr(lower(hex(unique_hash)), -4) AS unique_hash,
     'amexsv' AS Account,
     "Date" AS tx_date,
     Type AS tx_merchant,
     Amount AS tx_amount,
     NULL AS tx_category,
-    NULL AS tx_note
+    NULL AS tx_note,
+    unique_hash AS source_hash,
+    created,
+    tx_local_date,
+    merchant_key
 FROM amexsv
 WHERE Tags != 'duplicate' OR Tags IS NULL;
 
 DROP VIEW venmo_view;
 CREATE VIEW venmo_view AS
 SELECT
-    substr(unique_hash, 1, 5) || '...' || substr(unique_hash, -4) AS unique_hash,
+    substr(lower(hex(unique_hash)), 1, 5) || '...' || substr(lower(hex(unique_hash)), -4) AS unique_hash,
     'venmo' AS Account,
     "Datetime" AS tx_date,
     IFNULL(
@@ -28,20 +32,36 @@ SELECT
     ) AS tx_merchant, 
     CAST(REPLACE([Amount (total)], '$', '') AS NUMERIC) AS tx_amount,
     Type AS tx_category,
-    Note AS tx_note
+    Note AS tx_note,
+    unique_hash AS source_hash,
+    created,
+    tx_local_date,
+    -- venmo has no merchant_column, its counterparties are keyed as displayed
+    UPPER(IFNULL(
+        CASE
+            WHEN CAST(REPLACE([Amount (total)], '$', '') AS NUMERIC) < 0 THEN "To"
+            WHEN CAST(REPLACE([Amount (total)], '$', '') AS NUMERIC) >= 0 THEN "From"
+            ELSE NULL
+        END,
+        "Destination"
+    )) AS merchant_key
 FROM venmo
 WHERE Tags != 'duplicate' OR Tags IS NULL;
 
 DROP VIEW paypal_view;
 CREATE VIEW paypal_view AS
 SELECT
-    substr(unique_hash, 1, 5) || '...' || substr(unique_hash, -4) AS unique_hash,
+    substr(lower(hex(unique_hash)), 1, 5) || '...' || substr(lower(hex(unique_hash)), -4) AS unique_hash,
     'paypal' AS Account,
     "Date" AS tx_date,
     IFNULL(Name, Type) AS tx_merchant,
     CAST(REPLACE(Amount, '$', '') AS NUMERIC) AS tx_amount,
     Type AS tx_category,
-    NULL AS tx_note
+    NULL AS tx_note,
+    unique_hash AS source_hash,
+    created,
+    tx_local_date,
+    merchant_key
 FROM paypal
 WHERE Tags != 'duplicate' OR Tags IS NULL;
 
@@ -49,46 +69,58 @@ WHERE Tags != 'duplicate' OR Tags IS NULL;
 DROP VIEW psecuch_view;
 CREATE VIEW psecuch_view AS
 SELECT
-    substr(unique_hash, 1, 5) || '...' || substr(unique_hash, -4) AS unique_hash,
+    substr(lower(hex(unique_hash)), 1, 5) || '...' || substr(lower(hex(unique_hash)), -4) AS unique_hash,
     'psecuch' AS Account,
     "Date" AS tx_date,
     "Transaction Description" AS tx_merchant,
     Amount AS tx_amount,
     Category AS tx_category,
-    Note AS tx_note
+    Note AS tx_note,
+    unique_hash AS source_hash,
+    created,
+    tx_local_date,
+    merchant_key
 FROM psecuch
 WHERE Tags != 'duplicate' OR Tags IS NULL;
 
 DROP VIEW psecucc_view;
 CREATE VIEW psecucc_view AS
 SELECT
-    substr(unique_hash, 1, 5) || '...' || substr(unique_hash, -4) AS unique_hash,
+    substr(lower(hex(unique_hash)), 1, 5) || '...' || substr(lower(hex(unique_hash)), -4) AS unique_hash,
     'psecucc' AS Account,
     "Date" AS tx_date,
     "Transaction Description" AS tx_merchant,
     -(Principal + Interest + Fees) AS tx_amount,
     Category AS tx_category,
-    Note AS tx_note
+    Note AS tx_note,
+    unique_hash AS source_hash,
+    created,
+    tx_local_date,
+    merchant_key
 FROM psecucc
 WHERE Tags != 'duplicate' OR Tags IS NULL;
 
 DROP VIEW chasecc_view;
 CREATE VIEW chasecc_view AS
 SELECT
-    substr(unique_hash, 1, 5) || '...' || substr(unique_hash, -4) AS unique_hash,
+    substr(lower(hex(unique_hash)), 1, 5) || '...' || substr(lower(hex(unique_hash)), -4) AS unique_hash,
     'chasecc' AS Account,
     "Transaction Date" AS tx_date,
     Description AS tx_merchant,
     Amount AS tx_amount,
     Category AS tx_category,
-    Memo AS tx_note
+    Memo AS tx_note,
+    unique_hash AS source_hash,
+    created,
+    tx_local_date,
+    merchant_key
 FROM chasecc
 WHERE Tags != 'duplicate' OR Tags IS NULL;
 
 DROP VIEW citicc_view;
 CREATE VIEW citicc_view AS
 SELECT
-    substr(unique_hash, 1, 5) || '...' || substr(unique_hash, -4) AS unique_hash,
+    substr(lower(hex(unique_hash)), 1, 5) || '...' || substr(lower(hex(unique_hash)), -4) AS unique_hash,
     'citicc' AS Account,
     "Date" AS tx_date,
     Description AS tx_merchant,
@@ -97,14 +129,18 @@ SELECT
         ELSE -Credit
     END AS tx_amount,
     NULL AS tx_category,
-    NULL AS tx_note
+    NULL AS tx_note,
+    unique_hash AS source_hash,
+    created,
+    tx_local_date,
+    merchant_key
 FROM citicc
 WHERE Tags != 'duplicate' OR Tags IS NULL;
 
 DROP VIEW IF EXISTS amexcc_view;
 CREATE VIEW amexcc_view AS
 SELECT
-    substr(a.unique_hash, 1, 5) || '...' || substr(a.unique_hash, -4) AS unique_hash,
+    substr(lower(hex(a.unique_hash)), 1, 5) || '...' || substr(lower(hex(a.unique_hash)), -4) AS unique_hash,
     'amexcc' AS Account,
     a."Date" AS tx_date,
     a.Description AS tx_merchant,
@@ -112,75 +148,95 @@ SELECT
     COALESCE(m.category, a.Category) AS tx_category,
     CASE
         -- Enrich the tx_note if the category is 'AMAZON'
-        WHEN COALESCE(m.category, a.Category) = 'AMAZON' AND amazon.tx_merchant is not null THEN
-            amazon.tx_merchant
+        WHEN COALESCE(m.category, a.Category) = 'AMAZON' AND o."Product Name" is not null THEN
+            o."Product Name"
         ELSE
             a."Extended Details"
-    END AS tx_note
+    END AS tx_note,
+    a.unique_hash AS source_hash,
+    a.created,
+    a.tx_local_date,
+    a.merchant_key
 FROM amexcc a
-LEFT JOIN amazon_view amazon ON
-    date(a."Date", 'unixepoch') = date(amazon.tx_date, 'unixepoch') AND  -- Compare date part only
-    a.Amount = amazon.tx_amount
-LEFT JOIN merchant m ON a.Description = m.merchant_id  -- Adjusted join to include merchant table
+-- Orders are matched to charges by reconcile.py; amazon_amex_link is created by schema migration 7
+LEFT JOIN amazon_amex_link l ON l.amex_hash = a.unique_hash
+LEFT JOIN amazon o ON o.unique_hash = l.amazon_hash AND (o.Tags != 'duplicate' OR o.Tags IS NULL)
+LEFT JOIN merchant m ON a.merchant_key = m.merchant_id  -- Merchants are keyed by the canonical merchant key
 WHERE (a.Tags != 'duplicate' OR a.Tags IS NULL);
 
 
 DROP VIEW psecupe_view;
 CREATE VIEW psecupe_view AS
 SELECT
-    substr(unique_hash, 1, 5) || '...' || substr(unique_hash, -4) AS unique_hash,
+    substr(lower(hex(unique_hash)), 1, 5) || '...' || substr(lower(hex(unique_hash)), -4) AS unique_hash,
     'psecuch' AS Account,
     "Date" AS tx_date,
     "Transaction Description" AS tx_merchant,
     Amount AS tx_amount,
     Category AS tx_category,
-    Note AS tx_note
+    Note AS tx_note,
+    unique_hash AS source_hash,
+    created,
+    tx_local_date,
+    merchant_key
 FROM psecupe
 WHERE Tags != 'duplicate' OR Tags IS NULL;
 
 DROP VIEW psecuxd_view;
 CREATE VIEW psecuxd_view AS
 SELECT
-    substr(unique_hash, 1, 5) || '...' || substr(unique_hash, -4) AS unique_hash,
+    substr(lower(hex(unique_hash)), 1, 5) || '...' || substr(lower(hex(unique_hash)), -4) AS unique_hash,
     'psecuxd' AS Account,
     "Date" AS tx_date,
     "Transaction Description" AS tx_merchant,
     Amount AS tx_amount,
     Category AS tx_category,
-    Note AS tx_note
+    Note AS tx_note,
+    unique_hash AS source_hash,
+    created,
+    tx_local_date,
+    merchant_key
 FROM psecuxd
 WHERE Tags != 'duplicate' OR Tags IS NULL;
 
 DROP VIEW psecudr_view;
 CREATE VIEW psecudr_view AS
 SELECT
-    substr(unique_hash, 1, 5) || '...' || substr(unique_hash, -4) AS unique_hash,
+    substr(lower(hex(unique_hash)), 1, 5) || '...' || substr(lower(hex(unique_hash)), -4) AS unique_hash,
     'psecudr' AS Account,
     "Date" AS tx_date,
     "Transaction Description" AS tx_merchant,
     Amount AS tx_amount,
     Category AS tx_category,
-    Note AS tx_note
+    Note AS tx_note,
+    unique_hash AS source_hash,
+    created,
+    tx_local_date,
+    merchant_key
 FROM psecudr
 WHERE Tags != 'duplicate' OR Tags IS NULL;
 
 DROP VIEW chasemo_view;
 CREATE VIEW chasemo_view AS
 SELECT
-    substr(unique_hash, 1, 5) || '...' || substr(unique_hash, -4) AS unique_hash,
+    substr(lower(hex(unique_hash)), 1, 5) || '...' || substr(lower(hex(unique_hash)), -4) AS unique_hash,
     'chasemo' AS Account,
     "Date" AS tx_date,
     Description AS tx_merchant,
     Amount AS tx_amount,
     NULL AS tx_category,
-    NULL AS tx_note
+    NULL AS tx_note,
+    unique_hash AS source_hash,
+    created,
+    tx_local_date,
+    merchant_key
 FROM chasemo
 WHERE Tags != 'duplicate' OR Tags IS NULL;
 
 DROP VIEW IF EXISTS mint_view;
 CREATE VIEW mint_view AS
 SELECT
-    substr(unique_hash, 1, 5) || '...' || substr(unique_hash, -4) AS unique_hash,  -- Shortened hash format
+    substr(lower(hex(unique_hash)), 1, 5) || '...' || substr(lower(hex(unique_hash)), -4) AS unique_hash,  -- Shortened hash format
     "Account Name" AS Account,                                                    -- Use "Account Name" from mint as Account
     "Date" AS tx_date,                                                            -- Retaining epoch seconds for consistency
     "Original Description" AS tx_merchant,                                        -- Use "Original Description" as merchant
@@ -193,7 +249,11 @@ SELECT
         COALESCE("Description", '') ||
         CASE WHEN "Labels" IS NOT NULL AND "Labels" != '' THEN ', ' || "Labels" ELSE '' END ||
         CASE WHEN "Notes" IS NOT NULL AND "Notes" != '' THEN ', ' || "Notes" ELSE '' END
-    ) AS tx_note  -- Concatenate Description, Labels, Notes for tx_note
+    ) AS tx_note,  -- Concatenate Description, Labels, Notes for tx_note
+    unique_hash AS source_hash,
+    created,
+    tx_local_date,
+    merchant_key
 FROM mint
 WHERE "Tags" != 'duplicate' OR "Tags" IS NULL;
 
@@ -201,13 +261,17 @@ WHERE "Tags" != 'duplicate' OR "Tags" IS NULL;
 DROP VIEW IF EXISTS amazon_digital_view;
 CREATE VIEW amazon_digital_view AS
 SELECT
-    substr(unique_hash, 1, 5) || '...' || substr(unique_hash, -4) AS unique_hash,
+    substr(lower(hex(unique_hash)), 1, 5) || '...' || substr(lower(hex(unique_hash)), -4) AS unique_hash,
     'amazon_digital' AS Account,
     OrderDate AS tx_date,
     ProductName AS tx_merchant,
     OurPrice AS tx_amount,
     NULL AS tx_category, -- Assuming there's no direct category mapping available
-    "ASIN" || ', ' || "OrderId" || ', ' || COALESCE("GiftMessage", '') AS tx_note
+    "ASIN" || ', ' || "OrderId" || ', ' || COALESCE("GiftMessage", '') AS tx_note,
+    unique_hash AS source_hash,
+    created,
+    tx_local_date,
+    merchant_key
 FROM amazon
 WHERE Tags != 'duplicate' OR Tags IS NULL;
 
@@ -215,13 +279,17 @@ WHERE Tags != 'duplicate' OR Tags IS NULL;
 DROP VIEW IF EXISTS amazon_view;
 CREATE VIEW amazon_view AS
 SELECT
-    substr(unique_hash, 1, 5) || '...' || substr(unique_hash, -4) AS unique_hash,
+    substr(lower(hex(unique_hash)), 1, 5) || '...' || substr(lower(hex(unique_hash)), -4) AS unique_hash,
     'amazon' AS Account,
     "Order Date" AS tx_date,
     "Product Name" AS tx_merchant,
     "Total Owed" AS tx_amount,
     "AMAZON" AS tx_category,  -- No direct category mapping available
-    "Purchase Order Number" || ', ' || "Order ID" AS tx_note  -- Combine Purchase Order Number and Order ID for notes
+    "Purchase Order Number" || ', ' || "Order ID" AS tx_note,  -- Combine Purchase Order Number and Order ID for notes
+    unique_hash AS source_hash,
+    created,
+    tx_local_date,
+    merchant_key
 FROM amazon
 WHERE Tags != 'duplicate' OR Tags IS NULL;
 
@@ -231,14 +299,19 @@ CREATE VIEW all_transactions AS
 SELECT 
     a.unique_hash,
     a.Account,
-    CASE
-        WHEN strftime('%m', a.tx_date, 'unixepoch') IN ('04', '05', '06', '07', '08', '09', '10') THEN date(a.tx_date, 'unixepoch', '-4 hours') -- EDT months
-        ELSE date(a.tx_date, 'unixepoch', '-5 hours') -- EST months
-    END AS tx_date,
+    a.tx_local_date AS tx_date,  -- Eastern Time date precomputed at ingest
     a.tx_merchant,
     a.tx_amount,
-    COALESCE(m.category, m.tx_category, a.tx_category) AS tx_category,
-    a.tx_note
+    -- The manual category, categorize.py's confident one (0.8 is categorize.CONFIDENCE_THRESHOLD) while the LLM
+    -- has none, then the source categories; materialize.TX_CATEGORY matches it
+    COALESCE(
+        m.category,
+        CASE WHEN COALESCE(m.gpt_category, '') = '' AND m.auto_confidence >= 0.8 THEN m.auto_category END,
+        m.tx_category,
+        a.tx_category
+    ) AS tx_category,
+    a.tx_note,
+    a.merchant_key
 FROM (
     SELECT * FROM amexcc_view
     UNION ALL
@@ -268,5 +341,5 @@ FROM (
     UNION ALL
     SELECT * FROM amazon_view
 ) a
-LEFT JOIN merchant m ON a.tx_merchant = m.merchant_id
-ORDER BY a.tx_date;
+LEFT JOIN merchant m ON a.merchant_key = m.merchant_id
+ORDER BY a.tx_local_date;